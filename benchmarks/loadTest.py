@@ -0,0 +1,433 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals, print_function
+
+"""
+End-to-end load test of the manager.
+The web server runs in its own process (see benchmarks.serve) on a
+temporary saves folder and database, with `tools/fakeFactorio.py` as the
+factorio binary. A few instances are created and started through the
+websocket, then fleets of 1, 10 and 100 clients (see `--clients`) each
+follow the instances ('sync'), receive their output, and send 'manage' and
+'system-usage' requests one at a time.
+For each fleet size, the results hold:
+* log: delay between a log line written by the fake server and its
+  reception by a client, in milliseconds
+* actions: round-trip time of the requests by action, in milliseconds
+* memory: RSS of the web server process, in bytes
+* ioloop: lag of the web server IOLoop (see benchmarks.serve), in
+  milliseconds
+The results are saved in `benchmarks/results/`, see `--compare`.
+The clients run on a single IOLoop of this process: above a few hundred
+clients, its own lag shows in the measures.
+
+Run from the root of the repository:
+    python -m benchmarks.loadTest --clients 1 10 100 --duration 30
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import signal
+import random
+import socket
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import timedelta
+
+import psutil
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.concurrent import Future
+from tornado.websocket import websocket_connect
+
+from benchmarks import utils
+
+TICK = re.compile(r'Benchmark\.cpp: tick (\d+\.\d+)')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_FACTORIO = os.path.join('tools', 'fakeFactorio.py')
+
+# requests sent in turn by each client: (message, action of the response)
+REQUESTS = [
+    ({'handlerKey': 'manage', 'action': 'listsaves'}, 'listsaves'),
+    ({'handlerKey': 'system-usage', 'detailed': False}, None),
+    ({'handlerKey': 'manage', 'action': 'load', '_id': '*'}, 'load'),
+    ({'handlerKey': 'manage', 'action': 'diskusage'}, 'diskusage'),
+    ({'handlerKey': 'system-usage', 'detailed': True}, None),
+]
+
+
+class Stats(object):
+    """
+    Measures of a fleet of clients.
+    """
+    def __init__(self):
+        super(Stats, self).__init__()
+        self.logLatencies = []
+        self.roundTrips = {}  # {action: [durations]}
+        self.timeouts = 0
+        self.errors = 0
+
+    def results(self):
+        return {
+            'log': utils.summarize(self.logLatencies, 1000),
+            'actions': dict((action, utils.summarize(durations, 1000))
+                            for action, durations in self.roundTrips.items()),
+            'allActions': utils.summarize(
+                [d for ds in self.roundTrips.values() for d in ds], 1000),
+            'timeouts': self.timeouts,
+            'errors': self.errors
+        }
+
+
+class Client(object):
+    """
+    Websocket client of the manager, sending one request at a time.
+    """
+    def __init__(self, url, stats, timeout):
+        super(Client, self).__init__()
+        self._url = url
+        self._stats = stats
+        self._timeout = timeout
+        self._connection = None
+        self._waiting = None  # (handlerKey, action, future)
+
+    @gen.coroutine
+    def connect(self):
+        self._connection = yield websocket_connect(self._url)
+        IOLoop.current().add_future(self._read(), lambda f: f.result())
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @gen.coroutine
+    def _read(self):
+        connection = self._connection
+        while True:
+            message = yield connection.read_message()
+            if message is None:
+                break
+            self.onMessage(json.loads(message))
+
+    def onMessage(self, message):
+        now = time.time()
+        if message['handlerKey'] == 'error':
+            self._stats.errors += 1
+        if message.get('action') == 'log':
+            for match in TICK.finditer(message['message']):
+                self._stats.logLatencies.append(now - float(match.group(1)))
+        if self._waiting is not None and \
+                self._waiting[:2] == (message['handlerKey'],
+                                      message.get('action')):
+            future = self._waiting[2]
+            self._waiting = None
+            future.set_result(message)
+
+    @gen.coroutine
+    def request(self, message, action):
+        """
+        Send the message, and wait for the response of the handler with the
+        given action. Return the response, None after a timeout.
+        """
+        future = Future()
+        self._waiting = (message['handlerKey'], action, future)
+        t0 = time.time()
+        self._connection.write_message(json.dumps(message))
+        try:
+            response = yield gen.with_timeout(
+                timedelta(seconds=self._timeout), future)
+        except gen.TimeoutError:
+            self._waiting = None
+            self._stats.timeouts += 1
+            raise gen.Return(None)
+        self._stats.roundTrips.setdefault(
+            action or message['handlerKey'], []).append(time.time() - t0)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def drive(self, until, interval):
+        """
+        Send the requests in turn until the given time, `interval` seconds
+        apart on average.
+        """
+        index = random.randrange(len(REQUESTS))
+        yield gen.sleep(random.uniform(0, interval))
+        while time.time() < until and self._connection is not None:
+            message, action = REQUESTS[index % len(REQUESTS)]
+            index += 1
+            yield self.request(dict(message), action)
+            yield gen.sleep(random.uniform(0.5, 1.5) * interval)
+
+
+class LoadTest(object):
+    def __init__(self, ns):
+        super(LoadTest, self).__init__()
+        self._ns = ns
+        self._workdir = tempfile.mkdtemp(prefix='miniboard-bench-')
+        self._server = None
+        self._process = None  # psutil.Process of the server
+        self._url = 'ws://127.0.0.1:%d/websocket' % ns.port
+        self._lagFile = os.path.join(self._workdir, 'lag.txt')
+
+    def _path(self, *parts):
+        # the factorio folders of Conf are given relative to the repository
+        return os.path.relpath(os.path.join(self._workdir, *parts), ROOT)
+
+    def prepare(self):
+        """
+        Create the saves and config folders, and the Conf overrides.
+        """
+        for folder in ('saves', 'config', 'logs'):
+            os.makedirs(os.path.join(self._workdir, folder))
+        # pid files of the instances, see tools.factorio.PIDFILE
+        if not os.path.isdir(os.path.join(ROOT, 'db')):
+            os.makedirs(os.path.join(ROOT, 'db'))
+        for i in range(self._ns.instances):
+            with open(os.path.join(self._workdir, 'saves',
+                                   'bench%d.zip' % i), 'wb') as f:
+                f.write(os.urandom(self._ns.save_size))
+        ports = [self._ns.game_port + i for i in range(self._ns.instances)]
+        overrides = {
+            'state': 'PRODUCTION',
+            'database': {'name': self._path('bench.db')},
+            'placement': {'enabled': False},
+            'server': {'port': self._ns.port},
+            'factorio': {
+                'allowedPorts': ports,
+                'savesFolder': self._path('saves'),
+                'configFolder': self._path('config'),
+                'binary': FAKE_FACTORIO,
+                'hibernation': {'enabled': False},
+                'logArchive': {'folder': self._path('logs')}
+            }
+        }
+        path = os.path.join(self._workdir, 'overrides.json')
+        with open(path, 'w') as f:
+            json.dump(overrides, f)
+        return path
+
+    def startServer(self, overrides):
+        env = dict(os.environ)
+        env.update({
+            'FAKE_FACTORIO_LOG_RATE': str(self._ns.log_rate),
+            'FAKE_FACTORIO_LOG_SIZE': str(self._ns.log_size),
+            'FAKE_FACTORIO_AUTOSAVE_PERIOD': str(self._ns.autosave_period),
+            'FAKE_FACTORIO_STARTUP_DELAY': str(self._ns.startup_delay)
+        })
+        self._server = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.serve', '--overrides',
+             overrides, '--lag-file', self._lagFile], cwd=ROOT, env=env)
+        self._process = psutil.Process(self._server.pid)
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self._ns.port),
+                                         1).close()
+                return
+            except socket.error:
+                if self._server.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("The web server didn't start")
+                time.sleep(0.2)
+
+    def stopServer(self):
+        if self._server is not None and self._server.poll() is None:
+            self._server.send_signal(signal.SIGINT)
+            self._server.wait()
+        shutil.rmtree(self._workdir, ignore_errors=True)
+
+    @gen.coroutine
+    def startInstances(self):
+        """
+        Create and start the instances, return their _id.
+        """
+        stats = Stats()
+        client = Client(self._url, stats, self._ns.timeout)
+        yield client.connect()
+        ids = []
+        for i in range(self._ns.instances):
+            response = yield client.request({
+                'handlerKey': 'manage',
+                'action': 'save',
+                'data': {
+                    'name': 'bench%d' % i,
+                    'save': 'bench%d' % i,
+                    'port': self._ns.game_port + i
+                }
+            }, 'save')
+            ids.append(response['instances'][0]['_id'])
+            yield client.request({'handlerKey': 'manage', 'action': 'start',
+                                  '_id': ids[-1]}, 'start')
+        client.close()
+        # let the fake servers load their map
+        yield gen.sleep(self._ns.startup_delay + self._ns.warmup)
+        raise gen.Return(ids)
+
+    @gen.coroutine
+    def stopInstances(self, ids):
+        client = Client(self._url, Stats(), self._ns.timeout)
+        yield client.connect()
+        for _id in ids:
+            yield client.request({'handlerKey': 'manage', 'action': 'kill',
+                                  '_id': _id}, 'kill')
+        client.close()
+        yield gen.sleep(2)
+
+    def _lag(self, start, end):
+        lags = []
+        with open(self._lagFile) as f:
+            for line in f:
+                ts, lag = map(float, line.split())
+                if start <= ts <= end:
+                    lags.append(lag)
+        return utils.summarize(lags, 1000)
+
+    @gen.coroutine
+    def runFleet(self, count):
+        """
+        Run `count` clients for `--duration` seconds, return their results.
+        """
+        logging.info("Running %d clients for %ds" % (count,
+                                                     self._ns.duration))
+        stats = Stats()
+        clients = [Client(self._url, stats, self._ns.timeout)
+                   for _ in range(count)]
+        yield [client.connect() for client in clients]
+        yield [client.request({'handlerKey': 'manage', 'action': 'sync',
+                               'version': None}, 'sync')
+               for client in clients]
+        stats.logLatencies = []  # the connection is not part of the measure
+
+        rss = [self._process.memory_info().rss]
+        sampler = PeriodicCallback(
+            lambda: rss.append(self._process.memory_info().rss), 1000)
+        sampler.start()
+        start = time.time()
+        until = start + self._ns.duration
+        yield [client.drive(until, self._ns.interval) for client in clients]
+        end = time.time()
+        sampler.stop()
+        rss.append(self._process.memory_info().rss)
+        for client in clients:
+            client.close()
+
+        yield gen.sleep(1.5)  # last lag samples
+        results = stats.results()
+        results.update({
+            'clients': count,
+            'duration': end - start,
+            'memory': {
+                'start': rss[0],
+                'end': rss[-1],
+                'peak': max(rss),
+                'growth': rss[-1] - rss[0]
+            },
+            'ioloop': self._lag(start, end)
+        })
+        raise gen.Return(results)
+
+    @gen.coroutine
+    def run(self):
+        ids = yield self.startInstances()
+        results = {
+            'options': {
+                'instances': self._ns.instances,
+                'logRate': self._ns.log_rate,
+                'logSize': self._ns.log_size,
+                'interval': self._ns.interval,
+                'duration': self._ns.duration
+            },
+            'fleets': {}
+        }
+        try:
+            for count in self._ns.clients:
+                results['fleets'][str(count)] = yield self.runFleet(count)
+        finally:
+            yield self.stopInstances(ids)
+        raise gen.Return(results)
+
+
+def report(results):
+    row = '%8s %10s %10s %10s %10s %10s %12s %6s'
+    print(row % ('clients', 'log p50', 'log p99', 'rtt p50', 'rtt p99',
+                 'lag p99', 'rss growth', 'errs'))
+    for count, fleet in sorted(results['fleets'].items(),
+                               key=lambda item: int(item[0])):
+
+        def fmt(value):
+            return '-' if value is None else '%.1f' % value
+        print(row % (
+            count, fmt(fleet['log']['p50']), fmt(fleet['log']['p99']),
+            fmt(fleet['allActions']['p50']), fmt(fleet['allActions']['p99']),
+            fmt(fleet['ioloop']['p99']),
+            '%+d' % fleet['memory']['growth'],
+            fleet['timeouts'] + fleet['errors']))
+
+
+def printComparison(old, new):
+    print("Compared to %s (%s):" % (old['commit'], old['date']))
+    for key, a, b, ratio in utils.compare(old, new):
+        if ratio is not None and abs(ratio - 1) >= 0.1:
+            print('  %-50s %12s -> %12s (x%.2f)' % (key, a, b, ratio))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Load test of the manager with fake factorio servers.",
+        prog="benchmarks.loadTest")
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[1, 10, 100],
+                        help="Sizes of the client fleets, run in turn.")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="Run time of each fleet, in seconds.")
+    parser.add_argument('--interval', type=float, default=1,
+                        help="Average time between two requests of a "
+                        "client, in seconds.")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="Request timeout, in seconds.")
+    parser.add_argument('--instances', type=int, default=2)
+    parser.add_argument('--log-rate', type=float, default=20,
+                        help="Log lines per second of each instance.")
+    parser.add_argument('--log-size', type=int, default=120)
+    parser.add_argument('--autosave-period', type=float, default=60,
+                        help="In seconds.")
+    parser.add_argument('--save-size', type=int, default=10 * 1024 ** 2,
+                        help="In bytes.")
+    parser.add_argument('--startup-delay', type=float, default=1)
+    parser.add_argument('--warmup', type=float, default=3,
+                        help="Wait after the start of the instances, in "
+                        "seconds.")
+    parser.add_argument('--port', type=int, default=15100,
+                        help="Port of the web server.")
+    parser.add_argument('--game-port', type=int, default=44197,
+                        help="Port of the first instance.")
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help="Previous results file to compare with.")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    ns = parse_args()
+    test = LoadTest(ns)
+    test.startServer(test.prepare())
+    try:
+        results = IOLoop.current().run_sync(test.run)
+    finally:
+        test.stopServer()
+    report(results)
+    path = utils.saveResults('loadTest', results)
+    print("Results saved to %s" % path)
+    if ns.compare:
+        printComparison(utils.loadResults(ns.compare),
+                        utils.loadResults(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals, print_function
+
+"""
+Micro-benchmarks of the hot paths of the manager: the services, the
+listing of the saves folder, the backups and the formatters used in every
+message.
+Each benchmark is run for `--rounds` rounds of a number of calls calibrated
+so that a round lasts at least `--min-time` seconds. Its results hold the
+time per call of each round, in seconds, and their summary.
+Compared to a baseline (see `--baseline`), a benchmark is reported slower or
+faster when its median changed by more than `--threshold` and Welch's test
+tells the change apart from the noise (see benchmarks.utils.welch).
+
+Run from the root of the repository:
+    python -m benchmarks.micro --save-baseline    # before a change
+    python -m benchmarks.micro                    # after, compared
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import zipfile
+import argparse
+import tempfile
+import timeit
+from collections import OrderedDict
+
+from conf import Conf
+from benchmarks import utils
+
+BASELINE = os.path.join(utils.resultsFolder, 'micro-baseline.json')
+
+# {name: setup(context) returning the function to time}, in run order
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, **params):
+    def register(setup):
+        BENCHMARKS[name] = lambda context: setup(context, **params)
+        return setup
+    return register
+
+
+class Context(object):
+    """
+    Temporary folders of the run. The saves folder is filled on demand.
+    """
+    def __init__(self, ns):
+        super(Context, self).__init__()
+        self.ns = ns
+        self.workdir = tempfile.mkdtemp(prefix='miniboard-micro-')
+        for folder in ('saves', 'config', 'logs'):
+            os.makedirs(os.path.join(self.workdir, folder))
+        self.savesFolder = os.path.join(self.workdir, 'saves')
+
+    def configure(self):
+        """
+        Point Conf to the temporary folders. Must be called before importing
+        the tools modules, some of them read it at import time.
+        """
+        # the factorio folders of Conf are given relative to the current one
+        path = os.path.relpath(self.workdir).replace(os.sep, '/')
+        Conf['factorio']['savesFolder'] = path + '/saves'
+        Conf['factorio']['configFolder'] = path + '/config'
+        Conf['factorio']['logArchive']['folder'] = path + '/logs'
+        Conf['factorio']['storage']['minFreeSpace'] = 0
+
+    def fillSaves(self, count):
+        """
+        Leave `count` empty saves in the saves folder.
+        """
+        wanted = set('save%05d.zip' % i for i in range(count))
+        present = set(os.listdir(self.savesFolder))
+        for filename in present - wanted:
+            os.remove(os.path.join(self.savesFolder, filename))
+        for filename in wanted - present:
+            open(os.path.join(self.savesFolder, filename), 'wb').close()
+
+    def fillAutosaves(self, instance, count):
+        """
+        Leave `count` empty autosaves in the autosaves folder of the instance
+        (see factorio.WRITE_DATA), return their paths.
+        """
+        folder = os.path.join(instance.writeData, 'saves')
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        paths = [os.path.join(folder, '_autosave%d.zip' % (i + 1))
+                 for i in range(count)]
+        for path in paths:
+            open(path, 'wb').close()
+        return paths
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def instanceService(count):
+    from server.services.instanceService import InstanceService
+    service = InstanceService(sqlite3.connect(':memory:'))
+    # the cache is shared by the services of the same table
+    service.invalidate()
+    for i in range(count):
+        service.insert('instance%d' % i, 'save%d' % i, str(34197 + i),
+                       _id='id%d' % i)
+    return service
+
+
+for _count in (10, 100, 1000):
+    @benchmark('service.getAll[%d]' % _count, count=_count)
+    def _getAll(context, count):
+        return instanceService(count).getAll
+
+    @benchmark('service.getAll.uncached[%d]' % _count, count=_count)
+    def _getAllUncached(context, count):
+        service = instanceService(count)
+
+        def run():
+            service.invalidate()
+            service.getAll()
+        return run
+
+    @benchmark('service.getById[%d]' % _count, count=_count)
+    def _getById(context, count):
+        service = instanceService(count)
+        return lambda: service.getById('id%d' % (count // 2))
+
+    @benchmark('service.getById.uncached[%d]' % _count, count=_count)
+    def _getByIdUncached(context, count):
+        service = instanceService(count)
+
+        def run():
+            service.invalidate()
+            service.getById('id%d' % (count // 2))
+        return run
+
+    @benchmark('service.set[%d]' % _count, count=_count)
+    def _set(context, count):
+        service = instanceService(count)
+        return lambda: service.set('id%d' % (count // 2), 'status', 'running')
+
+for _count in (10, 100, 1000, 10000):
+    @benchmark('saves.list[%d]' % _count, count=_count)
+    def _savesList(context, count):
+        from tools import saves
+        context.fillSaves(count)
+
+        def run():
+            saves.list.invalidate()
+            saves.list()
+        return run
+
+    @benchmark('utils.getFolderSize[%d]' % _count, count=_count)
+    def _getFolderSize(context, count):
+        from tools import utils as toolsUtils
+        context.fillSaves(count)
+        return lambda: toolsUtils.getFolderSize(context.savesFolder)
+
+    @benchmark('diskUsage.folderSize.full[%d]' % _count, count=_count)
+    def _folderSizeFull(context, count):
+        from tools import diskUsage
+        context.fillSaves(count)
+        return lambda: diskUsage.folderSize(context.savesFolder, full=True)
+
+    @benchmark('Instance.findMostRecentAutosave[%d]' % _count, count=_count)
+    def _findMostRecentAutosave(context, count):
+        from tools import factorio
+        context.fillSaves(count)
+        instance = factorio.Instance(34197, 'save00000', 'bench')
+        context.fillAutosaves(instance, 3)
+        return instance.findMostRecentAutosave
+
+
+@benchmark('Instance.backupSave')
+def _backupSave(context):
+    from tools import factorio
+    context.fillSaves(10)
+    instance = factorio.Instance(34197, 'save00000', 'bench')
+    # a valid archive, or the autosave isn't promoted
+    autosave, = context.fillAutosaves(instance, 1)
+    with zipfile.ZipFile(autosave, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('level.dat', os.urandom(context.ns.save_size))
+
+    def run():
+        instance.backupSave()
+        for filename in os.listdir(context.savesFolder):
+            if '_back_' in filename:
+                os.remove(os.path.join(context.savesFolder, filename))
+    # two copies per call
+    run.bytes = 2 * os.path.getsize(autosave)
+    return run
+
+
+@benchmark('utils.timeFormat')
+def _timeFormat(context):
+    from tools import utils as toolsUtils
+    durations = [5e-6, 0.02, 3.5, 125, 4000, 90000]
+    return lambda: [toolsUtils.timeFormat(d) for d in durations]
+
+
+@benchmark('utils.sizeFormat')
+def _sizeFormat(context):
+    from tools import utils as toolsUtils
+    sizes = [500, 5 * 10 ** 4, 5 * 10 ** 7, 5 * 10 ** 10]
+    return lambda: [toolsUtils.sizeFormat(s) for s in sizes]
+
+
+@benchmark('utils.dateFormat')
+def _dateFormat(context):
+    from tools import utils as toolsUtils
+    now = time.time()
+    return lambda: toolsUtils.dateFormat(now)
+
+
+def measure(fn, rounds, minTime):
+    """
+    Return the number of calls per round, and the time per call of each
+    round.
+    """
+    number = 1
+    while True:
+        duration = timeit.timeit(fn, number=number)
+        if duration >= minTime:
+            break
+        number *= 2 if duration < minTime / 10 else 1 + int(
+            minTime / max(duration, 1e-9))
+    times = [timeit.timeit(fn, number=number) / number
+             for _ in range(rounds)]
+    return number, times
+
+
+def run(ns):
+    context = Context(ns)
+    context.configure()
+    results = OrderedDict()
+    try:
+        for name, setup in BENCHMARKS.items():
+            if ns.filter and not re.search(ns.filter, name):
+                continue
+            fn = setup(context)
+            number, times = measure(fn, ns.rounds, ns.min_time)
+            results[name] = {
+                'number': number,
+                'times': times,
+                'mean': sum(times) / len(times),
+                'median': utils.percentile(times, 50),
+                'min': min(times),
+                'stdev': utils.stdev(times)
+            }
+            if hasattr(fn, 'bytes'):
+                results[name]['bytesPerSecond'] = \
+                    fn.bytes / results[name]['median']
+            if not ns.json:
+                print('%-45s %12s  +-%5.1f%%' % (
+                    name, formatTime(results[name]['median']),
+                    100 * results[name]['stdev'] / results[name]['mean']))
+    finally:
+        context.cleanup()
+    return results
+
+
+def formatTime(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.2f%s' % (seconds / scale, unit)
+    return '%.0fns' % (seconds * 1e9)
+
+
+def compare(baseline, results, threshold):
+    """
+    Return {benchmark name: comparison} for the benchmarks of both runs. A
+    comparison holds the medians, the relative change, Welch's t and the
+    verdict: 'slower', 'faster' or 'same'.
+    """
+    comparisons = OrderedDict()
+    for name, new in results.items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        change = new['median'] / old['median'] - 1
+        t = utils.welch(old['times'], new['times'])
+        verdict = 'same'
+        if t is not None and abs(t) >= 2 and abs(change) >= threshold:
+            verdict = 'slower' if change > 0 else 'faster'
+        comparisons[name] = {
+            'baseline': old['median'],
+            'median': new['median'],
+            'change': change,
+            't': t,
+            'verdict': verdict
+        }
+    return comparisons
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the hot paths of the manager.",
+        prog="benchmarks.micro")
+    parser.add_argument('--filter', help="Only run the benchmarks whose name "
+                        "matches this regular expression.")
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help="Minimum duration of a round, in seconds.")
+    parser.add_argument('--save-size', type=int, default=8 * 1024 ** 2,
+                        help="Size of the autosave of Instance.backupSave, "
+                        "in bytes.")
+    parser.add_argument('--baseline', default=BASELINE,
+                        help="Results to compare with. Default: %s" % BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Store the results as the new baseline.")
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help="Relative change of the median reported, if "
+                        "significant.")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the results and comparison as JSON.")
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help="Exit with the code 1 if a benchmark is slower.")
+    return parser.parse_args()
+
+
+def main():
+    ns = parse_args()
+    results = run(ns)
+    path = utils.saveResults('micro', results)
+    comparisons = None
+    if os.path.isfile(ns.baseline) and not ns.save_baseline:
+        baseline = utils.loadResults(ns.baseline)
+        comparisons = compare(baseline, results, ns.threshold)
+    if ns.save_baseline:
+        shutil.copyfile(path, ns.baseline)
+
+    if ns.json:
+        print(json.dumps({'results': results, 'comparison': comparisons},
+                         indent=2))
+    else:
+        print("Results saved to %s" % path)
+        if ns.save_baseline:
+            print("Baseline saved to %s" % ns.baseline)
+        if comparisons is not None:
+            print("Compared to %s (%s):" % (baseline['commit'],
+                                            baseline['date']))
+            for name, comparison in comparisons.items():
+                print('%-45s %12s -> %12s %+7.1f%%  %s' % (
+                    name, formatTime(comparison['baseline']),
+                    formatTime(comparison['median']),
+                    100 * comparison['change'], comparison['verdict']))
+    if ns.fail_on_regression and comparisons and any(
+            c['verdict'] == 'slower' for c in comparisons.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
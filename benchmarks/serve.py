@@ -0,0 +1,86 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Run the web server for the load tests (see benchmarks.loadTest):
+* `Conf` is overridden by the given JSON file before the server modules are
+  imported, since some of them read it at import time
+* the IOLoop lag (delay of a callback scheduled every `--lag-interval`
+  seconds) is appended to `--lag-file` as lines '<timestamp> <lag>'
+
+Run from the root of the repository:
+    python -m benchmarks.serve --overrides conf.json --lag-file lag.txt
+"""
+
+import time
+import json
+import argparse
+
+from conf import Conf
+
+
+def merge(conf, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(conf.get(key), dict):
+            merge(conf[key], value)
+        else:
+            conf[key] = value
+
+
+class LagProbe(object):
+    """
+    Measure how late the IOLoop runs a callback scheduled `interval`
+    seconds ahead.
+    """
+    def __init__(self, ioloop, path, interval):
+        super(LagProbe, self).__init__()
+        self._ioloop = ioloop
+        self._file = open(path, 'a')
+        self._interval = interval
+        self._samples = []
+        self._lastFlush = time.time()
+
+    def start(self):
+        self._expected = self._ioloop.time() + self._interval
+        self._ioloop.call_at(self._expected, self._probe)
+
+    def _probe(self):
+        now = time.time()
+        self._samples.append('%.6f %.6f\n' % (
+            now, max(0, self._ioloop.time() - self._expected)))
+        if now - self._lastFlush >= 1:
+            self._file.writelines(self._samples)
+            self._file.flush()
+            self._samples = []
+            self._lastFlush = now
+        self.start()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="benchmarks.serve")
+    parser.add_argument('--overrides', required=True,
+                        help="JSON file of the Conf entries to change.")
+    parser.add_argument('--lag-file', required=True)
+    parser.add_argument('--lag-interval', type=float, default=0.05)
+    parser.add_argument('--verbose', '-v', action="count", default=0)
+    return parser.parse_args()
+
+
+def main():
+    ns = parse_args()
+    with open(ns.overrides) as f:
+        merge(Conf, json.load(f))
+
+    import tornado.ioloop
+    import main as server
+
+    LagProbe(tornado.ioloop.IOLoop.instance(), ns.lag_file,
+             ns.lag_interval).start()
+    server.Server(argparse.Namespace(
+        verbose=ns.verbose, quiet=not ns.verbose, adapter=0,
+        profile_startup=False)).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Helpers shared by the benchmarks: statistics, and the JSON results saved in
+`benchmarks/results/`, named after the benchmark, the date and the commit,
+so that the runs can be compared across commits.
+"""
+
+import os
+import json
+import math
+import time
+import platform
+import subprocess
+
+resultsFolder = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile (0 to 100) of the values, None if empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * p / 100.
+    low = int(index)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def summarize(values, scale=1):
+    """
+    Return the count, mean, p50, p99 and max of the values, multiplied by
+    `scale` (eg: 1000 for seconds to milliseconds).
+    """
+    if not values:
+        return {'count': 0, 'mean': None, 'p50': None, 'p99': None,
+                'max': None}
+    return {
+        'count': len(values),
+        'mean': scale * sum(values) / len(values),
+        'p50': scale * percentile(values, 50),
+        'p99': scale * percentile(values, 99),
+        'max': scale * max(values)
+    }
+
+
+def stdev(values):
+    """
+    Return the sample standard deviation of the values, 0 if less than two.
+    """
+    if len(values) < 2:
+        return 0.
+    mean = float(sum(values)) / len(values)
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+
+def welch(a, b):
+    """
+    Return the t statistic of Welch's test between the two samples: above 2
+    in absolute value, the means differ with about 95% confidence. None if
+    a sample has less than two values.
+    """
+    if len(a) < 2 or len(b) < 2:
+        return None
+    meanA, meanB = float(sum(a)) / len(a), float(sum(b)) / len(b)
+    error = math.sqrt(stdev(a) ** 2 / len(a) + stdev(b) ** 2 / len(b))
+    if error == 0:
+        return 0. if meanA == meanB else float('inf') * (meanB - meanA)
+    return (meanB - meanA) / error
+
+
+def gitCommit():
+    """
+    Return the hash of the current commit, with a '+' if the tree has
+    uncommitted changes. None outside of a git repository.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode('utf8').strip()
+        dirty = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty.strip() else '')
+
+
+def saveResults(name, results):
+    """
+    Write the results with the details of the run, return the path of the
+    file.
+    """
+    commit = gitCommit()
+    data = {
+        'benchmark': name,
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'machine': platform.machine()
+        },
+        'results': results
+    }
+    if not os.path.isdir(resultsFolder):
+        os.makedirs(resultsFolder)
+    path = os.path.join(resultsFolder, '%s-%s-%s.json' % (
+        name, time.strftime('%Y%m%d-%H%M%S'), commit or 'nogit'))
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    return path
+
+
+def loadResults(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def flatten(results, prefix=''):
+    """
+    Return the numeric values of the nested results as {dotted key: value}.
+    """
+    values = {}
+    if isinstance(results, dict):
+        items = results.items()
+    elif isinstance(results, list):
+        items = enumerate(results)
+    else:
+        items = []
+    for key, value in items:
+        path = '%s%s' % (prefix, key)
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, long, float)):
+            values[path] = value
+        else:
+            values.update(flatten(value, path + '.'))
+    return values
+
+
+def compare(old, new):
+    """
+    Return the values of both results as a sorted list of (key, old value,
+    new value, ratio new / old), None for the missing or zero values.
+    """
+    old, new = flatten(old['results']), flatten(new['results'])
+    rows = []
+    for key in sorted(set(old) | set(new)):
+        a, b = old.get(key), new.get(key)
+        ratio = float(b) / a if a and b is not None else None
+        rows.append((key, a, b, ratio))
+    return rows
@@ -50,21 +50,122 @@ def getIp(adapteridx):
 Conf = {
     'state': 'DEBUG',
     'log': {
-        'fileLevel': logging.WARNING
+        'fileLevel': logging.WARNING,
+        # rotate log files above this size, keeping this many gzipped segments
+        'maxBytes': 10000000,
+        'backupCount': 10,
+        # records are written by a background thread. Above `shedThreshold`
+        # (ratio of `queueSize`) pending records, DEBUG records are dropped.
+        'queueSize': 10000,
+        'shedThreshold': 0.5,
+        'flushInterval': 1.0  # in seconds
     },
     'database': {
         'name': 'db/miniboard-factorio.db'
     },
+    # options of the caches of `server.memory` (ttl in seconds)
+    'cache': {
+        'saves': {'ttl': 5},
+        'services': {'maxSize': 1024},
+        'verify': {'maxSize': 4096}
+    },
+    # see server.scheduler
+    'scheduler': {
+        'workers': 4,  # threads running the jobs
+        'processes': None,  # processes running the jobs, default: cpu count
+        'logPumpInterval': 1,  # in seconds
+        'logRotation': '0 4 * * *'  # cron spec
+    },
+    # system metrics sampled by the scheduler, see server.metrics
+    'metrics': {
+        'interval': 1,  # in seconds
+        'historySize': 3600  # number of samples kept
+    },
+    # cpu placement of the processes, see tools.placement
+    'placement': {
+        'enabled': True,
+        'cores': 1,  # physical cores per factorio server
+        'reservedCores': 1,  # physical cores kept for the web server
+        'nice': -5  # nice value of the factorio servers
+    },
+    # page cache pre-warming of the files read by factorio, see tools.prewarm
+    'prewarm': {
+        'enabled': True,
+        'dataFolder': None,  # factorio's data folder, pre-warmed if set
+        # cron specs, the stopped instances are pre-warmed before play times
+        'schedule': []
+    },
+    'manage': {
+        # bulk start/kill/restart, see server.bulk
+        'bulk': {
+            'parallelism': 2,  # operations in progress at the same time
+            'stagger': 5,  # in seconds, between two operations
+            'timeout': 300  # in seconds, for each operation
+        },
+        # versioned instance state sync, see ManageHandler.execSync
+        'sync': {
+            'deletions': 1000  # deleted instances remembered
+        }
+    },
+    'diskUsage': {
+        'workers': 4  # number of directories listed in parallel
+    },
     'server': {
         'port': 15000,
-        'ip': '',
+        'ip': '',  # resolved after the start, from the adapter below
+        'adapter': 0,
+        # web worker processes, see server.workers. 0: the main process
+        # serves the requests itself.
+        'workers': 0,
+        # channel between the workers and the main process, see server.rpc
+        'rpcSocket': 'db/rpc.sock',
         'assets': {
             'minifiedCleanups': [
                 'http/assets/custom/css/',
                 'http/assets/custom/js/'
             ],
-            'minifyOnDebug': False
+            'minifyOnDebug': False,
+            # client templates compiled into custom/js/templates.js, see
+            # tools.clientTemplates
+            'templates': 'http/assets/custom/templates'
+        },
+        # rendered pages and the snapshot they embed, see TemplatesHandler
+        'templates': {
+            'ttl': 30,  # in seconds, age of the embedded metrics
+            'cacheSize': 64  # rendered pages kept
         },
+        # encodings of the websocket messages, see server.codec
+        'websocket': {
+            'msgpack': True  # offered if the msgpack package is installed
+        },
+        # read-only JSON API, see ApiHandler
+        'api': {
+            'maxAge': 2,  # in seconds, Cache-Control of the answers
+            'defaultLimit': 100,  # items per page
+            'maxLimit': 1000,
+            'cacheSize': 256  # answers kept
+        },
+        # save files transfers, see SavesHandler
+        'saves': {
+            'chunkSize': 64 * 1024,
+            'maxUploadSize': 4 * 1024 ** 3,
+            # if set, downloads are delegated to the front proxy using the
+            # `X-Accel-Redirect` header, eg: '/protected-saves/'
+            'accelRedirect': None
+        }
+    },
+    # multi-host mode, see server.cluster. Each agent is started on its host
+    # with `main.py --agent <port>`.
+    'cluster': {
+        # {'name': ..., 'address': ..., 'port': ...} of each agent
+        'agents': [],
+        'token': '',  # shared secret, checked by the agents
+        'local': True,  # run instances on this host as well
+        'heartbeat': 2,  # in seconds, status sent by the agents
+        'timeout': 60,  # in seconds, for the requests to the agents
+        'reconnectDelay': 2,  # in seconds
+        # output chunks kept per instance by an agent without manager
+        'logBuffer': 1000
     },
     'factorio': {
         'allowedPorts': sorted(
@@ -74,6 +175,49 @@ Conf = {
         'binary': '/Applications/factorio.app',
         'configFolder': (
             '/Users/romain/Library/Application Support/factorio/config'),
-        'autosaveInterval': 15  # in minutes
+        'autosaveInterval': 15,  # in minutes
+        # quotas of the saves folder (see tools.storage), sizes in bytes
+        'storage': {
+            'quota': 20 * 1024 ** 3,
+            'familyQuota': 5 * 1024 ** 3,
+            'minFreeSpace': 2 * 1024 ** 3,
+            'keepBackups': 3,  # most recent backups never evicted
+            'interval': 60  # in seconds
+        },
+        # packing of the old backups with a stronger codec, see
+        # tools.recompress
+        'recompress': {
+            'olderThan': 7 * 24 * 3600,  # in seconds
+            'bytesPerSecond': 8 * 1024 ** 2,  # read throughput limit
+            'interval': 3600  # in seconds
+        },
+        # automatic restart of the crashed instances, see server.supervisor
+        'supervisor': {
+            'backoff': 1,  # in seconds, delay before the first restart
+            'maxBackoff': 60,  # in seconds
+            'maxRestarts': 5,  # within the crash window
+            'crashWindow': 600  # in seconds
+        },
+        # stop the instances without players, see server.hibernation
+        'hibernation': {
+            'enabled': True,
+            'idleTimeout': 30 * 60,  # in seconds
+            'checkInterval': 30  # in seconds
+        },
+        # relay of the public ports of the local instances, so that they can
+        # be restarted without closing their port, see server.forwarder
+        'forwarder': {
+            'enabled': False,
+            # ports factorio listens on, at most two per running instance
+            'internalPorts': range(35190, 35200),
+            'sessionTimeout': 60,  # in seconds, idle players forgotten
+            'maxSessions': 256,  # players relayed per port
+            'bootTimeout': 600  # in seconds, for a replacement instance
+        },
+        'logArchive': {
+            'folder': 'db/logs',
+            'bucket': 3600,  # in seconds, time span of each archive segment
+            'flushInterval': 5  # in seconds
+        }
     }
 }
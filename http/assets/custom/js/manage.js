@@ -1,47 +1,3 @@
-template = '\
-<tr>\
-    <td>{{name}}</td>\
-    <td><b>{{saveObj.name}}</b> ({{saveObj.date}}, {{saveObj.size}})</td>\
-    <td>{{ip}}:{{port}}</td>\
-    <td class="status">\
-        {{#if isRunning}}\
-            <div class="uk-badge uk-badge-success">{{status}}</div></td>\
-        {{else}}\
-            <div class="uk-badge uk-badge-danger">{{status}}</div></td>\
-        {{/if}}\
-    <td id="controls">\
-        {{#if isRunning}}\
-            <button class="uk-button uk-button-danger" id="kill">Kill</button>\
-        {{else}}\
-            {{# if startAvailable }}\
-                <button class="uk-button uk-button-success" id="start">Start</button>\
-            {{/if}}\
-            <button class="uk-button uk-button-primary" id="edit">Edit</button>\
-            <button class="uk-button uk-button-danger" id="delete">Delete</button>\
-        {{/if}}\
-    </td>\
-</tr>\
-'
-editorTemplate = '\
-<tr>\
-    <td><input type="text" id="name" value="{{name}}"></td>\
-    <td><select id="saves">\
-        {{#each saves}}\
-            <option value="{{this.name}}">{{this.name}} ({{this.date}}, {{this.size}})</option>\
-        {{/each}}\
-    <select></td>\
-    <td>{{ip}}: <select id="ports">\
-        {{#each ports}}\
-            <option value="{{this}}">{{this}}</option>\
-        {{/each}}\
-    </td>\
-    <td><div class="uk-badge uk-badge-warning uk-badge-notification">?</div></td>\
-    <td>\
-        <button class="uk-button uk-button-primary" id="submit">Submit</button>\
-    </td>\
-</tr>\
-'
-errorTemplate = '<tr><td colspan="5">Error</td></tr>'
 
 function InstanceLogs($container) {
     var self = this;
@@ -57,6 +13,14 @@ function InstanceLogs($container) {
             message = '<span class="error">' + message + '</span>'
         self.$container.append(message + '<br>');
     }
+
+    self.showSearchResults = function (lines) {
+        self.clear();
+        if (lines.length == 0)
+            return self.log('[No matching archived output]');
+        for (var i = 0; i < lines.length; i++)
+            self.log('[' + lines[i].date + '] ' + $('<div>').text(lines[i].line).html());
+    }
 }
 
 // auto-renders when created unless `options.$el` is specified
@@ -71,12 +35,19 @@ function Instance(data, $container, onDelete, onEdit, onStart, onKill, options)
             ip: initData.ip,
             port: data.port,
             status: data.status,
-            isRunning: data.status == 'running',
+            disk: data.disk,
+            // actual placement when running, configured one otherwise
+            cores: data.placement || data.cores || 'auto',
+            host: data.host || 'auto',
+            // a crashed instance waiting for its automatic restart, or an
+            // idle one waiting for a player, can be killed
+            isRunning: data.status == 'running' || data.status == 'restarting' ||
+                data.status == 'hibernating',
             startAvailable: data.startAvailable
         };
     }
 
-    self.template = Handlebars.compile(template)
+    self.template = Templates.instance
     self.options = options || {}
     // either save the $el in which it should render, or render it automatically
     // to create the $el if not provided.
@@ -86,6 +57,7 @@ function Instance(data, $container, onDelete, onEdit, onStart, onKill, options)
     self.onDelete = onDelete
     self.onEdit = onEdit
     self.onStart = onStart
+    self.onPrewarm = self.options.onPrewarm
     self.onKill = onKill
     self.editor = false;
 
@@ -102,6 +74,13 @@ function Instance(data, $container, onDelete, onEdit, onStart, onKill, options)
         self.$el.find('#kill').click(function () {
             self.onKill(self.data._id);
         });
+        // pre-warm the save as soon as the operator points at the instance
+        self.$el.find('#start').mouseenter(function () {
+            if (self.onPrewarm && (!self.prewarmedAt || Date.now() - self.prewarmedAt > 300000)) {
+                self.prewarmedAt = Date.now();
+                self.onPrewarm(self.data._id);
+            }
+        });
     }
     self.events();
 
@@ -121,7 +100,8 @@ function Instance(data, $container, onDelete, onEdit, onStart, onKill, options)
     }
 
     self.isRunning = function () {
-        return self.data.status == 'running';
+        return self.data.status == 'running' || self.data.status == 'restarting' ||
+            self.data.status == 'hibernating';
     }
 
     self.setStartAvailable = function () {
@@ -150,8 +130,8 @@ function InstanceEditor($container, saves, onSubmit, options) {
     self.options = options || {};
 
     self.$el = self.options.$el || null;
-    self.template = Handlebars.compile(editorTemplate);
-    self.errorTemplate = Handlebars.compile(errorTemplate);
+    self.template = Templates.editor;
+    self.errorTemplate = Templates.error;
 
     self.editedId = null;
     self.editor = true;
@@ -173,6 +153,8 @@ function InstanceEditor($container, saves, onSubmit, options) {
         data = data || {}
         return {
             name: data.name || '',
+            cores: data.cores || '',
+            host: data.host || '',
             saves: self.saves,
             ip: initData.ip,
             ports: filteredPorts(removePorts)
@@ -230,6 +212,8 @@ function InstanceEditor($container, saves, onSubmit, options) {
             name: self.$el.find('#name').val(),
             port: self.$el.find('#ports').val(),
             save: self.$el.find('#saves').val(),
+            cores: self.$el.find('#cores').val().trim(),
+            host: self.$el.find('#host').val().trim(),
         };
         if (self.editedId)
             data._id = self.editedId;
@@ -255,12 +239,62 @@ function Manage () {
 
     self.instances = {}
     self.creator = null;
+    // last version of the instance store received, null before the first sync
+    self.version = null;
 
     self.savesList = [];
     self.savesIndex = {}
 
     self.logger = new InstanceLogs($('#logs'));
 
+    $('#log-search-submit').click(function () {
+        if (!$('#log-instance').val())
+            return;
+        self.send({
+            'action': 'searchlogs',
+            '_id': $('#log-instance').val(),
+            'query': $('#log-query').val().trim()
+        });
+    });
+
+    $('#start-all').click(function () {
+        self.send({'action': 'startmany', '_ids': '*'});
+    });
+    $('#kill-all').click(function () {
+        self.send({'action': 'killmany', '_ids': '*'});
+    });
+    $('#restart-all').click(function () {
+        self.send({'action': 'restartall'});
+    });
+
+    self.onBulkProgress = function (message) {
+        var instance = self.instances[message._id];
+        var name = instance && instance.data ? instance.data.name : message._id;
+        if (message.step != 'done') {
+            if (instance && !instance.editor)
+                instance.loading();
+            return self.logger.log('[Bulk] ' + name + ': ' + message.step + '...');
+        }
+        var line = '[Bulk] ' + name + ': ' + message.result +
+            ' (' + message.done + '/' + message.total + ')';
+        if (message.error)
+            line = '[ERROR] ' + line + ' ' + $('<div>').text(message.error).html();
+        self.logger.log(line);
+    }
+
+    self.renderLogInstances = function () {
+        var $select = $('#log-instance');
+        var selected = $select.val();
+        $select.html('');
+        for (var _id in self.instances) {
+            if (self.instances[_id].data)
+                $('<option>').val(_id).text(self.instances[_id].data.name)
+                    .appendTo($select);
+        }
+        if (selected)
+            $select.val(selected);
+    }
+
     self.countRunningInstances = function () {
         var count = 0
         for (var inst in self.instances) {
@@ -276,6 +310,10 @@ function Manage () {
             var data = message.instances[i];
             data.saveObj = self.savesIndex[data.save];
             data.startAvailable = count == 0
+            if (self.instances[data._id] && self.instances[data._id].data) {
+                data.disk = self.instances[data._id].data.disk;
+                data.placement = self.instances[data._id].data.placement;
+            }
             if (self.instances[data._id]) {
                 if (!self.instances[data._id].editor)
                     self.instances[data._id].render(data);
@@ -286,7 +324,8 @@ function Manage () {
                 self.instances[data._id] = new Instance(
                     data, self.$container,
                     self.onDeleteInstance, self.onEditInstance,
-                    self.onStartInstance, self.onKillInstance);
+                    self.onStartInstance, self.onKillInstance,
+                    {onPrewarm: self.onPrewarmInstance});
         }
         var count = self.countRunningInstances()
         for (var inst in self.instances) {
@@ -297,6 +336,7 @@ function Manage () {
                     self.instances[inst].setStartAvailable()
             }
         }
+        self.renderLogInstances();
     }
 
     self.getUsedPorts = function () {
@@ -330,6 +370,8 @@ function Manage () {
                         self.$container,
                         message.saves,
                         self.onSaveInstance);
+                else
+                    self.creator.saves = message.saves;
                 self.fetchList();  // need the saves to fetch the list of instances
                 break;
             case 'save':
@@ -338,25 +380,129 @@ function Manage () {
                     self.creator.render(null, self.getUsedPorts());
                 break;
             case 'delete':
-                self.instances[message._id].delete();
-                if (self.creator)
-                    self.creator.render(null, self.getUsedPorts());
-                delete self.instances[message._id];
+                self.removeInstances([message._id]);
+                break;
+            case 'sync':
+                self.onSync(message);
                 break;
             case 'start':
             case 'kill':
+            case 'bulk':
                 self.onLoad(message, true);
                 break;
+            case 'bulkprogress':
+                self.onBulkProgress(message);
+                break;
             case 'log':
                 self.logger.log(message.message);
                 break;
+            case 'searchlogs':
+                self.logger.showSearchResults(message.lines);
+                break;
+            case 'diskusage':
+                self.onDiskUsage(message.usage);
+                break;
+            case 'placement':
+                self.onPlacement(message.instances);
+                break;
+            case 'prewarm':
+                if (message.stats.ratio !== null)
+                    console.log('Pre-warmed ' + message.stats.files + ' files of ' +
+                        message._id + ', ' + Math.round(100 * message.stats.ratio) +
+                        '% were already cached');
+                break;
+        }
+    }
+
+    self.removeInstances = function (ids) {
+        for (var i = 0; i < ids.length; i++) {
+            if (!self.instances[ids[i]])
+                continue;
+            self.instances[ids[i]].delete();
+            delete self.instances[ids[i]];
         }
+        if (self.creator)
+            self.creator.render(null, self.getUsedPorts());
+        self.renderLogInstances();
+    }
+
+    // show the snapshot embedded in the page until the websocket is open,
+    // which then only brings the changes made since
+    self.onSnapshot = function (snapshot) {
+        self.savesList = snapshot.saves;
+        self.savesIndex = self.indexSaves(self.savesList);
+        self.creator = new InstanceEditor(
+            self.$container,
+            snapshot.saves,
+            self.onSaveInstance);
+        self.onSync({
+            'version': snapshot.version,
+            'snapshot': true,
+            'instances': snapshot.instances,
+            'deleted': []
+        });
+    }
+
+    self.onSync = function (message) {
+        var deleted = message.deleted;
+        if (message.snapshot) {
+            var kept = {};
+            for (var i = 0; i < message.instances.length; i++)
+                kept[message.instances[i]._id] = true;
+            deleted = [];
+            for (var _id in self.instances)
+                if (!kept[_id])
+                    deleted.push(_id);
+        }
+        self.removeInstances(deleted);
+        self.onLoad(message, true);
+        self.version = message.version;
     }
 
     self.onReady = function () {
-        self.$container.html('');
-        self.instances = {};
+        // after a reconnection, only the changes since self.version are sent
+        if (self.version === null) {
+            self.$container.html('');
+            self.instances = {};
+        }
         self.fetchSaves();
+        if (self.diskUsageTimeout)
+            clearTimeout(self.diskUsageTimeout);
+        self.fetchDiskUsage();
+    }
+
+    self.diskUsageTimeout = null;
+    self.onDiskUsage = function (usage) {
+        for (var _id in usage) {
+            var instance = self.instances[_id];
+            if (instance && !instance.editor && instance.data) {
+                instance.data.disk = usage[_id].total;
+                instance.render();
+            }
+        }
+        self.diskUsageTimeout = setTimeout(self.fetchDiskUsage, 30000);
+    }
+
+    self.fetchDiskUsage = function () {
+        self.send({
+            'action': 'diskusage'
+        });
+        self.send({
+            'action': 'placement'
+        });
+    }
+
+    self.onPlacement = function (placements) {
+        for (var _id in self.instances) {
+            var instance = self.instances[_id];
+            if (instance.editor || !instance.data)
+                continue;
+            var placement = placements[_id];
+            instance.data.placement = placement ?
+                (placement.current && placement.current.cores) || placement.cores :
+                null;
+            instance.render();
+        }
     }
 
     self.onEditInstance = function (_id) {
@@ -371,7 +517,8 @@ function Manage () {
                 self.instances[_id] = new Instance(
                     data, self.$container, self.onDeleteInstance,
                     self.onEditInstance,
-                    self.onStartInstance, self.onKillInstance, {$el: $el});
+                    self.onStartInstance, self.onKillInstance,
+                    {$el: $el, onPrewarm: self.onPrewarmInstance});
                 self.onSaveInstance(data);
             }, {$el: $el});
         self.instances[_id].render(data, self.getUsedPorts());
@@ -386,6 +533,13 @@ function Manage () {
         self.logger.clear();
     }
 
+    self.onPrewarmInstance = function (_id) {
+        self.send({
+            'action': 'prewarm',
+            '_id': _id
+        })
+    }
+
     self.onKillInstance = function (_id) {
         self.instances[_id].loading()
         self.send({
@@ -421,8 +575,8 @@ function Manage () {
 
     self.fetchList = function () {
         self.send({
-            'action': 'load',
-            '_id': '*'
+            'action': 'sync',
+            'version': self.version
         });
     }
 
@@ -433,6 +587,8 @@ function Manage () {
         });
     }
 
+    if (initData.snapshot)
+        self.onSnapshot(initData.snapshot);
 }
 
 $(function () {
@@ -0,0 +1,137 @@
+// MessagePack decoder of the binary websocket messages (see server.codec).
+// The arrays of doubles packed by the server (extension type 1) are decoded
+// as plain arrays, so the messages are the same as with the json encoding.
+var MsgPack = (function () {
+    var PACKED_DOUBLES = 1;
+
+    function decodeUtf8(bytes) {
+        var out = '';
+        for (var i = 0; i < bytes.length;) {
+            var c = bytes[i++];
+            if (c >= 0xf0) {
+                c = ((c & 0x07) << 18) | ((bytes[i++] & 0x3f) << 12) |
+                    ((bytes[i++] & 0x3f) << 6) | (bytes[i++] & 0x3f);
+                c -= 0x10000;
+                out += String.fromCharCode(0xd800 + (c >> 10),
+                                           0xdc00 + (c & 0x3ff));
+                continue;
+            }
+            if (c >= 0xe0)
+                c = ((c & 0x0f) << 12) | ((bytes[i++] & 0x3f) << 6) |
+                    (bytes[i++] & 0x3f);
+            else if (c >= 0xc0)
+                c = ((c & 0x1f) << 6) | (bytes[i++] & 0x3f);
+            out += String.fromCharCode(c);
+        }
+        return out;
+    }
+
+    function Decoder(buffer) {
+        var self = this;
+        var view = new DataView(buffer);
+        var bytes = new Uint8Array(buffer);
+        var offset = 0;
+
+        function take(size) {
+            offset += size;
+            return offset - size;
+        }
+        function str(size) {
+            var start = take(size);
+            return decodeUtf8(bytes.subarray(start, start + size));
+        }
+        function bin(size) {
+            var start = take(size);
+            return bytes.slice(start, start + size);
+        }
+        function array(size) {
+            var out = new Array(size);
+            for (var i = 0; i < size; i++)
+                out[i] = self.value();
+            return out;
+        }
+        function map(size) {
+            var out = {};
+            for (var i = 0; i < size; i++) {
+                var key = self.value();
+                out[key] = self.value();
+            }
+            return out;
+        }
+        function ext(size) {
+            var type = view.getInt8(take(1));
+            var start = take(size);
+            if (type !== PACKED_DOUBLES)
+                return bytes.slice(start, start + size);  // unknown, as bin
+            var out = new Array(size / 8);
+            for (var i = 0; i < out.length; i++)
+                out[i] = view.getFloat64(start + 8 * i, true);
+            return out;
+        }
+        function uint64() {
+            var start = take(8);
+            return view.getUint32(start) * 4294967296 +
+                view.getUint32(start + 4);
+        }
+        function int64() {
+            var start = take(8);
+            return view.getInt32(start) * 4294967296 +
+                view.getUint32(start + 4);
+        }
+
+        self.value = function () {
+            var type = bytes[take(1)];
+            if (type < 0x80)
+                return type;
+            if (type < 0x90)
+                return map(type & 0x0f);
+            if (type < 0xa0)
+                return array(type & 0x0f);
+            if (type < 0xc0)
+                return str(type & 0x1f);
+            if (type >= 0xe0)
+                return type - 0x100;
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(view.getUint8(take(1)));
+                case 0xc5: return bin(view.getUint16(take(2)));
+                case 0xc6: return bin(view.getUint32(take(4)));
+                case 0xc7: return ext(view.getUint8(take(1)));
+                case 0xc8: return ext(view.getUint16(take(2)));
+                case 0xc9: return ext(view.getUint32(take(4)));
+                case 0xca: return view.getFloat32(take(4));
+                case 0xcb: return view.getFloat64(take(8));
+                case 0xcc: return view.getUint8(take(1));
+                case 0xcd: return view.getUint16(take(2));
+                case 0xce: return view.getUint32(take(4));
+                case 0xcf: return uint64();
+                case 0xd0: return view.getInt8(take(1));
+                case 0xd1: return view.getInt16(take(2));
+                case 0xd2: return view.getInt32(take(4));
+                case 0xd3: return int64();
+                case 0xd4: return ext(1);
+                case 0xd5: return ext(2);
+                case 0xd6: return ext(4);
+                case 0xd7: return ext(8);
+                case 0xd8: return ext(16);
+                case 0xd9: return str(view.getUint8(take(1)));
+                case 0xda: return str(view.getUint16(take(2)));
+                case 0xdb: return str(view.getUint32(take(4)));
+                case 0xdc: return array(view.getUint16(take(2)));
+                case 0xdd: return array(view.getUint32(take(4)));
+                case 0xde: return map(view.getUint16(take(2)));
+                case 0xdf: return map(view.getUint32(take(4)));
+            }
+            throw new Error('Invalid MessagePack type 0x' + type.toString(16));
+        };
+    }
+
+    return {
+        // decode the ArrayBuffer of a binary websocket message
+        decode: function (buffer) {
+            return new Decoder(buffer).value();
+        }
+    };
+})();
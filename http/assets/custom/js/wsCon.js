@@ -4,7 +4,11 @@ function WSCon() {
     self.handlers = {};
     self.socket = null;
     self.connect = function () {
-        self.socket = new WebSocket('ws://' + location.hostname + ':' + initData.port + '/websocket')
+        // the server answers in MessagePack if it supports it, see
+        // server.codec
+        self.socket = new WebSocket('ws://' + location.hostname + ':' + initData.port + '/websocket',
+                                    ['msgpack', 'json'])
+        self.socket.binaryType = 'arraybuffer';
 
         self.socket.onopen = function() {
             console.log("Connection opened, notifying handlers.")
@@ -13,7 +17,10 @@ function WSCon() {
             }
         };
         self.socket.onmessage = function (evt) {
-            message = JSON.parse(evt.data);
+            if (typeof evt.data === 'string')
+                message = JSON.parse(evt.data);
+            else
+                message = MsgPack.decode(evt.data);
             self.handlers[message.handlerKey].onMessage(message);
         };
         self.socket.onclose = function (evt) {
@@ -3,15 +3,19 @@
 from __future__ import unicode_literals
 
 ### Initialize the logging system
+import atexit
+import copy
+import gzip
 import logging
 import os
-
+import shutil
+import time
 from logging.handlers import RotatingFileHandler
-import logging
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
 
 from conf import Conf
 from config import termColors
-from threading import Lock
 
 
 class ColorFormatter(logging.Formatter):
@@ -31,7 +35,10 @@ class ColorFormatter(logging.Formatter):
     def format(self, record):
         color = self.COLORS[record.levelno] if record.levelno in self.COLORS \
             else self.DEFAULT_COLOR
-        record.msg = color + record.msg + termColors.Color_Off
+        # work on a copy: the same record goes through the file handlers,
+        # which must not receive the color codes.
+        record = copy.copy(record)
+        record.msg = color + '%s' % record.msg + termColors.Color_Off
         message = logging.Formatter.format(self, record)
         return message\
             .replace(
@@ -44,69 +51,309 @@ class ColorFormatter(logging.Formatter):
                 % (termColors.Cyan, record.filename, termColors.Color_Off))
 
 
-class LockedRotatingFileHandler(RotatingFileHandler):
-    def __init__(self, *args, **kwargs):
-        super(LockedRotatingFileHandler, self).__init__(*args, **kwargs)
-        self._lock = Lock()
+class BatchFlushMixin(object):
+    """
+    Make a stream based handler leave its stream unflushed after each record.
+    The `AsyncHandler` writer thread calls `forceFlush` once per batch or
+    once per flush interval instead.
+    """
+    def flush(self):
+        pass
+
+    def forceFlush(self):
+        super(BatchFlushMixin, self).flush()
+
+
+class BatchStreamHandler(BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class CompressedRotatingFileHandler(BatchFlushMixin, RotatingFileHandler):
+    """
+    Rotating file handler that gzips the rotated segments
+    (`file.log.1.gz` ... `file.log.N.gz`).
+    Rotation only ever happens on the `AsyncHandler` writer thread, which is
+    the only thread writing to the file, so the file is never in use by
+    another writer when it is renamed.
+    """
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.backupCount > 0:
+            for i in range(self.backupCount - 1, 0, -1):
+                sfn = "%s.%d.gz" % (self.baseFilename, i)
+                dfn = "%s.%d.gz" % (self.baseFilename, i + 1)
+                if os.path.exists(sfn):
+                    if os.path.exists(dfn):
+                        os.remove(dfn)
+                    os.rename(sfn, dfn)
+            dfn = self.baseFilename + ".1.gz"
+            if os.path.exists(dfn):
+                os.remove(dfn)
+            if os.path.exists(self.baseFilename):
+                with open(self.baseFilename, 'rb') as fr, \
+                        gzip.open(dfn, 'wb') as fw:
+                    shutil.copyfileobj(fr, fw)
+                os.remove(self.baseFilename)
+        # the file was either compressed or is to be discarded: always start
+        # from an empty file.
+        self.mode = 'w'
+        self.stream = self._open()
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Handler that only enqueues the records. Formatting and writing is done
+    by the given `handlers` on a background thread, by batches, and the
+    streams are flushed every `flushInterval` seconds (or right away for
+    records of level ERROR and above).
+    When the queue fills above `shedThreshold` (ratio of `queueSize`), DEBUG
+    records are dropped. When it is full, anything below WARNING is dropped
+    and other records wait at most one second for room in the queue.
+    """
+    ROTATE = object()  # queue marker requesting a rollover of the files
+
+    def __init__(self, handlers, queueSize=10000, flushInterval=1.0,
+                 batchSize=500, shedThreshold=0.5):
+        logging.Handler.__init__(self)
+        self._handlers = handlers
+        self._queue = Queue(queueSize)
+        self._shedSize = int(queueSize * shedThreshold)
+        self._flushInterval = flushInterval
+        self._batchSize = batchSize
+        self._shed = 0
+        self._shedLock = Lock()
+        self._stopped = False
+        self._thread = Thread(target=self._run, name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        """
+        Merge args into the message and render the traceback now: the objects
+        they refer to may have changed by the time the writer thread gets to
+        the record.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _drop(self):
+        with self._shedLock:
+            self._shed += 1
+
+    def emit(self, record):
+        if self._stopped:
+            return
+        if record.levelno <= logging.DEBUG and \
+                self._queue.qsize() >= self._shedSize:
+            return self._drop()
+        try:
+            record = self.prepare(record)
+            try:
+                self._queue.put_nowait(record)
+            except Full:
+                if record.levelno < logging.WARNING:
+                    return self._drop()
+                self._queue.put(record, timeout=1)
+        except Full:
+            self._drop()
+        except Exception:
+            self.handleError(record)
+
+    def _shedRecord(self):
+        """
+        Return a record reporting the number of records dropped since last
+        call, None if nothing was dropped.
+        """
+        with self._shedLock:
+            shed, self._shed = self._shed, 0
+        if not shed:
+            return None
+        return logging.makeLogRecord({
+            'name': 'log', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+            'pathname': __file__, 'filename': 'log.py', 'funcName': '_run',
+            'lineno': 0, 'msg': "Logging backpressure: dropped %d records"
+            % shed})
+
+    def _write(self, batch):
+        for handler in self._handlers:
+            for record in batch:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
 
-    def doRollOver(self):
-        # doesn't work - file is still in use by the user process, even if locked
-        with self._lock:
-            super(LockedRotatingFileHandler, self).doRollOver()
+    def _flush(self):
+        for handler in self._handlers:
+            handler.acquire()
+            try:
+                handler.forceFlush()
+            finally:
+                handler.release()
 
+    def _run(self):
+        lastFlush = time.time()
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self._flushInterval))
+                while len(batch) < self._batchSize:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            stop = None in batch
+            rotate = any(r is self.ROTATE for r in batch)
+            batch = [record for record in batch
+                     if record is not None and record is not self.ROTATE]
+            shedRecord = self._shedRecord()
+            if shedRecord is not None:
+                batch.append(shedRecord)
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception:
+                    pass  # the handlers report their own errors
+            now = time.time()
+            if stop or now - lastFlush >= self._flushInterval or \
+                    any(r.levelno >= logging.ERROR for r in batch):
+                self._flush()
+                lastFlush = now
+            if rotate:
+                self._rollover()
+            if stop:
+                return
 
-def init(verbose=0, quiet=False, filename='activity.log', colored=True):
+    def _rollover(self):
+        for handler in self._handlers:
+            if isinstance(handler, RotatingFileHandler):
+                handler.acquire()
+                try:
+                    handler.doRollover()
+                except Exception:
+                    pass  # keep writing to the current file
+                finally:
+                    handler.release()
+
+    def rotate(self):
+        """
+        Request a rollover of the log files, done by the writer thread.
+        """
+        if not self._stopped:
+            self._queue.put(self.ROTATE)
+
+    def close(self):
+        """
+        Write all the pending records and close the underlying handlers.
+        """
+        if not self._stopped:
+            self._stopped = True
+            self._queue.put(None)
+            self._thread.join()
+            for handler in self._handlers:
+                handler.close()
+        logging.Handler.close(self)
+
+
+_asyncHandler = None
+
+
+def rotate():
+    """
+    Rotate the log files now, whatever their size. Scheduled by the server.
+    """
+    if _asyncHandler is not None:
+        _asyncHandler.rotate()
+
+
+def stop():
+    """
+    Write out all the pending records. Called at exit.
+    """
+    global _asyncHandler
+    if _asyncHandler is not None:
+        logging.getLogger().removeHandler(_asyncHandler)
+        _asyncHandler.close()
+        _asyncHandler = None
+
+
+def init(verbose=0, quiet=False, filename='activity.log', colored=True,
+         errorsFilename='errors.log'):
     """
     Initialize the logger
     * verbose (int) specify the verbosity level of the standart output
       0 (default) ~ ERROR, 1 ~ WARN & WARNING, 2 ~ INFO, 3 ~ DEBUG
     * quiet (boolean) allow to remove all message whatever is the verbosity lvl
+    * filename, errorsFilename: files of the log folder receiving all the
+      records and the errors only. Each process needs its own files, they
+      are emptied on each start.
+    The root logger only gets a single `AsyncHandler` that forwards the
+    records to the file and console handlers on a background thread.
     """
+    global _asyncHandler
+
     if not os.path.exists('log'):
         os.mkdir('log')
 
-    with open("log/" + filename, 'w'):
-        pass
-    with open("log/errors.log", 'w'):
-        pass
+    stop()
+
+    # RotatingFileHandler always appends when it has a maxBytes
+    for name in (filename, errorsFilename):
+        with open("log/" + name, 'w'):
+            pass
 
     logger = logging.getLogger()
     logger.propagate = False
+    if verbose is 0:
+        streamLevel = logging.ERROR
+    elif verbose is 1:
+        streamLevel = logging.WARNING
+    elif verbose is 2:
+        streamLevel = logging.INFO
+    else:
+        streamLevel = logging.DEBUG
     logger.setLevel(min([Conf['log']['fileLevel'],
-                         verbose]))
+                         logging.CRITICAL if quiet else streamLevel]))
 
+    handlers = []
     formatter = logging.Formatter(
         '%(asctime)s :: %(levelname)s :: ' +
         '%(filename)s:%(funcName)s[%(lineno)d] :: %(message)s')
-    file_handler = LockedRotatingFileHandler("log/" + filename, 'w', 10000000, 10)
+    file_handler = CompressedRotatingFileHandler(
+        "log/" + filename, 'w', Conf['log']['maxBytes'],
+        Conf['log']['backupCount'])
     file_handler.setLevel(Conf['log']['fileLevel'])
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    handlers.append(file_handler)
 
-    formatter = logging.Formatter(
-        '%(asctime)s :: %(levelname)s :: ' +
-        '%(filename)s:%(funcName)s[%(lineno)d] :: %(message)s')
-    file_handler = LockedRotatingFileHandler("log/errors.log", 'w', 10000000, 10)
+    file_handler = CompressedRotatingFileHandler(
+        "log/" + errorsFilename, 'w', Conf['log']['maxBytes'],
+        Conf['log']['backupCount'])
     file_handler.setLevel(logging.ERROR)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    handlers.append(file_handler)
 
     if not quiet:
         Formatter = ColorFormatter if colored else logging.Formatter
         formatter = Formatter(
             '%(levelname)s :: %(filename)s :: %(message)s')
-        stream_handler = logging.StreamHandler()
-        if verbose is 0:
-            stream_handler.setLevel(logging.ERROR)
-        elif verbose is 1:
-            stream_handler.setLevel(logging.WARNING)
-        elif verbose is 2:
-            stream_handler.setLevel(logging.INFO)
-        else:
-            stream_handler.setLevel(logging.DEBUG)
+        stream_handler = BatchStreamHandler()
+        stream_handler.setLevel(streamLevel)
         stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
+        handlers.append(stream_handler)
+
+    _asyncHandler = AsyncHandler(
+        handlers, queueSize=Conf['log']['queueSize'],
+        flushInterval=Conf['log']['flushInterval'],
+        shedThreshold=Conf['log']['shedThreshold'])
+    logger.addHandler(_asyncHandler)
 
     logging.info("=" * 80)
     logging.info('Logging system started: verbose=%d, quiet=%s' %
                  (verbose, str(quiet)))
+
+atexit.register(stop)
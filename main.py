@@ -3,20 +3,27 @@
 
 from __future__ import unicode_literals
 
+import time
+# beginning of the imports, see StartupProfile
+IMPORTS_START = time.time()
+
+import os
+import sys
 import argparse
 import logging
 from threading import Thread
+from contextlib import contextmanager
 
-import tornado
-from tornado.web import Application
+import psutil
+import tornado.ioloop
 
 from conf import Conf, getIp
 import log
-from server.model import Model
-from server.requestHandlers.templatesHandler import TemplatesHandler
-from server.requestHandlers.defaultHandler import DefaultHandler
-from server.requestHandlers.assetsHandler import AssetsHandler
-from server.requestHandlers.wsHandler import WSHandler
+from server import scheduler, metrics
+from tools import storage, placement
+# the modules of a single mode are imported by the functions which run it:
+# the agent doesn't load the web server, the single process mode doesn't
+# load the agent nor the workers
 
 
 def parse_args():
@@ -32,9 +39,96 @@ messages and -vvv enable DEBUG messages. Ignored if started using daemon.",
                         help="Remove ALL logging messages from the console.")
     parser.add_argument('-a', '--adapter', action="store",
                         help="Adapter's ip to show.", type=int, default=0)
+    parser.add_argument('--profile-startup', action="store_true",
+                        help="Print the time spent in each phase of the \
+startup once it is over.")
+    parser.add_argument('--agent', type=int, metavar='PORT',
+                        help="Run the agent of the multi-host mode on this \
+port, see server.agent.")
+    # index of the web worker, see server.workers
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
     return parser.parse_args()
 
 
+def makeApplication():
+    from tornado.web import Application
+    from server.requestHandlers.templatesHandler import TemplatesHandler
+    from server.requestHandlers.defaultHandler import DefaultHandler
+    from server.requestHandlers.assetsHandler import AssetsHandler
+    from server.requestHandlers.savesHandler import SavesHandler
+    from server.requestHandlers.apiHandler import ApiHandler
+    from server.requestHandlers.wsHandler import WSHandler
+    # define server settings and server routes
+    server_settings = {
+        "cookie_secret": "101010",  # todo: generate a more secure token
+        "template_path": "http/templates/",
+        # allow to recompile templates on each request, enable autoreload
+        # and some other useful features on debug. See:
+        # http://www.tornadoweb.org/en/stable/guide/running.html#debug-mode
+        "debug": Conf['state'] == 'DEBUG'
+    }
+    # /assets/... will send the corresponding static asset
+    # /savefiles/[save].zip will download or upload a save file
+    # /api/[resource] will send the corresponding JSON data
+    # /[whatever] will display the corresponding template
+    # other routes will display 404
+    server_routes = [
+        (r"/websocket", WSHandler),
+        (r"/assets/([a-zA-Z0-9_\/\.-]+)/?", AssetsHandler),
+        (r"/savefiles/([^/]+)", SavesHandler),
+        (r"/api/([a-z]+)/?", ApiHandler),
+        (r"/([a-zA-Z0-9_/\.=-]*)/?", TemplatesHandler),
+        (r"/(.+)/?", DefaultHandler)
+    ]
+    return Application(server_routes, **server_settings)
+
+
+class StartupProfile(object):
+    """
+    Durations of the phases of the startup. The phases run after the server
+    started listening are marked as deferred.
+    """
+    def __init__(self):
+        super(StartupProfile, self).__init__()
+        try:
+            processStart = psutil.Process(os.getpid()).create_time()
+        except psutil.Error:
+            processStart = IMPORTS_START
+        self._start = min(processStart, IMPORTS_START)
+        self._phases = [('interpreter', self._start, IMPORTS_START, False),
+                        ('imports', IMPORTS_START, time.time(), False)]
+        self.ready = None
+
+    @contextmanager
+    def phase(self, name, deferred=False):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self._phases.append((name, t0, time.time(), deferred))
+
+    def markReady(self):
+        """
+        The IOLoop is running: the first request can be answered.
+        """
+        self.ready = time.time()
+
+    def report(self):
+        lines = ["Startup profile (ms since the process start):"]
+        for deferred in (False, True):
+            if deferred:
+                lines.append("  ready for the first request at %8.1f"
+                             % (1000 * (self.ready - self._start)))
+                lines.append("  deferred:")
+            for name, start, end, isDeferred in self._phases:
+                if isDeferred == deferred:
+                    lines.append("    %-20s %8.1f  (at %.1f)" % (
+                        name, 1000 * (end - start),
+                        1000 * (start - self._start)))
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+
 class Server(Thread):
     """
     Create the server.
@@ -48,7 +142,10 @@ class Server(Thread):
         """
         super(Server, self).__init__()
         self._ns = ns
-        Conf['server']['ip'] = getIp(ns.adapter)
+        self._profile = StartupProfile()
+        self._workers = None  # see `serveWorkers`
+        # resolved after the start, see `deferredInit`
+        Conf['server']['adapter'] = ns.adapter
 
     def stop(self):
         ioloop = tornado.ioloop.IOLoop.instance()
@@ -61,53 +158,242 @@ class Server(Thread):
     started as a daemon.
     """
     def run(self):
+        profile = self._profile
+        with profile.phase('web imports'):
+            from server import supervisor, hibernation, bulk, rpc
+            from server.model import Model
+            from server.requestHandlers.websocketHandlers import \
+                manageHandler
+            from tools import logArchive
         # initialize log
-        log.init(
-            self._ns.verbose, self._ns.quiet,
-            filename="server.log", colored=False)
+        with profile.phase('log'):
+            log.init(
+                self._ns.verbose, self._ns.quiet,
+                filename="server.log", colored=False)
 
         # create model, that hold services for database collection
         # and memory, a wrapper object over the manipulation of the shared
         # persistent memory between queries
-        model = Model()
-
-        # define server settings and server routes
-        server_settings = {
-            "cookie_secret": "101010",  # todo: generate a more secure token
-            "template_path": "http/templates/",
-            # allow to recompile templates on each request, enable autoreload
-            # and some other useful features on debug. See:
-            # http://www.tornadoweb.org/en/stable/guide/running.html#debug-mode
-            "debug": Conf['state'] == 'DEBUG'
-        }
-        # /assets/... will send the corresponding static asset
-        # /[whatever] will display the corresponding template
-        # other routes will display 404
-        server_routes = [
-            (r"/websocket", WSHandler),
-            (r"/assets/([a-zA-Z0-9_\/\.-]+)/?", AssetsHandler),
-            (r"/([a-zA-Z0-9_/\.=-]*)/?", TemplatesHandler),
-            (r"/(.+)/?", DefaultHandler)
-        ]
+        with profile.phase('model'):
+            model = Model()
+        ioloop = tornado.ioloop.IOLoop.instance()
 
+        with profile.phase('listeners'):
+            # push the changes of the instances to the manage clients
+            model.getService('instance').onChange(manageHandler.scheduleSync)
+
+            # report the crashes and automatic restarts of the instances
+            supervisor.addListener(manageHandler.onInstanceEvent)
+            # stop the idle instances until a player shows up
+            supervisor.addListener(hibernation.onInstanceEvent)
+            # follow the bulk operations
+            supervisor.addListener(bulk.onInstanceEvent)
+
+        with profile.phase('listen'):
+            count = Conf['server']['workers']
+            if count and not rpc.available():
+                logging.error("The web workers need Unix sockets and "
+                              "SO_REUSEPORT, serving from a single process.")
+                count = 0
+            if count:
+                self.serveWorkers(count)
+            else:
+                self.listen()
+        # anything else waits until the server is able to answer
+        ioloop.add_callback(profile.markReady)
+        ioloop.add_callback(self.deferredInit, model)
+
+        # start listening
+        try:
+            ioloop.start()
+        except KeyboardInterrupt:
+            logging.info("Stopping server...")
+
+        if self._workers is not None:
+            self._workers.stop()
+        scheduler.getInstance().stop()
+        logArchive.closeAll()
+        model.disconnect()
+
+    def listen(self):
         # start the server.
-        logging.info("Server Starts - %s state - %s:%s"
-                     % (Conf['state'], Conf['server']['ip'],
-                        Conf['server']['port']))
+        logging.info("Server Starts - %s state - port %s"
+                     % (Conf['state'], Conf['server']['port']))
         logging.debug("Debugging message enabled.")
-        application = Application(server_routes, **server_settings)
-        application.listen(Conf['server']['port'])
+        makeApplication().listen(Conf['server']['port'])
         logging.info(
             "Connected to database: %s"
             % Conf['database']['name'])
 
-        # start listening
+    def serveWorkers(self, count):
+        """
+        Multi-worker mode: the requests are served by `count` worker
+        processes, this one keeps the instances, the database and the
+        websocket sessions (see server.rpc and server.workers).
+        """
+        from server import rpc, workers, snapshot
+        from server.requestHandlers.wsHandler import Session
+        logging.info("Server Starts - %s state - port %s - %d workers"
+                     % (Conf['state'], Conf['server']['port'], count))
+        rpc.serve(Conf['server']['rpcSocket'], Session, snapshot.get)
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--adapter', str(self._ns.adapter)]
+        command += ['-v'] * self._ns.verbose
+        if self._ns.quiet:
+            command.append('--quiet')
+        self._workers = workers.WorkerPool(command, count)
+        self._workers.start()
+
+    def deferredInit(self, model):
+        """
+        Initialization that isn't needed to answer the first requests, run
+        on the IOLoop once the server listens. The slowest parts run on a
+        worker thread (see `warmUp`).
+        """
+        from server import supervisor, hibernation, cluster
+        profile = self._profile
+        # keep the web server and its jobs off the cores of the game servers
+        with profile.phase('placement', deferred=True):
+            if Conf['placement']['enabled']:
+                placement.apply(os.getpid(), placement.reserved())
+
+        with profile.phase('hibernation', deferred=True):
+            if Conf['factorio']['hibernation']['enabled']:
+                hibernation.resume()
+                scheduler.add(
+                    'hibernation', hibernation.check, executor='ioloop',
+                    interval=Conf['factorio']['hibernation']['checkInterval'])
+
+        with profile.phase('jobs', deferred=True):
+            self.addJobs(model)
+
+        # instances of the other hosts, see server.cluster
+        with profile.phase('cluster', deferred=True):
+            cluster.start(supervisor.adopt)
+        scheduler.add('warm-up', self.warmUp, delay=0)
+
+    def warmUp(self):
+        """
+        Resolve the ip shown to the players, and minify the assets ahead of
+        their first request. Run on a worker thread.
+        """
+        from server.requestHandlers.assetsHandler import warmUp
+        profile = self._profile
+        with profile.phase('ip', deferred=True):
+            ip = getIp(self._ns.adapter)
+            Conf['server']['ip'] = ip
+        logging.info("Server ip: %s" % ip)
+        with profile.phase('assets', deferred=True):
+            warmUp()
+        if self._ns.profile_startup:
+            tornado.ioloop.IOLoop.instance().add_callback(profile.report)
+
+    def addJobs(self, model):
+        from server.requestHandlers.websocketHandlers import manageHandler
+        from tools import logArchive, recompress
+        from tools.factorio import SAVE_INTERVAL
+        ioloop = tornado.ioloop.IOLoop.instance()
+        # periodic work of the server, see server.scheduler
+        scheduler.add('instance-logs', manageHandler.pumpInstanceLogs,
+                      interval=Conf['scheduler']['logPumpInterval'],
+                      executor='ioloop')
+        scheduler.add('backup', manageHandler.backupInstance,
+                      interval=SAVE_INTERVAL * 60, jitter=30)
+        scheduler.add('metrics', metrics.sample,
+                      interval=Conf['metrics']['interval'], misfireGrace=1)
+        scheduler.add('log-rotation', log.rotate,
+                      cron=Conf['scheduler']['logRotation'])
+        scheduler.add('log-archive', logArchive.flushAll,
+                      interval=Conf['factorio']['logArchive']['flushInterval'])
+        # read the saves ahead of the expected play times
+        for i, spec in enumerate(Conf['prewarm']['schedule']):
+            scheduler.add('prewarm-%d' % i, manageHandler.prewarmInstances,
+                          cron=spec, executor='ioloop')
+        # keep the saves folder within its quotas
+        scheduler.add('storage', storage.enforce,
+                      interval=Conf['factorio']['storage']['interval'])
+        # pack the old backups. The results are recorded from the IOLoop
+        # thread, which owns the database connection.
+        scheduler.add('recompress', recompress.recompressOld,
+                      interval=Conf['factorio']['recompress']['interval'],
+                      jitter=60, kwargs={
+                          'onPacked': lambda res: ioloop.add_callback(
+                              lambda: model.getService('compression').insert(
+                                  **res))})
+
+
+class WorkerServer(object):
+    """
+    Web worker of the multi-worker mode, see server.workers.
+    """
+    def __init__(self, ns):
+        super(WorkerServer, self).__init__()
+        self._ns = ns
+        Conf['server']['adapter'] = ns.adapter
+
+    def run(self):
+        from tornado.httpserver import HTTPServer
+        from server import rpc, workers
+        index = self._ns.worker
+        log.init(self._ns.verbose, self._ns.quiet,
+                 filename="worker.%d.log" % index, colored=False,
+                 errorsFilename="errors.worker.%d.log" % index)
+        # off the cores of the game servers, like the main process
+        if Conf['placement']['enabled']:
+            placement.apply(os.getpid(), placement.reserved())
+        rpc.connect(Conf['server']['rpcSocket'])
+        server = HTTPServer(makeApplication())
+        server.add_sockets(workers.bindSockets(Conf['server']['port']))
+        logging.info("Web worker %d started." % index)
         try:
             tornado.ioloop.IOLoop.instance().start()
         except KeyboardInterrupt:
-            logging.info("Stopping server...")
+            logging.info("Stopping web worker %d..." % index)
+
+
+class AgentServer(object):
+    """
+    Agent of the multi-host mode, see server.agent.
+    """
+    def __init__(self, ns):
+        super(AgentServer, self).__init__()
+        self._ns = ns
+
+    def run(self):
+        from server import agent
+        log.init(self._ns.verbose, self._ns.quiet, filename="agent.log",
+                 colored=False, errorsFilename="errors.agent.log")
+        if not Conf['cluster']['token']:
+            logging.warning("No token set in Conf['cluster']['token'], any "
+                            "host can control this agent.")
+        # keep the agent and its jobs off the cores of the game servers
+        if Conf['placement']['enabled']:
+            placement.apply(os.getpid(), placement.reserved())
+        agent.serve(self._ns.agent)
+        scheduler.add('metrics', metrics.sample,
+                      interval=Conf['metrics']['interval'], misfireGrace=1)
+        scheduler.add('agent-logs', agent.pumpLogs,
+                      interval=Conf['scheduler']['logPumpInterval'],
+                      executor='ioloop')
+        scheduler.add('agent-status', agent.sendStatus,
+                      interval=Conf['cluster']['heartbeat'],
+                      executor='ioloop')
+        scheduler.add('log-rotation', log.rotate,
+                      cron=Conf['scheduler']['logRotation'])
+        scheduler.add('storage', storage.enforce,
+                      interval=Conf['factorio']['storage']['interval'])
+        try:
+            tornado.ioloop.IOLoop.instance().start()
+        except KeyboardInterrupt:
+            logging.info("Stopping the agent...")
+        scheduler.getInstance().stop()
 
-        model.disconnect()
 
 if __name__ == '__main__':
-    Server(parse_args()).run()
+    ns = parse_args()
+    if ns.worker is not None:
+        WorkerServer(ns).run()
+    elif ns.agent is not None:
+        AgentServer(ns).run()
+    else:
+        Server(ns).run()
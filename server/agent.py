@@ -0,0 +1,305 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Agent of the multi-host mode (see server.cluster), started on each host with
+`main.py --agent <port>`. It runs the factorio instances the manager asks
+for, streams their output, reports their exits and sends the metrics of the
+host every `Conf['cluster']['heartbeat']` seconds. The policy (automatic
+restarts, hibernation, backups schedule) stays in the manager.
+A single manager is served at a time. It must first send the 'hello'
+request with the token of `Conf['cluster']['token']`; a new manager
+replaces the previous one.
+The instances keep running while no manager is connected: their output is
+buffered (`Conf['cluster']['logBuffer']` chunks per instance) and their
+exits are reported on the next 'hello'.
+
+Requests (see `Agent._actions`), with their arguments:
+* hello(token): returns the status of the host (see `status`) and the
+  exits not reported yet, {instance _id: exit code}, as 'exited'
+* start(_id, port, save, cores): returns the cpus chosen as 'cores'
+* stop(_id): returns False if the instance wasn't running
+* place(_id, cores): pin the instance again, returns the cpus as 'cores'
+* backup(_id): see factorio.Instance.backupSave
+* restore(save): see factorio.restoreSave, returns the restored backup
+* saves(): see tools.saves.list
+* metrics(since): see server.metrics.history
+"""
+
+import os
+import hmac
+import json
+import logging
+from threading import Thread, Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+from tornado.ioloop import IOLoop
+from tornado.tcpserver import TCPServer
+from tornado.netutil import bind_sockets
+from tornado.concurrent import is_future
+
+from conf import Conf
+from server import metrics
+from server.rpc import Channel
+from tools import factorio, placement, saves
+
+
+class AgentException(Exception):
+    pass
+
+
+class Agent(TCPServer):
+    def __init__(self):
+        super(Agent, self).__init__()
+        self._listening = []  # sockets
+        self._connections = {}  # {Channel: socket}
+        self._manager = None  # Channel of the manager, once authenticated
+        self._instances = {}  # {instance _id: factorio.Instance}
+        self._output = {}  # {instance _id: deque of chunks not sent yet}
+        self._exited = {}  # {instance _id: exit code not reported yet}
+        self._executor = ThreadPoolExecutor(2)
+        self._ioloop = IOLoop.instance()
+        self._actions = {
+            'hello': self.hello,
+            'start': self.startInstance,
+            'stop': self.stopInstance,
+            'place': self.place,
+            'backup': self.backup,
+            'restore': self.restore,
+            'saves': self.listSaves,
+            'metrics': self.history
+        }
+
+    def serve(self, port):
+        self._listening = bind_sockets(port)
+        self.add_sockets(self._listening)
+
+    def handle_stream(self, stream, address):
+        logging.info("Connection from %s:%s" % address[:2])
+        stream.set_nodelay(True)
+        channel = Channel(stream, self._onFrame, self._onClose)
+        self._connections[channel] = stream.socket
+        channel.start()
+
+    def _onClose(self, channel):
+        self._connections.pop(channel, None)
+        if channel is self._manager:
+            logging.warning("Lost the connection to the manager.")
+            self._manager = None
+
+    def _onFrame(self, channel, header, payload):
+        if header['type'] != 'request':
+            return
+        requestId, action = header['id'], header['action']
+        try:
+            if channel is not self._manager and action != 'hello':
+                raise AgentException("Send the 'hello' request first")
+            if action not in self._actions:
+                raise AgentException("Unknown action %s" % action)
+            result = self._actions[action](channel, **json.loads(payload))
+        except Exception as e:
+            if not isinstance(e, AgentException):
+                logging.exception(e)
+            self._reply(channel, requestId, error=str(e))
+            if channel is not self._manager:
+                channel.close()
+            return
+        if not is_future(result):
+            return self._reply(channel, requestId, result)
+
+        def done(future):
+            try:
+                self._reply(channel, requestId, future.result())
+            except Exception as e:
+                logging.exception(e)
+                self._reply(channel, requestId, error=str(e))
+        self._ioloop.add_future(result, done)
+
+    def _reply(self, channel, requestId, result=None, error=None):
+        channel.send({'type': 'response', 'id': requestId, 'error': error},
+                     json.dumps(result))
+
+    def status(self):
+        """
+        Return the status of the host: number of cpus, latest metrics (see
+        server.metrics) and running instances.
+        """
+        return {
+            'cpus': psutil.cpu_count(),
+            'metrics': metrics.latest(),
+            'instances': [{
+                '_id': process._id,
+                'port': process.port,
+                'pid': process.subpid.value,
+                'cores': placement.formatCores(process.cores)
+            } for process in self._instances.itervalues()]
+        }
+
+    def sendStatus(self):
+        """
+        Scheduled on the IOLoop every `Conf['cluster']['heartbeat']` seconds.
+        """
+        if self._manager is not None:
+            self._manager.send({'type': 'status'}, json.dumps(self.status()))
+
+    def pumpLogs(self):
+        """
+        Send the output of the instances, one frame per instance. Scheduled
+        on the IOLoop every `Conf['scheduler']['logPumpInterval']` seconds.
+        """
+        for process in self._instances.values():
+            self._collect(process)
+        self._flush()
+
+    def _collect(self, process):
+        chunks = []
+        while True:
+            data = process.read()
+            if data is None:
+                break
+            chunks.append(data)
+        if chunks:
+            self._output.setdefault(process._id, deque(
+                maxlen=Conf['cluster']['logBuffer'])).append('\n'.join(chunks))
+
+    def _flush(self):
+        if self._manager is None:
+            return
+        output, self._output = self._output, {}
+        for instanceId, chunks in output.iteritems():
+            for data in chunks:
+                self._manager.send({'type': 'log', 'instance': instanceId},
+                                   data)
+
+    def hello(self, channel, token):
+        if not hmac.compare_digest(token or '',
+                                   Conf['cluster']['token'] or ''):
+            logging.error("Refused a manager with an invalid token.")
+            raise AgentException("Invalid token")
+        previous, self._manager = self._manager, channel
+        if previous is not None and previous is not channel:
+            logging.warning("Replaced by a new manager connection.")
+            previous.close()
+        logging.info("Manager connected.")
+        # the output of the exited instances is sent before their exit
+        self._flush()
+        status = self.status()
+        status['exited'], self._exited = self._exited, {}
+        return status
+
+    def _plan(self, cores, others):
+        if not Conf['placement']['enabled']:
+            return None
+        try:
+            manual = placement.parseCores(cores)
+        except placement.PlacementException as e:
+            logging.warning("Ignoring the given cores: %s" % str(e))
+            manual = None
+        return placement.plan(manual, [p.cores for p in others],
+                              metrics.latest().get('CPUs'))
+
+    def startInstance(self, channel, _id, port, save, cores=None):
+        if _id in self._instances:
+            raise AgentException("The instance %s is already running" % _id)
+        for process in self._instances.itervalues():
+            if process.port == str(port):
+                raise AgentException("An instance is already running on "
+                                     "port %s" % port)
+        process = factorio.Instance(port, save, _id)
+        # so that a new agent can listen on the port, and the manager notices
+        # the end of the connection, if this one dies while the instance runs
+        process.inherited = self._listening + self._connections.values()
+        process.cores = self._plan(cores, self._instances.values())
+        process.start()
+        self._instances[_id] = process
+        watcher = Thread(target=self._watch, args=(process, ),
+                         name='watch-%s' % _id)
+        watcher.daemon = True
+        watcher.start()
+        logging.info("Started instance %s on port %s." % (_id, port))
+        return {'cores': placement.formatCores(process.cores)}
+
+    def _watch(self, process):
+        process.join()
+        self._ioloop.add_callback(self._onExit, process)
+
+    def _onExit(self, process):
+        if self._instances.get(process._id) is process:
+            del self._instances[process._id]
+        logging.info("Instance %s exited (exit code: %d)."
+                     % (process._id, process.exitCode.value))
+        self._collect(process)
+        if self._manager is None:
+            self._exited[process._id] = process.exitCode.value
+            return
+        self._flush()
+        self._manager.send({'type': 'exited', 'instance': process._id,
+                            'exitCode': process.exitCode.value})
+
+    def _get(self, _id):
+        process = self._instances.get(_id)
+        if process is None:
+            raise AgentException("The instance %s isn't running" % _id)
+        return process
+
+    def stopInstance(self, channel, _id):
+        process = self._instances.get(_id)
+        if process is None:
+            return False
+        process.kill()
+        return True
+
+    def place(self, channel, _id, cores=None):
+        process = self._get(_id)
+        process.cores = self._plan(cores, [
+            p for p in self._instances.itervalues() if p is not process])
+        if process.subpid.value:
+            placement.apply(process.subpid.value, process.cores, 'game')
+        return {'cores': placement.formatCores(process.cores)}
+
+    def backup(self, channel, _id):
+        return self._executor.submit(self._get(_id).backupSave)
+
+    def restore(self, channel, save):
+        return self._executor.submit(factorio.restoreSave, os.path.join(
+            factorio.savesFolder, '%s.zip' % save))
+
+    def listSaves(self, channel):
+        return saves.list()
+
+    def history(self, channel, since=None):
+        return metrics.history(since)
+
+
+# this module is a singleton
+_instance = None
+_lock = Lock()
+
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = Agent()
+    return _instance
+
+
+def serve(port):
+    getInstance().serve(port)
+    logging.info("Agent listening on port %d" % port)
+
+
+def sendStatus():
+    return getInstance().sendStatus()
+
+
+def pumpLogs():
+    return getInstance().pumpLogs()
@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Lifecycle operations on many instances at once (start, kill, restart).
+At most `Conf['manage']['bulk']['parallelism']` operations are in progress
+at the same time, and two operations never begin less than `stagger`
+seconds apart, so that the servers don't all load their save together.
+An operation is over when its outcome is known from the supervisor events:
+* start: the server is ready to accept players, or it stopped
+* kill: the process exited
+* restart: kill, then start, or replace when possible (see
+  server.supervisor.replace): the new process took over, or it failed
+or after `timeout` seconds without outcome.
+
+Everything here runs on the IOLoop thread.
+"""
+
+import time
+import logging
+import itertools
+from collections import deque
+
+from tornado.ioloop import IOLoop
+
+from conf import Conf
+from server import supervisor, hibernation, forwarder
+from tools import factorio
+
+
+# operations in progress
+_operations = set()
+_ids = itertools.count(1)
+
+
+class BulkOperation(object):
+    """
+    Run `action` ('start', 'kill' or 'restart') on each of the instances.
+    * onProgress(instanceId, step, result=None, error=None): called when
+      an instance changes step ('stopping', 'starting', 'replacing', or
+      'done' with its result: 'ok', 'skipped', 'failed' or 'timeout')
+    * onDone(results): called once all are done, with {instance _id:
+      result}
+    """
+    def __init__(self, action, instanceIds, onProgress, onDone):
+        super(BulkOperation, self).__init__()
+        self._id = next(_ids)
+        self.action = action
+        self.total = len(instanceIds)
+        self.results = {}
+        self._pending = deque(instanceIds)
+        self._steps = {}  # {instance _id: (step, timeout handle)}
+        self._lastBegin = 0
+        self._done = False
+        self._onProgress = onProgress
+        self._onDone = onDone
+        self._ioloop = IOLoop.current()
+
+    def start(self):
+        _operations.add(self)
+        self._next()
+        return self._id
+
+    def _next(self):
+        options = Conf['manage']['bulk']
+        while self._pending and len(self._steps) < options['parallelism']:
+            wait = self._lastBegin + options['stagger'] - time.time()
+            if wait > 0:
+                return self._ioloop.call_later(wait, self._next)
+            self._lastBegin = time.time()
+            self._begin(self._pending.popleft())
+        if not self._pending and not self._steps and not self._done:
+            self._done = True
+            _operations.discard(self)
+            self._onDone(self.results)
+
+    def _begin(self, instanceId):
+        try:
+            stopped = hibernation.cancel(instanceId)
+            if self.action == 'start':
+                return self._start(instanceId)
+            process = supervisor.get(instanceId)
+            if self.action == 'restart' and process is not None and \
+                    process.host == factorio.LOCAL and forwarder.enabled():
+                supervisor.replace(instanceId)
+                return self._step(instanceId, 'replacing')
+            if process is not None:
+                supervisor.stop(instanceId)
+                return self._step(instanceId, 'stopping')
+            if self.action == 'restart':
+                return self._start(instanceId)
+            # stopping a hibernating instance is immediate
+            self._finish(instanceId, 'ok' if stopped else 'skipped')
+        except Exception as e:
+            logging.exception(e)
+            self._finish(instanceId, 'failed', str(e))
+
+    def _start(self, instanceId):
+        if supervisor.get(instanceId) is not None:
+            return self._finish(instanceId, 'skipped')
+        try:
+            supervisor.start(instanceId)
+        except Exception as e:
+            logging.exception(e)
+            return self._finish(instanceId, 'failed', str(e))
+        self._step(instanceId, 'starting')
+
+    def _step(self, instanceId, step):
+        if instanceId in self._steps:
+            self._ioloop.remove_timeout(self._steps[instanceId][1])
+        timeout = self._ioloop.call_later(
+            Conf['manage']['bulk']['timeout'], self._finish, instanceId,
+            'timeout')
+        self._steps[instanceId] = (step, timeout)
+        self._onProgress(instanceId, step)
+
+    def _finish(self, instanceId, result, error=None):
+        if instanceId in self._steps:
+            self._ioloop.remove_timeout(self._steps.pop(instanceId)[1])
+        self.results[instanceId] = result
+        self._onProgress(instanceId, 'done', result, error)
+        self._next()
+
+    def onInstanceEvent(self, event, instanceId, **info):
+        if instanceId not in self._steps:
+            return
+        step = self._steps[instanceId][0]
+        if step == 'stopping' and event in ('stopped', 'crashed'):
+            if self.action == 'restart':
+                self._start(instanceId)
+            else:
+                self._finish(instanceId, 'ok')
+        elif step == 'replacing' and event == 'replaced':
+            if info['error'] is None:
+                self._finish(instanceId, 'ok')
+            else:
+                self._finish(instanceId, 'failed', info['error'])
+        elif step == 'starting' and event == 'ready':
+            self._finish(instanceId, 'ok')
+        elif step == 'starting' and event == 'crashed':
+            self._finish(instanceId, 'failed', "The instance crashed (exit "
+                         "code: %d)" % info['exitCode'])
+
+
+def onInstanceEvent(event, instanceId, **info):
+    """
+    Listener of the supervisor events, see server.supervisor.
+    """
+    for operation in list(_operations):
+        operation.onInstanceEvent(event, instanceId, **info)
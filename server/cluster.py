@@ -0,0 +1,468 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Multi-host mode: the factorio instances may run on other hosts, each one
+running an agent (see server.agent, started with `main.py --agent <port>`)
+this process connects to. The agents are listed in
+`Conf['cluster']['agents']`.
+All the instances are kept in the database of this process, with the host
+they run on (`host` field): 'local' for this one (see
+`Conf['cluster']['local']`), the name of an agent otherwise. An instance
+without host is placed on the least loaded host when it is first started
+(see `pickHost`), and stays there since its saves are in the saves folder of
+that host.
+The supervisor (see server.supervisor) handles the remote instances like the
+local ones, through `RemoteInstance`: the crash detection, automatic
+restarts and backups schedule stay in this process.
+
+The connection to an agent is a framed TCP stream (see server.rpc.Channel).
+Frames sent to the agent: {'type': 'request', 'id': id, 'action': name},
+with the JSON arguments as payload. Frames sent by the agent:
+* {'type': 'response', 'id': id, 'error': message or None}, with the JSON
+  result as payload
+* {'type': 'status'}: metrics and running instances of the host, every
+  `Conf['cluster']['heartbeat']` seconds
+* {'type': 'log', 'instance': id}: output of an instance, as is
+* {'type': 'exited', 'instance': id, 'exitCode': code}
+"""
+
+import json
+import logging
+import itertools
+from threading import Event, Lock
+from collections import deque
+from concurrent.futures import Future as ThreadFuture
+
+import psutil
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future, chain_future
+from tornado.tcpclient import TCPClient
+
+from conf import Conf
+from server import metrics
+from server.rpc import Channel
+from server.model import getService
+from tools import factorio, placement
+
+
+class ClusterException(Exception):
+    pass
+
+
+class _Value(object):
+    """
+    Stands for the shared values of factorio.Instance.
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+class RemoteInstance(object):
+    """
+    Instance run by an agent, with the interface of factorio.Instance used by
+    the supervisor. Called on the IOLoop thread, except `join`, `backupSave`
+    and `restoreSave` which wait for the agent.
+    """
+    def __init__(self, link, data):
+        super(RemoteInstance, self).__init__()
+        self._link = link
+        self._id = data['_id']
+        self.host = link.name
+        self.port = str(data['port'])
+        self.publicPort = self.port
+        self.save = data['save']
+        # cpus of the agent host, chosen by the agent
+        self.cores = None
+        self._manualCores = data.get('cores')
+        self.subpid = _Value(0)  # on the agent host
+        self.exitCode = _Value(-1)
+        self.stopRequested = False
+        self.replaced = False
+        self._output = deque()
+        self._exited = Event()
+
+    def start(self):
+        self._link.processes[self._id] = self
+
+        def done(future):
+            try:
+                self.cores = placement.parseCores(future.result()['cores'])
+            except Exception as e:
+                self.feed('[ERROR] Unable to start the instance on %s: %s'
+                          % (self.host, str(e)))
+                self.onExit(-1)
+        IOLoop.current().add_future(self._link.call(
+            'start', _id=self._id, port=self.port, save=self.save,
+            cores=self._manualCores), done)
+
+    def started(self, info):
+        """
+        The instance was found running on the agent, see
+        `AgentLink._reconcile`.
+        """
+        self._link.processes[self._id] = self
+        self.cores = placement.parseCores(info['cores'])
+        self.subpid.value = info['pid'] or 0
+
+    def kill(self):
+        self.stopRequested = True
+
+        def done(future):
+            try:
+                future.result()
+            except ClusterException as e:
+                # sent again once connected, see `AgentLink._reconcile`
+                logging.warning("Unable to stop instance %s: %s"
+                                % (self._id, str(e)))
+        IOLoop.current().add_future(
+            self._link.call('stop', _id=self._id), done)
+
+    def place(self, cores):
+        """
+        Pin the instance again on the agent host, see `supervisor.place`.
+        """
+        def done(future):
+            try:
+                self.cores = placement.parseCores(future.result()['cores'])
+            except ClusterException as e:
+                logging.warning("Unable to pin instance %s: %s"
+                                % (self._id, str(e)))
+        IOLoop.current().add_future(
+            self._link.call('place', _id=self._id, cores=cores), done)
+
+    def feed(self, data):
+        self._output.append(data)
+
+    def read(self):
+        try:
+            return self._output.popleft()
+        except IndexError:
+            return None
+
+    def onExit(self, exitCode):
+        if self._link.processes.get(self._id) is self:
+            del self._link.processes[self._id]
+        self.exitCode.value = exitCode
+        self._exited.set()
+
+    def join(self):
+        self._exited.wait()
+
+    def backupSave(self):
+        self._link.callFromThread('backup', _id=self._id)
+
+    def restoreSave(self):
+        return self._link.callFromThread('restore', save=self.save)
+
+
+class AgentLink(object):
+    """
+    Connection to an agent, reconnecting after losing it. The instances run
+    by the agent keep running meanwhile, and are reconciled once connected
+    again (see `_reconcile`).
+    * adopt(process): called with the instances found running on the agent
+      that this process doesn't follow, see `supervisor.adopt`
+    """
+    def __init__(self, name, address, port, adopt):
+        super(AgentLink, self).__init__()
+        self.name = name
+        self.address = address
+        self.port = port
+        self.connected = False
+        # last status sent by the agent: cpus, metrics and instances
+        self.status = {}
+        self.processes = {}  # {instance _id: RemoteInstance}
+        self._adopt = adopt
+        self._channel = None
+        self._requests = {}  # {request id: (Future, timeout handle)}
+        self._ids = itertools.count(1)
+        self._ioloop = IOLoop.instance()
+
+    @gen.coroutine
+    def connect(self):
+        while self._channel is None:
+            try:
+                stream = yield TCPClient().connect(self.address, self.port)
+            except IOError:
+                yield gen.sleep(Conf['cluster']['reconnectDelay'])
+                continue
+            stream.set_nodelay(True)
+            self._channel = Channel(stream, self._onFrame, self._onClose)
+            self._channel.start()
+        try:
+            hello = yield self.call('hello', token=Conf['cluster']['token'])
+        except ClusterException as e:
+            logging.error("Unable to connect to agent %s: %s"
+                          % (self.name, str(e)))
+            if self._channel is not None:
+                self._channel.close()  # reconnects, see `_onClose`
+            return
+        self.connected = True
+        self.status = hello
+        logging.info("Connected to agent %s (%s:%s)."
+                     % (self.name, self.address, self.port))
+        self._reconcile(hello)
+
+    @gen.coroutine
+    def _reconnect(self):
+        yield gen.sleep(Conf['cluster']['reconnectDelay'])
+        yield self.connect()
+
+    def _onClose(self, channel):
+        if self.connected:
+            logging.warning("Lost the connection to agent %s." % self.name)
+        self.connected = False
+        self._channel = None
+        requests, self._requests = self._requests, {}
+        for future, timeout in requests.itervalues():
+            self._ioloop.remove_timeout(timeout)
+            future.set_exception(ClusterException(
+                "Lost the connection to agent %s" % self.name))
+        self._ioloop.add_future(self._reconnect(), lambda f: f.result())
+
+    def _reconcile(self, hello):
+        """
+        Follow the changes that happened while disconnected: the exits of
+        the instances, and the instances started by a previous manager.
+        """
+        running = {info['_id']: info for info in hello['instances']}
+        for instanceId, process in self.processes.items():
+            if instanceId in running:
+                if process.stopRequested:  # requested while disconnected
+                    process.kill()
+                continue
+            exitCode = hello['exited'].get(instanceId)
+            if exitCode is None:
+                process.feed('[ERROR] Agent %s lost the instance.'
+                             % self.name)
+                exitCode = -1
+            process.onExit(exitCode)
+        known = {data['_id']: data
+                 for data in getService('instance').getAll()}
+        for instanceId, info in running.iteritems():
+            if instanceId in self.processes:
+                continue
+            if instanceId not in known:
+                logging.warning("Agent %s runs the unknown instance %s."
+                                % (self.name, instanceId))
+                continue
+            process = RemoteInstance(self, known[instanceId])
+            process.started(info)
+            self._adopt(process)
+
+    def _onFrame(self, channel, header, payload):
+        kind = header['type']
+        if kind == 'response':
+            future, timeout = self._requests.pop(header['id'], (None, None))
+            if future is None:
+                return  # expired
+            self._ioloop.remove_timeout(timeout)
+            if header['error'] is not None:
+                future.set_exception(ClusterException(header['error']))
+            else:
+                future.set_result(json.loads(payload))
+        elif kind == 'status':
+            self.status = json.loads(payload)
+            for info in self.status['instances']:
+                if info['_id'] in self.processes:
+                    self.processes[info['_id']].subpid.value = \
+                        info['pid'] or 0
+        elif kind == 'log':
+            process = self.processes.get(header['instance'])
+            if process is not None:
+                process.feed(payload)
+        elif kind == 'exited':
+            process = self.processes.get(header['instance'])
+            if process is not None:
+                process.onExit(header['exitCode'])
+
+    def call(self, action, **args):
+        """
+        Send a request to the agent, return the Future of its result.
+        IOLoop thread only.
+        """
+        future = Future()
+        if self._channel is None:
+            future.set_exception(ClusterException(
+                "Agent %s is not connected" % self.name))
+            return future
+        requestId = next(self._ids)
+
+        def expire():
+            if self._requests.pop(requestId, None) is not None:
+                future.set_exception(ClusterException(
+                    "Agent %s didn't answer the '%s' request in time"
+                    % (self.name, action)))
+        self._requests[requestId] = (future, self._ioloop.call_later(
+            Conf['cluster']['timeout'], expire))
+        self._channel.send({'type': 'request', 'id': requestId,
+                            'action': action}, json.dumps(args))
+        return future
+
+    def callFromThread(self, action, **args):
+        """
+        `call` from another thread: wait for the result and return it.
+        """
+        result = ThreadFuture()
+        self._ioloop.add_callback(
+            lambda: chain_future(self.call(action, **args), result))
+        return result.result()
+
+
+class Cluster(object):
+    def __init__(self):
+        super(Cluster, self).__init__()
+        self._links = {}  # {agent name: AgentLink}
+
+    def start(self, adopt):
+        """
+        Connect to the agents, see `AgentLink` for `adopt`.
+        """
+        for agent in Conf['cluster']['agents']:
+            link = AgentLink(agent['name'], agent['address'], agent['port'],
+                             adopt)
+            self._links[link.name] = link
+            IOLoop.current().add_future(link.connect(),
+                                        lambda f: f.result())
+
+    def exists(self, host):
+        return host in self._links or (
+            host == factorio.LOCAL and Conf['cluster']['local'])
+
+    def _link(self, host):
+        link = self._links.get(host)
+        if link is None:
+            raise ClusterException("Unknown host %s" % host)
+        if not link.connected:
+            raise ClusterException("Agent %s is not connected" % host)
+        return link
+
+    def create(self, host, data):
+        """
+        Return the process of the instance, not started yet.
+        """
+        if host == factorio.LOCAL:
+            if not Conf['cluster']['local']:
+                raise ClusterException("The instances can't run on the "
+                                       "manager host")
+            return factorio.Instance(data['port'], data['save'], data['_id'])
+        return RemoteInstance(self._link(host), data)
+
+    def _candidates(self):
+        """
+        Return the available hosts as tuples (name, cpus, cpu usage).
+        """
+        hosts = []
+        if Conf['cluster']['local']:
+            hosts.append((factorio.LOCAL, psutil.cpu_count(),
+                          metrics.latest()['CPU']))
+        for link in self._links.itervalues():
+            if link.connected:
+                hosts.append((link.name, link.status['cpus'],
+                              link.status['metrics']['CPU']))
+        return hosts
+
+    def pickHost(self, processes):
+        """
+        Return the least loaded host, given the running processes: fewest
+        instances per cpu, then lowest cpu usage.
+        """
+        counts = {}
+        for process in processes:
+            counts[process.host] = counts.get(process.host, 0) + 1
+        hosts = self._candidates()
+        if not hosts:
+            raise ClusterException("No host available to run the instance")
+        return min(hosts, key=lambda host: (
+            float(counts.get(host[0], 0)) / host[1], host[2]))[0]
+
+    def hosts(self, processes):
+        """
+        Return the state of each host, given the running processes, as dicts
+        {'name', 'address', 'connected', 'cpus', 'CPU', 'MEM', 'instances':
+        number of running instances}.
+        """
+        counts = {}
+        for process in processes:
+            counts[process.host] = counts.get(process.host, 0) + 1
+        hosts = []
+        if Conf['cluster']['local']:
+            usage = metrics.latest()
+            hosts.append({
+                'name': factorio.LOCAL,
+                'address': Conf['server']['ip'],
+                'connected': True,
+                'cpus': psutil.cpu_count(),
+                'CPU': usage['CPU'],
+                'MEM': usage['MEM'],
+                'instances': counts.get(factorio.LOCAL, 0)
+            })
+        for name, link in sorted(self._links.iteritems()):
+            usage = link.status.get('metrics', {})
+            hosts.append({
+                'name': name,
+                'address': '%s:%s' % (link.address, link.port),
+                'connected': link.connected,
+                'cpus': link.status.get('cpus'),
+                'CPU': usage.get('CPU'),
+                'MEM': usage.get('MEM'),
+                'instances': counts.get(name, 0)
+            })
+        return hosts
+
+    def call(self, host, action, **args):
+        """
+        Send a request to the agent of the host, return the Future of its
+        result.
+        """
+        try:
+            return self._link(host).call(action, **args)
+        except ClusterException as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+
+# this module is a singleton
+_instance = None
+_lock = Lock()
+
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = Cluster()
+    return _instance
+
+
+def start(adopt):
+    return getInstance().start(adopt)
+
+
+def exists(host):
+    return getInstance().exists(host)
+
+
+def create(host, data):
+    return getInstance().create(host, data)
+
+
+def pickHost(processes):
+    return getInstance().pickHost(processes)
+
+
+def hosts(processes):
+    return getInstance().hosts(processes)
+
+
+def call(host, action, **args):
+    return getInstance().call(host, action, **args)
@@ -0,0 +1,137 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Encodings of the messages written to the websocket connections (see
+WSHandler). The client chooses one when opening the connection, by
+proposing websocket subprotocols:
+* json: text frames. Also used for the clients proposing no subprotocol.
+* msgpack: binary MessagePack frames. Offered if the msgpack package is
+  installed and `Conf['server']['websocket']['msgpack']` is set.
+  The lists of at least PACKED_MIN_LENGTH numbers, such as the columns of
+  the metrics history (see ManageHandler.execHostMetrics), are packed as
+  arrays of little-endian doubles (extension type PACKED_DOUBLES).
+  See http/assets/custom/js/msgpack.js for the client side.
+The clients always send JSON text frames, their messages being small.
+
+A `Message` is encoded at most once for each encoding, whatever the number
+of connections it is written to (see manageHandler.broadcast and
+server.rpc). In the multi-worker mode, the main process sends them to the
+workers marshalled (MARSHAL, never offered to the clients), which is
+cheaper than json: the workers encode them for their connections.
+"""
+
+import sys
+import json
+import array
+import marshal
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from conf import Conf
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+MARSHAL = 'marshal'  # between the processes of a host, see server.rpc
+PACKED_DOUBLES = 1  # msgpack extension type
+PACKED_MIN_LENGTH = 8
+MAX_SAFE_INTEGER = 2 ** 53  # integers stored exactly in a double
+
+
+def encodings():
+    """
+    Return the encodings offered to the clients, preferred first.
+    """
+    if msgpack is not None and Conf['server']['websocket']['msgpack']:
+        return [MSGPACK, JSON]
+    return [JSON]
+
+
+def select(subprotocols):
+    """
+    Return the encoding of a connection, given the subprotocols proposed by
+    its client. None if none of them is supported.
+    """
+    for encoding in encodings():
+        if encoding in subprotocols:
+            return encoding
+    return None
+
+
+def _isNumber(value):
+    if type(value) is float:
+        return True
+    return type(value) in (int, long) and \
+        -MAX_SAFE_INTEGER <= value <= MAX_SAFE_INTEGER
+
+
+def _prepare(value):
+    """
+    Return the value with its numeric lists packed, and its byte strings
+    decoded like json.dumps does.
+    """
+    if isinstance(value, dict):
+        return {_prepare(key): _prepare(item)
+                for key, item in value.iteritems()}
+    if isinstance(value, (list, tuple)):
+        if len(value) >= PACKED_MIN_LENGTH and all(map(_isNumber, value)):
+            doubles = array.array(b'd', value)
+            if sys.byteorder == 'big':
+                doubles.byteswap()
+            return msgpack.ExtType(PACKED_DOUBLES, doubles.tostring())
+        return map(_prepare, value)
+    if isinstance(value, bytes):
+        return value.decode('utf8', 'replace')
+    return value
+
+
+def _packb(data):
+    return msgpack.packb(_prepare(data), use_bin_type=True)
+
+
+_encoders = {
+    JSON: json.dumps,
+    MSGPACK: _packb,
+    MARSHAL: marshal.dumps
+}
+
+_decoders = {
+    JSON: json.loads,
+    MARSHAL: marshal.loads
+}
+
+
+class Message(object):
+    """
+    Message written to websocket connections, built from its dict or from
+    its payload in the given encoding (as sent by the main process, see
+    server.rpc).
+    """
+    def __init__(self, data=None, encoding=None, payload=None):
+        super(Message, self).__init__()
+        self._data = data
+        self._encoded = {}  # {encoding: payload}
+        if payload is not None:
+            self._encoded[encoding] = payload
+
+    def data(self):
+        if self._data is None:
+            encoding, payload = next(self._encoded.iteritems())
+            self._data = _decoders[encoding](payload)
+        return self._data
+
+    def encode(self, encoding):
+        """
+        Return the payload of the message in the given encoding: text for
+        json, bytes for msgpack and marshal. Raise ValueError if marshal
+        is given a message holding other types than the builtin ones.
+        """
+        payload = self._encoded.get(encoding)
+        if payload is None:
+            payload = self._encoded[encoding] = _encoders[encoding](
+                self.data())
+        return payload
@@ -0,0 +1,294 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+UDP forwarding of the game ports (see `Conf['factorio']['forwarder']`).
+The supervisor keeps the public port of a local instance (from
+`allowedPorts`) bound here, and factorio listens on an internal port. The
+internal port can then be switched to a replacement instance once it is
+joinable, without closing the public port (see `supervisor.replace`).
+
+Each player (client address) gets its own socket towards the internal port,
+so that the answers of factorio can be sent back to that player. Factorio
+sees all the players coming from 127.0.0.1. Players idle for
+`sessionTimeout` seconds are forgotten, and at most `maxSessions` are
+relayed on each port: the datagrams of the others are dropped.
+
+A single thread relays all the ports with a level-triggered poll loop. The
+datagrams are received into a preallocated buffer and sent from a view of
+it, so the relay doesn't copy or allocate per datagram.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+from collections import deque
+from threading import Thread, Event, Lock
+
+from conf import Conf
+
+BACKEND = '127.0.0.1'
+BUFFER_SIZE = 65536
+EXPIRE_INTERVAL = 1  # in seconds
+
+if hasattr(select, 'epoll'):
+    _Poller, _READ, _TIMEOUT_SCALE = select.epoll, select.EPOLLIN, 1
+else:  # MacOS
+    _Poller, _READ, _TIMEOUT_SCALE = select.poll, select.POLLIN, 1000
+
+
+class ForwarderException(Exception):
+    pass
+
+
+def _socket(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    sock.bind(address)
+    return sock
+
+
+class PortForward(object):
+    """
+    Public port relayed to an internal port, with its counters:
+    * 'in': datagrams and bytes from the players
+    * 'out': datagrams and bytes to the players
+    * 'dropped': datagrams of the players above `maxSessions`, or that
+      couldn't be sent
+    """
+    def __init__(self, publicPort, backendPort):
+        super(PortForward, self).__init__()
+        self.publicPort = publicPort
+        self.backend = (BACKEND, backendPort)
+        self.socket = _socket(('', publicPort))
+        self.sessions = {}  # {player address: Session}
+        self.packetsIn = self.bytesIn = 0
+        self.packetsOut = self.bytesOut = 0
+        self.dropped = 0
+        self.switchedAt = time.time()
+
+    def stats(self):
+        return {
+            'backendPort': self.backend[1],
+            'sessions': len(self.sessions),
+            'in': {'packets': self.packetsIn, 'bytes': self.bytesIn},
+            'out': {'packets': self.packetsOut, 'bytes': self.bytesOut},
+            'dropped': self.dropped,
+            'switchedAt': self.switchedAt
+        }
+
+
+class Session(object):
+    def __init__(self, forward, player):
+        super(Session, self).__init__()
+        self.forward = forward
+        self.player = player
+        self.socket = _socket((BACKEND, 0))
+        self.lastSeen = time.time()
+
+
+class Forwarder(Thread):
+    """
+    Relay thread. The ports are opened, switched and closed by the other
+    threads through commands, run by the relay loop.
+    """
+    def __init__(self):
+        super(Forwarder, self).__init__(name='forwarder')
+        self.daemon = True
+        self._forwards = {}  # {public port: PortForward}
+        # {fd: PortForward or Session}, readable sockets
+        self._sockets = {}
+        self._commands = deque()
+        self._poller = _Poller()
+        self._wakeRead, self._wakeWrite = os.pipe()
+        self._poller.register(self._wakeRead, _READ)
+
+    def _call(self, fn, *args):
+        """
+        Run `fn` on the relay thread, wait for its result.
+        """
+        done = {}
+        finished = Event()
+
+        def command():
+            try:
+                done['result'] = fn(*args)
+            except Exception as e:
+                done['error'] = e
+            finished.set()
+        self._commands.append(command)
+        os.write(self._wakeWrite, b'x')
+        finished.wait()
+        if 'error' in done:
+            raise done['error']
+        return done.get('result')
+
+    def forward(self, publicPort, backendPort):
+        """
+        Relay the public port to the internal port, switching its players to
+        it if the public port is already relayed.
+        """
+        return self._call(self._forward, int(publicPort), int(backendPort))
+
+    def close(self, publicPort):
+        """
+        Stop relaying the public port, so that it can be bound again.
+        Return False if it wasn't relayed.
+        """
+        return self._call(self._close, int(publicPort))
+
+    def sockets(self):
+        """
+        Return the sockets of the relay, see factorio.Instance.inherited.
+        """
+        return self._call(lambda: [
+            target.socket for target in self._sockets.itervalues()])
+
+    def stats(self):
+        """
+        Return the counters of each relayed port, see `PortForward`.
+        """
+        return self._call(lambda: {
+            port: forward.stats()
+            for port, forward in self._forwards.iteritems()})
+
+    def _forward(self, publicPort, backendPort):
+        forward = self._forwards.get(publicPort)
+        if forward is not None:
+            forward.backend = (BACKEND, backendPort)
+            forward.switchedAt = time.time()
+            return
+        try:
+            forward = PortForward(publicPort, backendPort)
+        except socket.error as e:
+            raise ForwarderException("Unable to bind port %d: %s"
+                                     % (publicPort, str(e)))
+        self._forwards[publicPort] = forward
+        self._register(forward)
+
+    def _close(self, publicPort):
+        forward = self._forwards.pop(publicPort, None)
+        if forward is None:
+            return False
+        for session in forward.sessions.values():
+            self._unregister(session)
+        self._unregister(forward)
+        return True
+
+    def _register(self, target):
+        self._sockets[target.socket.fileno()] = target
+        self._poller.register(target.socket.fileno(), _READ)
+
+    def _unregister(self, target):
+        fd = target.socket.fileno()
+        self._poller.unregister(fd)
+        del self._sockets[fd]
+        target.socket.close()
+
+    def _expire(self, now):
+        timeout = Conf['factorio']['forwarder']['sessionTimeout']
+        for forward in self._forwards.itervalues():
+            for player, session in forward.sessions.items():
+                if now - session.lastSeen > timeout:
+                    del forward.sessions[player]
+                    self._unregister(session)
+
+    def run(self):
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        maxSessions = Conf['factorio']['forwarder']['maxSessions']
+        nextExpire = time.time() + EXPIRE_INTERVAL
+        while True:
+            try:
+                events = self._poller.poll(EXPIRE_INTERVAL * _TIMEOUT_SCALE)
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                if fd == self._wakeRead:
+                    os.read(self._wakeRead, 4096)
+                    while self._commands:
+                        self._commands.popleft()()
+                    continue
+                target = self._sockets.get(fd)
+                if target is None:
+                    continue  # closed by a command of this round
+                try:
+                    size, address = target.socket.recvfrom_into(buf)
+                except socket.error:
+                    # eg: ECONNREFUSED, while the internal port is closed
+                    continue
+                if isinstance(target, Session):
+                    forward = target.forward
+                    try:
+                        forward.socket.sendto(view[:size], target.player)
+                    except socket.error:
+                        forward.dropped += 1
+                        continue
+                    forward.packetsOut += 1
+                    forward.bytesOut += size
+                    continue
+                forward = target
+                session = forward.sessions.get(address)
+                if session is None:
+                    if len(forward.sessions) >= maxSessions:
+                        forward.dropped += 1
+                        continue
+                    session = forward.sessions[address] = Session(
+                        forward, address)
+                    self._register(session)
+                session.lastSeen = time.time()
+                try:
+                    session.socket.sendto(view[:size], forward.backend)
+                except socket.error:
+                    forward.dropped += 1
+                    continue
+                forward.packetsIn += 1
+                forward.bytesIn += size
+            now = time.time()
+            if now >= nextExpire:
+                self._expire(now)
+                nextExpire = now + EXPIRE_INTERVAL
+
+
+# this module is a singleton
+_instance = None
+_lock = Lock()
+
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = Forwarder()
+                _instance.start()
+    return _instance
+
+
+def enabled():
+    return Conf['factorio']['forwarder']['enabled']
+
+
+def forward(publicPort, backendPort):
+    return getInstance().forward(publicPort, backendPort)
+
+
+def close(publicPort):
+    return getInstance().close(publicPort)
+
+
+def sockets():
+    return getInstance().sockets()
+
+
+def stats():
+    return getInstance().stats()
@@ -0,0 +1,220 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Idle hibernation of the factorio instances.
+The players of each running instance are tracked from the join and leave
+events of the supervisor. An instance without players for
+`Conf['factorio']['hibernation']['idleTimeout']` seconds is saved and
+stopped, and a UDP socket listens on its port instead. The first packet
+received on that port starts the instance again from its save: that packet
+is lost, but the factorio client keeps retrying while the map loads.
+Each hibernation is recorded by the 'hibernation' service with the memory
+that was freed and the wake latency: time between the packet and the
+server being ready to accept players.
+The instance status is 'hibernating' while it sleeps.
+Only the instances of this host hibernate (see server.cluster): the port of
+the others can't be listened on from here.
+
+Everything here runs on the IOLoop thread.
+"""
+
+import time
+import socket
+import logging
+from threading import Lock
+
+import psutil
+from tornado.ioloop import IOLoop
+
+from conf import Conf
+from server import supervisor
+from server.model import getService
+from tools import factorio
+
+
+class Hibernator(object):
+    def __init__(self):
+        super(Hibernator, self).__init__()
+        self._players = {}  # {instance _id: set of player names}
+        self._lastActivity = {}  # {instance _id: timestamp}
+        self._sleeping = {}  # {instance _id: hibernation _id}
+        self._sockets = {}  # {instance _id: listening socket}
+        self._waking = {}  # {instance _id: (hibernation _id, woke at)}
+
+    def _ready(self, instanceId):
+        if instanceId not in self._waking:
+            return
+        hibernationId, wokeAt = self._waking.pop(instanceId)
+        latency = time.time() - wokeAt
+        getService('hibernation').set(hibernationId, 'wakeLatency', latency)
+        logging.info("Instance %s woke up in %.1fs" % (instanceId, latency))
+
+    def players(self, instanceId):
+        return sorted(self._players.get(instanceId, ()))
+
+    def check(self):
+        """
+        Hibernate the running instances idle for too long. Scheduled on the
+        IOLoop every `Conf['factorio']['hibernation']['checkInterval']`
+        seconds.
+        """
+        now = time.time()
+        idleTimeout = Conf['factorio']['hibernation']['idleTimeout']
+        for process in supervisor.running():
+            instanceId = process._id
+            if process.stopRequested or self._players.get(instanceId) or \
+                    process.host != factorio.LOCAL:
+                continue
+            if now - self._lastActivity.setdefault(instanceId, now) >= \
+                    idleTimeout:
+                self.hibernate(process)
+
+    def hibernate(self, process):
+        """
+        Save and stop the instance, and wait for a player on its port.
+        """
+        instanceId = process._id
+        try:
+            rss = psutil.Process(process.subpid.value).memory_info().rss
+        except (psutil.Error, ValueError):
+            rss = 0
+        logging.info("Instance %s is idle, hibernating." % instanceId)
+        self._sleeping[instanceId] = getService('hibernation').insert(
+            instanceId, time.time(), rss)
+        supervisor.stop(instanceId)
+        getService('instance').set(instanceId, 'status', 'hibernating')
+
+    def onInstanceEvent(self, event, instanceId, **info):
+        """
+        Listener of the supervisor events: track the players, and listen on
+        the port of the hibernating instances once they are stopped.
+        """
+        if event == 'stopped' and instanceId in self._sleeping:
+            self._listen(instanceId)
+        elif event in ('started', 'restarted'):
+            self._players[instanceId] = set()
+            self._lastActivity[instanceId] = time.time()
+        elif event == 'ready':
+            self._ready(instanceId)
+        elif event in ('join', 'leave'):
+            players = self._players.setdefault(instanceId, set())
+            if event == 'join':
+                players.add(info['player'])
+            else:
+                players.discard(info['player'])
+            self._lastActivity[instanceId] = time.time()
+
+    def _listen(self, instanceId):
+        data = getService('instance').getById(instanceId)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(0)
+            sock.bind(('', int(data['port'])))
+        except socket.error as e:
+            sock.close()
+            logging.error("Unable to listen on port %s for instance %s: %s"
+                          % (data['port'], instanceId, str(e)))
+            self._close(instanceId)
+            getService('instance').set(instanceId, 'status', 'stopped')
+            return
+        self._sockets[instanceId] = sock
+        IOLoop.current().add_handler(
+            sock.fileno(), lambda fd, events: self.wake(instanceId),
+            IOLoop.READ)
+
+    def _close(self, instanceId):
+        """
+        Stop listening for the instance. Return the _id of its hibernation,
+        None if it wasn't hibernating.
+        """
+        sock = self._sockets.pop(instanceId, None)
+        if sock is not None:
+            IOLoop.current().remove_handler(sock.fileno())
+            sock.close()
+        hibernationId = self._sleeping.pop(instanceId, None)
+        if hibernationId is not None:
+            getService('hibernation').set(hibernationId, 'wokeAt', time.time())
+        return hibernationId
+
+    def wake(self, instanceId):
+        """
+        Start the hibernating instance again.
+        """
+        wokeAt = time.time()
+        hibernationId = self._close(instanceId)
+        if hibernationId is None:
+            return
+        logging.info("Waking instance %s up." % instanceId)
+        self._waking[instanceId] = (hibernationId, wokeAt)
+        try:
+            supervisor.start(instanceId)
+        except Exception as e:
+            logging.exception(e)
+            self._waking.pop(instanceId)
+            getService('instance').set(instanceId, 'status', 'stopped')
+
+    def cancel(self, instanceId):
+        """
+        Stop the hibernation of the instance without starting it, so that
+        it can be started or stopped by hand.
+        Return False if the instance wasn't hibernating.
+        """
+        return self._close(instanceId) is not None
+
+    def resume(self):
+        """
+        Listen again for the instances that were hibernating when the
+        server stopped.
+        """
+        for data in getService('instance').getAll():
+            if data['status'] != 'hibernating':
+                continue
+            hibernations = [h for h in getService('hibernation').getAll()
+                            if h['instanceId'] == data['_id'] and
+                            h['wokeAt'] is None]
+            if not hibernations:
+                getService('instance').set(data['_id'], 'status', 'stopped')
+                continue
+            self._sleeping[data['_id']] = max(
+                hibernations, key=lambda h: h['sleptAt'])['_id']
+            self._listen(data['_id'])
+
+
+# this module is a singleton
+_instance = None
+_lock = Lock()
+
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = Hibernator()
+    return _instance
+
+
+def onInstanceEvent(event, instanceId, **info):
+    return getInstance().onInstanceEvent(event, instanceId, **info)
+
+
+def players(instanceId):
+    return getInstance().players(instanceId)
+
+
+def check():
+    return getInstance().check()
+
+
+def cancel(instanceId):
+    return getInstance().cancel(instanceId)
+
+
+def resume():
+    return getInstance().resume()
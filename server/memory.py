@@ -2,10 +2,157 @@
 
 from __future__ import unicode_literals
 
-from threading import Lock
+import time
+from collections import OrderedDict
+from threading import Lock, RLock, Event
 from functools import wraps
 
 
+class Cache(object):
+    """
+    Thread-safe namespaced cache, with optional expiration and LRU eviction.
+    * ttl: default time to live of the entries in seconds (None for no
+      expiration)
+    * maxSize: max number of entries (None for no limit)
+    * maxWeight: max total weight of the entries, as computed by the `weigh`
+      function for each value (eg: `len` for a size in bytes). Ignored if
+      `weigh` is None.
+    When full, the least recently used entries are evicted first.
+    """
+    def __init__(self, namespace, ttl=None, maxSize=None, maxWeight=None,
+                 weigh=None):
+        super(Cache, self).__init__()
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.maxWeight = maxWeight
+        self.weigh = weigh
+        self._entries = OrderedDict()  # key -> (value, expires, weight)
+        self._weight = 0
+        self._lock = RLock()
+        self._inflight = {}  # key -> Event, for single flight computations
+        self._generation = 0
+        self._hooks = []
+        self._stats = {
+            'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0,
+            'invalidations': 0, 'coalesced': 0
+        }
+
+    def _remove(self, key):
+        _, _, weight = self._entries.pop(key)
+        self._weight -= weight
+
+    def _lookup(self, key):
+        """
+        Return a tuple (found, value). Expects the lock to be held.
+        """
+        if key not in self._entries:
+            return False, None
+        value, expires, weight = self._entries.pop(key)
+        if expires is not None and expires <= time.time():
+            self._weight -= weight
+            self._stats['expirations'] += 1
+            return False, None
+        # re-insert as most recently used
+        self._entries[key] = (value, expires, weight)
+        return True, value
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key)
+            self._stats['hits' if found else 'misses'] += 1
+            return value if found else default
+
+    def has(self, key):
+        with self._lock:
+            return self._lookup(key)[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        weight = self.weigh(value) if self.weigh is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (
+                value, time.time() + ttl if ttl is not None else None, weight)
+            self._weight += weight
+            while self._entries and (
+                    (self.maxSize is not None and
+                     len(self._entries) > self.maxSize) or
+                    (self.maxWeight is not None and self.weigh is not None and
+                     self._weight > self.maxWeight)):
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def getOrCompute(self, key, compute, ttl=None):
+        """
+        Return the cached value for `key`, or call `compute()` to get it and
+        cache it. Concurrent callers missing the same key wait for the first
+        one to compute the value instead of computing it again.
+        """
+        while True:
+            with self._lock:
+                found, value = self._lookup(key)
+                if found:
+                    self._stats['hits'] += 1
+                    return value
+                event = self._inflight.get(key)
+                leader = event is None
+                if leader:
+                    self._stats['misses'] += 1
+                    event = self._inflight[key] = Event()
+                    generation = self._generation
+                else:
+                    self._stats['coalesced'] += 1
+            if not leader:
+                # re-test once the leader is done. If it failed, one of the
+                # waiters will take the lead.
+                event.wait()
+                continue
+            try:
+                value = compute()
+                with self._lock:
+                    # don't cache a value computed before an invalidation
+                    if generation == self._generation:
+                        self.set(key, value, ttl)
+                return value
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                event.set()
+
+    def invalidate(self, key=None):
+        """
+        Remove the entry for `key` from the cache, or all the entries if `key`
+        is None, then call the invalidation hooks with the same argument.
+        """
+        with self._lock:
+            self._generation += 1
+            self._stats['invalidations'] += 1
+            if key is None:
+                self._entries.clear()
+                self._weight = 0
+            elif key in self._entries:
+                self._remove(key)
+        for hook in self._hooks:
+            hook(key)
+
+    def onInvalidate(self, hook):
+        """
+        Register a function to call with the invalidated key (None meaning
+        everything) each time this cache is invalidated. Useful to invalidate
+        dependent caches.
+        """
+        self._hooks.append(hook)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['weight'] = self._weight
+        return stats
+
+
 class Memory(object):
     """
     A singleton containing all the memory items shared by
@@ -14,13 +161,41 @@ class Memory(object):
     def __init__(self):
         super(Memory, self).__init__()
         self._memory = {}
+        self._caches = {}
+        self._lock = Lock()
 
     def setVal(self, mid, value):
-        self._memory[mid] = value
+        with self._lock:
+            self._memory[mid] = value
 
     def getVal(self, mid):
-        if mid in self._memory:
-            return self._memory[mid]
+        with self._lock:
+            if mid in self._memory:
+                return self._memory[mid]
+
+    def getCache(self, namespace, **options):
+        """
+        Return the cache of the given namespace, creating it with the given
+        options (see `Cache`) if it doesn't exist yet.
+        """
+        with self._lock:
+            if namespace not in self._caches:
+                self._caches[namespace] = Cache(namespace, **options)
+            return self._caches[namespace]
+
+    def invalidate(self, namespace, key=None):
+        with self._lock:
+            cache = self._caches.get(namespace)
+        if cache is not None:
+            cache.invalidate(key)
+
+    def stats(self):
+        """
+        Return the hit/miss/eviction statistics of each cache, by namespace.
+        """
+        with self._lock:
+            caches = dict(self._caches)
+        return {ns: cache.stats() for ns, cache in caches.iteritems()}
 
 # this module is a singleton
 _instance = None
@@ -39,12 +214,6 @@ def getInstance():
                 _instance = Memory()
     return _instance
 
-def getVal(mid):
-    getInstance().getVal(mid)
-
-def setVal(mid, val):
-    getInstance().setVal(mid, val)
-
 
 def singletonize(method):
     @wraps(method)
@@ -54,3 +223,41 @@ def singletonize(method):
 
 getVal = singletonize(Memory.getVal)
 setVal = singletonize(Memory.setVal)
+getCache = singletonize(Memory.getCache)
+invalidate = singletonize(Memory.invalidate)
+stats = singletonize(Memory.stats)
+
+
+def memoize(namespace, key=None, **options):
+    """
+    Cache the results of the decorated function in the `namespace` cache,
+    created with the given options (see `Cache`). Concurrent calls with the
+    same arguments only compute the result once.
+    * key: function computing the cache key from the call arguments. By
+      default, the tuple of positional arguments and sorted keyword
+      arguments is used, so they need to be hashable.
+    The decorated function exposes the `cache` and an `invalidate(*args,
+    **kwargs)` function removing the result of the corresponding call (all
+    results if called without arguments).
+    """
+    def makeKey(args, kwargs):
+        if key is not None:
+            return key(*args, **kwargs)
+        return (args, tuple(sorted(kwargs.items())))
+
+    def decorator(fn):
+        cache = getCache(namespace, **options)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return cache.getOrCompute(
+                makeKey(args, kwargs), lambda: fn(*args, **kwargs))
+
+        def invalidate(*args, **kwargs):
+            cache.invalidate(makeKey(args, kwargs) if args or kwargs
+                             else None)
+
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
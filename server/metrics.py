@@ -0,0 +1,70 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+System metrics sampled periodically by the scheduler (see `sample`), so that
+psutil is queried at a fixed rate whatever the number of connected clients.
+"""
+
+import time
+from collections import deque
+from threading import Lock
+
+import psutil
+
+from conf import Conf
+
+
+# list of samples, as dicts holding the fields ts, CPU, CPUs (usage of each
+# logical cpu) and MEM
+_history = deque(maxlen=Conf['metrics']['historySize'])
+_lock = Lock()
+
+
+def sample():
+    """
+    Take a new sample and add it to the history.
+    `psutil.cpu_percent` measures the usage since its previous call, that is
+    since the previous sample.
+    """
+    data = {
+        'ts': time.time(),
+        'CPU': psutil.cpu_percent(),
+        'CPUs': psutil.cpu_percent(percpu=True),
+        'MEM': psutil.virtual_memory().percent
+    }
+    with _lock:
+        _history.append(data)
+    return data
+
+
+def latest():
+    """
+    Return the most recent sample, taking one if there is none yet.
+    """
+    with _lock:
+        if _history:
+            return dict(_history[-1])
+    return dict(sample())
+
+
+def history(since=None):
+    """
+    Return the samples taken after the `since` timestamp (all by default),
+    oldest first.
+    """
+    with _lock:
+        return [dict(s) for s in _history
+                if since is None or s['ts'] > since]
+
+
+def columns(samples):
+    """
+    Return the samples as a dict of lists {field: values}, 'CPUs' holding a
+    list for each logical cpu.
+    """
+    data = {field: [s[field] for s in samples]
+            for field in ('ts', 'CPU', 'MEM')}
+    data['CPUs'] = map(list, zip(*[s['CPUs'] for s in samples]))
+    return data
@@ -10,6 +10,9 @@ import errno
 
 from conf import Conf
 from server.services.instanceService import InstanceService
+from server.services.compressionService import CompressionService
+from server.services.incidentService import IncidentService
+from server.services.hibernationService import HibernationService
 
 
 class ModelException(Exception):
@@ -51,6 +54,9 @@ class Model(object):
 
         self._services = {
             'instance': InstanceService(self._connection),
+            'compression': CompressionService(self._connection),
+            'incident': IncidentService(self._connection),
+            'hibernation': HibernationService(self._connection),
         }
 
     def getService(self, service):
@@ -0,0 +1,104 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Read-only JSON API, for the scripts and monitoring probes which don't speak
+the websocket protocol:
+* GET /api/instances: the instances, see server.services.instanceService
+* GET /api/saves: the saves, see tools.saves.list
+* GET /api/metrics: the latest metrics sample, see server.metrics
+The answers come from the snapshot of the pages (see server.snapshot), so a
+request doesn't touch the database or the saves folder.
+
+Query arguments:
+* fields: comma separated fields kept in each item, eg: `_id,name,status`
+* offset, limit: page of the list, at most
+  `Conf['server']['api']['maxLimit']` items. The list answers hold the
+  page as 'items', with the 'total' number of items and the 'next' offset
+  (None on the last page).
+
+The answers carry a strong ETag (hash of the body) and are cacheable for
+`Conf['server']['api']['maxAge']` seconds. An unchanged answer gets a 304,
+and the bodies are cached by version of the data, so that polling costs
+a hash table lookup.
+"""
+
+import json
+import hashlib
+
+from tornado import gen
+from tornado.web import RequestHandler, HTTPError
+
+from conf import Conf
+from server import memory
+from server.requestHandlers.templatesHandler import getSnapshot
+
+RESOURCES = ('instances', 'saves', 'metrics')
+
+
+def _select(item, fields):
+    if fields is None:
+        return item
+    return {field: item[field] for field in fields if field in item}
+
+
+class ApiHandler(RequestHandler):
+    """Handle the requests of /api/<resource>"""
+    def _intArgument(self, name, default, minimum=0, maximum=None):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise HTTPError(400, "Invalid %s: %s" % (name, value))
+        if value < minimum or (maximum is not None and value > maximum):
+            raise HTTPError(400, "Invalid %s: %d" % (name, value))
+        return value
+
+    def _body(self, resource, data, fields, offset, limit):
+        if resource == 'metrics':
+            return json.dumps(_select(data['metrics'], fields))
+        # sorted, so that the pages stay consistent between requests
+        items = sorted(data[resource],
+                       key=lambda item: (item['name'], item.get('_id')))
+        page = items[offset:offset + limit]
+        return json.dumps({
+            'total': len(items),
+            'offset': offset,
+            'limit': limit,
+            'next': offset + limit if offset + limit < len(items) else None,
+            'items': [_select(item, fields) for item in page]
+        })
+
+    @gen.coroutine
+    def get(self, resource):
+        if resource not in RESOURCES:
+            raise HTTPError(404)
+        options = Conf['server']['api']
+        fields = self.get_argument('fields', None)
+        if fields is not None:
+            fields = sorted(set(f for f in fields.split(',') if f))
+        offset = self._intArgument('offset', 0)
+        limit = self._intArgument('limit', options['defaultLimit'], 1,
+                                  options['maxLimit'])
+        data = yield getSnapshot()
+        if data is None:
+            raise HTTPError(503)
+        key = json.dumps([resource, fields, offset, limit,
+                          data['dataVersion'], data['metrics']['ts']
+                          if resource == 'metrics' else None])
+
+        def compute():
+            body = self._body(resource, data, fields, offset, limit)
+            return '"%s"' % hashlib.sha1(body.encode('utf8')).hexdigest(), body
+        etag, body = memory.getCache(
+            'api', maxSize=options['cacheSize']).getOrCompute(key, compute)
+        self.set_header('Etag', etag)
+        self.set_header('Cache-Control', 'max-age=%d' % options['maxAge'])
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.finish(body)
@@ -3,8 +3,6 @@
 from __future__ import unicode_literals
 
 from tornado.web import RequestHandler
-from jsmin import jsmin
-from cssmin import cssmin
 
 import random
 import logging
@@ -13,13 +11,106 @@ import os.path
 import io
 
 from conf import Conf
+from tools import clientTemplates
+
+# bundle of the compiled client templates, see tools.clientTemplates
+TEMPLATES_BUNDLE = 'custom/js/templates.js'
+# of the assets requested with a version (see `templatesUrl`), in seconds
+VERSIONED_MAX_AGE = 365 * 24 * 3600
+
+
+def minifyEnabled():
+    return Conf['state'] != 'DEBUG' or \
+        Conf['server']['assets']['minifyOnDebug']
+
+
+def minify(filepath, extension):
+    """
+    Create the minified version of the given file path, unless it is
+    already there and newer than the file.
+    filepath must be the entire path of the file from the root of the
+    project, without its extension (eg: whatever/example.js should be
+    given as 'whatever/example')
+    extension must be the extension or the file without the '.'
+    (eg: 'js' or 'css')
+    This will create the filepath.min.extension minified version of the
+    input file.
+    Note: Unexpected results may occur if the extension is neither js nor
+          css, or if the file does not contains js/css code.
+
+    Returns the path of the minified file
+    """
+    source = "%s.%s" % (filepath, extension)
+    target = "%s.min.%s" % (filepath, extension)
+    if os.path.isfile(target) and \
+            os.path.getmtime(target) >= os.path.getmtime(source):
+        return target
+    logging.info("Minifying the file: %s" % source)
+    # imported on first use, they are not needed to start the server
+    if extension == 'js':
+        from jsmin import jsmin as minifier
+    else:
+        from cssmin import cssmin as minifier
+    # written aside then renamed, the file may be requested meanwhile
+    tmp = "%s.%d.tmp" % (target, random.randint(0, 10 ** 9))
+    with open(tmp, 'w') as fw, open(source) as fr:
+        fw.write(minifier(fr.read()))
+    os.rename(tmp, target)
+    return target
+
+
+def bundleTemplates():
+    """
+    Compile the client templates if needed, see tools.clientTemplates.
+    """
+    return clientTemplates.bundle(Conf['server']['assets']['templates'],
+                                  'http/assets/' + TEMPLATES_BUNDLE)
+
+
+def templatesUrl():
+    """
+    Return the URL of the bundle of the client templates, with its version
+    so that it can be cached for good.
+    """
+    return '/assets/%s?v=%d' % (TEMPLATES_BUNDLE, clientTemplates.version(
+        Conf['server']['assets']['templates']))
+
+
+def warmUp():
+    """
+    Compile the client templates, and minify the missing or outdated assets
+    of the folders of `Conf['server']['assets']['minifiedCleanups']`, so
+    that their first requests don't have to. Called on a worker thread
+    after the start.
+    """
+    try:
+        bundleTemplates()
+    except Exception as e:
+        logging.error("Unable to compile the client templates: %s" % str(e))
+    if not minifyEnabled():
+        return
+    for folder in Conf['server']['assets']['minifiedCleanups']:
+        try:
+            filenames = os.listdir(folder)
+        except OSError as e:
+            logging.error("Unable to minify the assets of folder %s: %s"
+                          % (folder, str(e)))
+            continue
+        for filename in filenames:
+            name, _, extension = filename.rpartition('.')
+            if extension in ('js', 'css') and not name.endswith('.min'):
+                try:
+                    minify(os.path.join(folder, name), extension)
+                except Exception as e:
+                    logging.error("Unable to minify %s: %s"
+                                  % (filename, str(e)))
 
 
 def minifiedCleanUp():
     """
     WIll check the files in each folder of the cleanup list to remove
     minified js and css files.
-    This is done each time the server is started.
+    Not needed anymore: outdated minified files are rebuilt (see `minify`).
     """
     _min_cleanup = Conf['server']['assets']['minifiedCleanups']
 
@@ -40,30 +131,6 @@ def minifiedCleanUp():
 
 class AssetsHandler(RequestHandler):
     """Handle the requests of the assets items"""
-    def __minify(self, filepath, extension):
-        """
-        Create the minified version of the given file path.
-        filepath must be the entire path of the file from the root of the
-        project, without its extension (eg: whatever/example.js should be
-        given as 'whatever/example')
-        extension must be the extension or the file without the '.'
-        (eg: 'js' or 'css')
-        This will create the filepath.min.extension minified version of the
-        input file.
-        Note: Unexpected results may occur if the extension is neither js nor
-              css, or if the file does not contains js/css code.
-
-        Returns the path of the minified file
-        """
-        logging.info("Minifying the file: %s.%s"
-                     % ((filepath), extension))
-        minifier = jsmin if extension == 'js' else cssmin
-        if not os.path.isfile("%s.min.%s" % (filepath, extension)):
-            with open("%s.min.%s" % (filepath, extension), 'w') \
-                    as fw, open("%s.%s" % (filepath, extension)) as fr:
-                fw.write(minifier(fr.read()))
-        return "%s.min.%s" % (filepath, extension)
-
     def get(self, filename):
         """
         Will look at the http/assets/filename folder to find the requested file
@@ -72,32 +139,37 @@ class AssetsHandler(RequestHandler):
         If the project is not in debug state, if a requested asset is a
         javascript file (with .js extension) or a css file
         (with .css extension), it will send the corresponding filename.min.js
-        or filename.min.css. If this file does not exist, it will create it.
+        or filename.min.css. If this file does not exist or is older than the
+        file, it will create it (see `minify`). The assets are minified ahead
+        after each start by `warmUp`.
 
-        Note that (still not in DEBUG state), all the .min.js files found in
-        the folders listed in the `AssetsHandler._min_cleanup` attributes will
-        be deleted when the server restart (allowing recompile, and thus update
-        of the minified version of the assets).
+        The bundle of the client templates is compiled first if needed (see
+        `bundleTemplates`). The assets requested with a version argument
+        `v` are cached by the browsers for `VERSIONED_MAX_AGE`.
 
         Additionnal info: the module `jsmin` is used to minify js files and
         `cssmin` is used to minify css files.
         """
+        if filename == TEMPLATES_BUNDLE:
+            bundleTemplates()
+        if self.get_argument('v', None) is not None:
+            self.set_header('Cache-Control',
+                            'public, max-age=%d' % VERSIONED_MAX_AGE)
         # if the filename is a javacsript file (not a minified one) and the
-        # corresponding minified file does not exist, create it.
+        # corresponding minified file is missing or outdated, create it.
         if filename.endswith('.js') and not filename.endswith('.min.js') \
-                and (Conf['state'] != 'DEBUG' or
-                     Conf['server']['assets']['minifyOnDebug']):
-            filepath = self.__minify('http/assets/' + filename[:-3], 'js')
+                and minifyEnabled():
+            filepath = minify('http/assets/' + filename[:-3], 'js')
         # if the filename is a stylesheet (not a minified one) and the
-        # corresponding minified file does not exist, create it.
+        # corresponding minified file is missing or outdated, create it.
         elif filename.endswith('.css') and not filename.endswith('.min.css') \
-                and (Conf['state'] != 'DEBUG' or
-                     Conf['server']['assets']['minifyOnDebug']):
-            filepath = self.__minify('http/assets/' + filename[:-4], 'css')
+                and minifyEnabled():
+            filepath = minify('http/assets/' + filename[:-4], 'css')
         else:
             filepath = 'http/assets/' + filename
 
-        if filepath.endswith('.png') or filepath.endswith('.gif') or filepath.endswith('.jpg'):
+        if filepath.endswith('.png') or filepath.endswith('.gif') or \
+                filepath.endswith('.jpg'):
             try:
                 with open(filepath, 'rb') as p:
                     buf = p.read()
@@ -0,0 +1,183 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+from tornado.web import RequestHandler, HTTPError, stream_request_body
+
+from conf import Conf
+from tools import saves, storage, verify
+
+
+_executor = ThreadPoolExecutor(2)
+
+
+@stream_request_body
+class SavesHandler(RequestHandler):
+    """
+    Download and upload of the save files.
+    * GET /savefiles/<name>.zip streams the save by chunks, with support for
+      conditional requests (ETag computed from mtime and size) and single
+      byte ranges, to resume interrupted downloads.
+      If `Conf['server']['saves']['accelRedirect']` is set, the file isn't
+      sent by tornado: the response only holds an `X-Accel-Redirect` header
+      telling the front proxy (eg: nginx) to send it using sendfile.
+    * PUT /savefiles/<name>.zip streams the request body to a temporary file
+      of the saves folder, checks that it is a valid zip archive and moves it
+      in place. An existing save is only replaced if the query argument
+      `overwrite` is set to 1.
+    Memory usage does not depend on the size of the save.
+    """
+    def initialize(self):
+        self._tmp = None  # file of the upload
+        self._tmpPath = None
+
+    def _path(self, filename):
+        if os.path.basename(filename) != filename or \
+                not filename.endswith('.zip') or filename.startswith('.'):
+            raise HTTPError(400, "Invalid save file name: %s" % filename)
+        return os.path.join(saves.savesFolder, filename)
+
+    def prepare(self):
+        if self.request.method != 'PUT':
+            return
+        self.request.connection.set_max_body_size(
+            Conf['server']['saves']['maxUploadSize'])
+        filename = self.path_args[0]
+        path = self._path(filename)
+        if os.path.exists(path) and self.get_argument('overwrite', '0') != '1':
+            raise HTTPError(409, "The save %s already exists." % filename)
+        # in the saves folder, so that the final rename stays atomic
+        fd, tmp = tempfile.mkstemp(
+            prefix='.upload-', suffix='.tmp', dir=saves.savesFolder)
+        self._tmp = os.fdopen(fd, 'wb')
+        self._tmpPath = tmp
+
+    def data_received(self, chunk):
+        if self._tmp is not None:
+            self._tmp.write(chunk)
+
+    def _discardUpload(self):
+        if self._tmp is not None:
+            self._tmp.close()
+            self._tmp = None
+        if self._tmpPath is not None:
+            try:
+                os.remove(self._tmpPath)
+            except OSError:
+                pass
+            self._tmpPath = None
+
+    def on_connection_close(self):
+        self._discardUpload()
+
+    def on_finish(self):
+        self._discardUpload()
+
+    @gen.coroutine
+    def put(self, filename):
+        path = self._path(filename)
+        tmp = self._tmpPath
+        self._tmp.close()
+        try:
+            yield _executor.submit(verify.checkArchive, tmp)
+        except Exception as e:
+            logging.error("Rejected upload of %s: %s" % (filename, str(e)))
+            raise HTTPError(400, "Invalid save archive: %s" % str(e))
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)  # rename doesn't overwrite on windows
+        os.rename(tmp, path)
+        self._tmpPath = None
+        logging.info("Uploaded save %s (%d bytes)"
+                     % (filename, os.path.getsize(path)))
+        saves.list.invalidate()
+        yield _executor.submit(storage.enforce)
+        self.set_status(201)
+        self.finish({'name': filename[:-4]})
+
+    def _range(self, size):
+        """
+        Return the (start, end) byte range requested by the client, end
+        excluded, or None if the whole file should be sent.
+        Only single ranges are supported, multiple ranges are answered with
+        the whole file. Returns (0, 0) if the range can't be satisfied.
+        """
+        header = self.request.headers.get('Range')
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        ifRange = self.request.headers.get('If-Range')
+        if ifRange is not None and ifRange != self._etag:
+            return None
+        start, _, end = header[6:].strip().partition('-')
+        try:
+            if not start:  # suffix range: last `end` bytes
+                start, end = max(0, size - int(end)), size
+            else:
+                start = int(start)
+                end = min(size, int(end) + 1) if end else size
+        except ValueError:
+            return None
+        if start >= end:
+            return 0, 0
+        return start, end
+
+    @gen.coroutine
+    def get(self, filename, includeBody=True):
+        path = self._path(filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise HTTPError(404)
+        self._etag = '"%x-%x"' % (int(stat.st_mtime * 1000), stat.st_size)
+        self.set_header('Etag', self._etag)
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('Content-Type', 'application/zip')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="%s"' % filename)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        accel = Conf['server']['saves']['accelRedirect']
+        if accel:
+            # the proxy handles the ranges as well
+            self.set_header('X-Accel-Redirect', accel + filename)
+            return
+
+        size = stat.st_size
+        byteRange = self._range(size)
+        if byteRange == (0, 0):
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */%d' % size)
+            return
+        if byteRange is not None:
+            start, end = byteRange
+            self.set_status(206)
+            self.set_header('Content-Range',
+                            'bytes %d-%d/%d' % (start, end - 1, size))
+        else:
+            start, end = 0, size
+        self.set_header('Content-Length', end - start)
+        if not includeBody:
+            return
+
+        chunkSize = Conf['server']['saves']['chunkSize']
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(chunkSize, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                # wait for the chunk to be sent before reading the next one
+                yield self.flush()
+
+    def head(self, filename):
+        return self.get(filename, includeBody=False)
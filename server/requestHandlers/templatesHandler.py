@@ -4,51 +4,143 @@
 
 from __future__ import unicode_literals
 
+"""
+Renders the pages, with the snapshot of the instances, saves and metrics
+(see server.snapshot) embedded in `initData`, so that they show it without
+waiting for their websocket.
+Outside of the debug state, the rendered pages are cached by route,
+arguments, version of the snapshot data and period of the metrics (see
+`Conf['server']['templates']['ttl']`), and answered with a weak ETag: an
+unchanged page gets a 304 without being rendered again.
+"""
+
+from tornado import gen
 from tornado.web import RequestHandler, HTTPError
 
+import os
+import json
+import hashlib
 import logging
 
-from conf import Conf
+from conf import Conf, getIp
+from server import memory, rpc, snapshot
+from server.requestHandlers.assetsHandler import templatesUrl
+from tools import clientTemplates
+
+TEMPLATES_FOLDER = os.path.join('http', 'templates')
+
+_templatesVersion = None
+
+
+def templatesVersion():
+    """
+    Return the most recent modification time of the templates, so that the
+    cached pages and their ETag change after an update.
+    """
+    global _templatesVersion
+    if _templatesVersion is None:
+        _templatesVersion = max(
+            os.path.getmtime(os.path.join(TEMPLATES_FOLDER, filename))
+            for filename in os.listdir(TEMPLATES_FOLDER))
+    return _templatesVersion
+
+
+@gen.coroutine
+def getSnapshot():
+    """
+    Return the snapshot embedded in the pages, from the main process in the
+    multi-worker mode. None if it can't be read: the pages load it through
+    their websocket instead.
+    """
+    client = rpc.client()
+    try:
+        if client is not None:
+            data = yield client.snapshot()
+        else:
+            data = snapshot.get()
+    except Exception as e:
+        logging.error("Unable to get the snapshot of the pages: %s" % str(e))
+        data = None
+    raise gen.Return(data)
 
 
 class TemplatesHandler(RequestHandler):
     """Handle the requests of the root page"""
-    def _getInitData(self):
+    templateRoutes = {
+        'join': 'join.html',
+        'manage': 'manage.html',
+        'saves': 'base.html',
+        'monitor': 'base.html'
+    }
+    fullWidth = ['']
+
+    def get_template_namespace(self):
+        namespace = super(TemplatesHandler, self).get_template_namespace()
+        namespace['templatesUrl'] = templatesUrl
+        return namespace
+
+    def _getInitData(self, data):
         return dict(
             port=Conf['server']['port'], ip=Conf['server']['ip'],
-            factorioPorts=Conf['factorio']['allowedPorts'])
+            factorioPorts=Conf['factorio']['allowedPorts'],
+            snapshot=data,
+            # safe in a <script> element
+            snapshotJson=json.dumps(data).replace('</', '<\\/'))
 
-    def get(self, filename=None):
-        templateRoutes = {
-            'join': 'join.html',
-            'manage': 'manage.html',
-            'saves': 'base.html',
-            'monitor': 'base.html'
-        }
-        fullWidth = ['']
+    def _route(self, filename):
+        """
+        Return the template and the arguments rendering the page of the
+        given path.
+        """
         if filename is None or not filename:
-            self.render(
-                'join.html', currentPage='home', fullWidth=False,
-                initData=self._getInitData())
-        elif filename in templateRoutes:
-            self.render(templateRoutes[filename],
-                        currentPage=filename,
-                        debug=Conf['state'] == 'DEBUG',
-                        initData=self._getInitData(),
-                        fullWidth=filename in fullWidth)
-        elif filename.split('/')[0] in templateRoutes:
+            return 'join.html', dict(currentPage='home', fullWidth=False)
+        elif filename in self.templateRoutes:
+            return self.templateRoutes[filename], dict(
+                currentPage=filename, debug=Conf['state'] == 'DEBUG',
+                fullWidth=filename in self.fullWidth)
+        elif filename.split('/')[0] in self.templateRoutes:
             splitted = filename.split('/')
             filename, args = splitted[0], splitted[1:]
             kwtargs = {
                 arg.split('=')[0]: arg.split('=')[1]
                 for arg in args if len(arg.split('=')) > 1
             }
-            self.render(
-                templateRoutes[filename],
+            kwtargs.update(
                 currentPage=filename, debug=Conf['state'] == 'DEBUG',
-                initData=self._getInitData(),
-                fullWidth=filename in fullWidth,
-                **kwtargs)
-        else:
-            logging.error("Unable to find item %s" % filename)
-            raise HTTPError(404)
+                fullWidth=filename in self.fullWidth)
+            return self.templateRoutes[filename], kwtargs
+        logging.error("Unable to find item %s" % filename)
+        raise HTTPError(404)
+
+    @gen.coroutine
+    def get(self, filename=None):
+        template, kwargs = self._route(filename)
+        # requested before the server resolved it
+        if not Conf['server']['ip']:
+            Conf['server']['ip'] = getIp(Conf['server']['adapter'])
+        data = yield getSnapshot()
+        if Conf['state'] == 'DEBUG':  # the templates are recompiled
+            self.render(template, initData=self._getInitData(data), **kwargs)
+            return
+        options = Conf['server']['templates']
+        # the metrics shown by the navbar, renewed every ttl
+        metricsPeriod = None
+        if data and data['metrics']:
+            metricsPeriod = int(data['metrics']['ts'] // options['ttl'])
+        key = json.dumps([
+            template, sorted(kwargs.items()),
+            data['dataVersion'] if data else None, metricsPeriod,
+            templatesVersion(),
+            clientTemplates.version(Conf['server']['assets']['templates']),
+            Conf['server']['ip']])
+        self.set_header('Etag', 'W/"%s"' % hashlib.sha1(
+            key.encode('utf8')).hexdigest())
+        self.set_header('Cache-Control', 'no-cache')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        page = memory.getCache(
+            'templates', ttl=options['ttl'], maxSize=options['cacheSize'],
+        ).getOrCompute(key, lambda: self.render_string(
+            template, initData=self._getInitData(data), **kwargs))
+        self.finish(page)
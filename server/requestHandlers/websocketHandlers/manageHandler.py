@@ -3,16 +3,189 @@
 from __future__ import unicode_literals
 
 import logging
-import time
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 from tornado.web import HTTPError
 from tornado.ioloop import IOLoop
 
+from server import supervisor, hibernation, metrics, bulk, cluster, \
+    forwarder, codec
 from server.model import getService
-from tools import saves, factorio
+from tools import saves, logArchive, diskUsage, storage, verify, \
+    recompress, placement, prewarm, factorio, utils
 
 
-instanceProcess = None
+# runs the long actions, out of the IOLoop thread
+_executor = ThreadPoolExecutor(2)
+# all the living ManageHandler objects, notified of the instance events
+_listeners = set()
+# {ManageHandler: last version sent} of the clients following the changes of
+# the instance store (see ManageHandler.execSync)
+_subscribers = {}
+_syncScheduled = False
+
+
+def broadcast(message, error=None):
+    """
+    Write the message (and the error message, if any) to all the connected
+    manage clients. In the multi-worker mode, it is published once to each
+    worker (see server.rpc).
+    The message is encoded once for each encoding used by the clients, see
+    server.codec.
+    """
+    published = set()
+    message = codec.Message(dict(message,
+                                 handlerKey=ManageHandler.handlerKey))
+    for listener in list(_listeners):
+        try:
+            if listener.publisher is not None:
+                if listener.publisher not in published:
+                    published.add(listener.publisher)
+                    listener.publisher(message, error)
+                continue
+            listener.writeMessage(message)
+            if error is not None:
+                listener.error(error)
+        except Exception as e:
+            logging.warning("Unable to notify manage client: %s" % str(e))
+            _listeners.discard(listener)
+
+
+def syncMessage(version):
+    """
+    Return the 'sync' message bringing a client from the given version of the
+    instance store to the current one: only the changed and deleted
+    instances, or a full snapshot if the changes since that version aren't
+    known.
+    """
+    service = getService('instance')
+    current = service.version()
+    changes = service.changesSince(version)
+    if changes is None:
+        return {
+            'action': 'sync',
+            'version': current,
+            'snapshot': True,
+            'instances': service.getAll(),
+            'deleted': []
+        }
+    return {
+        'action': 'sync',
+        'version': current,
+        'snapshot': False,
+        'instances': changes[0],
+        'deleted': changes[1]
+    }
+
+
+def publishChanges():
+    """
+    Send the pending changes of the instance store to the subscribed
+    clients. Clients at the same version share the same message.
+    """
+    global _syncScheduled
+    _syncScheduled = False
+    current = getService('instance').version()
+    messages = {}
+    for handler, version in _subscribers.items():
+        if version >= current:
+            continue
+        if version not in messages:
+            messages[version] = syncMessage(version)
+        try:
+            handler.writeMessage(messages[version])
+            _subscribers[handler] = messages[version]['version']
+        except Exception as e:
+            logging.warning("Unable to sync manage client: %s" % str(e))
+            _subscribers.pop(handler, None)
+
+
+def scheduleSync():
+    """
+    Listener of the changes of the instance store: publish them once the
+    current IOLoop callback is done, so that successive writes are sent
+    together.
+    """
+    global _syncScheduled
+    if not _syncScheduled and _subscribers:
+        _syncScheduled = True
+        IOLoop.current().add_callback(publishChanges)
+
+
+def _forwardLogs(process):
+    while True:
+        data = process.read()
+        if data is None:
+            break
+        logging.info('[Instance] %s' % data)
+        logArchive.append(process._id, data)
+        supervisor.onOutput(process._id, data)
+        broadcast({
+            'action': 'log',
+            'message': data
+        })
+
+
+def pumpInstanceLogs():
+    """
+    Forward the output of the running instances to their archive and to all
+    the connected clients.
+    Scheduled on the IOLoop every `Conf['scheduler']['logPumpInterval']`
+    seconds, whether or not a client is connected.
+    """
+    for process in supervisor.running():
+        _forwardLogs(process)
+
+
+def onInstanceEvent(event, instanceId, **info):
+    """
+    Listener of the supervisor events (see server.supervisor), reporting
+    them to the connected clients.
+    """
+    if event == 'exited':
+        return _forwardLogs(info['process'])
+    instance = getService('instance').getById(instanceId)
+    if event == 'crashed' and info['restartIn'] is None:
+        error = "Instance %s keeps crashing (exit code: %d), it won't be " \
+            "restarted." % (instance['name'], info['exitCode'])
+    elif event == 'crashed':
+        error = "Instance %s stopped unexpectedly (exit code: %d), " \
+            "restarting in %ds." % (instance['name'], info['exitCode'],
+                                     info['restartIn'])
+    elif event == 'replaced' and info['error'] is not None:
+        error = "Unable to replace instance %s: %s" % (instance['name'],
+                                                       info['error'])
+    else:
+        error = None
+    broadcast({
+        'action': 'start' if event in ('started', 'restarted', 'replaced')
+        else 'kill',
+        'instances': [instance]
+    }, error=error)
+
+
+def backupInstance():
+    """
+    Backup the save of the running instances. Scheduled on a worker thread
+    every `Conf['factorio']['autosaveInterval']` minutes.
+    """
+    for process in supervisor.running():
+        process.backupSave()
+
+
+def prewarmInstances():
+    """
+    Pre-warm the files of the instances that are not running, ahead of the
+    expected play times. Scheduled on the IOLoop at the times of
+    `Conf['prewarm']['schedule']`, the files are read on a worker thread.
+    """
+    paths = []
+    for instance in getService('instance').getAll():
+        if supervisor.get(instance['_id']) is None:
+            paths += factorio.prewarmTargets(instance['save'])
+    if paths:
+        _executor.submit(prewarm.prewarm, paths)
 
 
 class ManageHandler(object):
@@ -20,17 +193,36 @@ class ManageHandler(object):
 
     handlerKey = 'manage'
 
-    def __init__(self, writeMessage, error):
+    def __init__(self, writeMessage, error, publisher=None):
         super(ManageHandler, self).__init__()
 
         self.writeMessage = writeMessage
         self.error = error
-        self.instLogtimeout = None
+        # writes to all the connections of the same worker, see `broadcast`
+        self.publisher = publisher
+        _listeners.add(self)
+
+    def onClose(self):
+        _listeners.discard(self)
+        _subscribers.pop(self, None)
 
-        if instanceProcess is not None and not \
-                instanceProcess.killed.value:
-            self.instLogtimeout = IOLoop.current().add_timeout(
-                time.time() + 2, self._logInstance)
+    def execSync(self, message):
+        """
+        Subscribe to the changes of the instance store. The message may hold
+        the field `version`: last version of the store seen by the client,
+        after a reconnection for instance.
+        Writes back a 'sync' message with the changes since that version
+        (see `syncMessage`), then a new one after each change:
+        * 'action': 'sync'
+        * 'version': current version of the store
+        * 'snapshot': true if 'instances' holds all the instances, in which
+          case the client should drop the others
+        * 'instances': changed instances, or all of them
+        * 'deleted': ids of the deleted instances
+        """
+        response = syncMessage(message.get('version'))
+        _subscribers[self] = response['version']
+        self.writeMessage(response)
 
     def execLoad(self, message):
         """
@@ -39,6 +231,7 @@ class ManageHandler(object):
         any other possible length if '*' is given as an _id in which case all
         available instances will be returned.
         This action requires the field `_id` to be set.
+        The 'sync' action should be preferred to follow the instances.
 
         The message written back will have the following structure:
         * 'instances': list of instance documents as returned by the database
@@ -55,17 +248,35 @@ class ManageHandler(object):
             'action': 'load'
         })
 
-    def execListSaves(self, _):
+    def execListSaves(self, message):
         """
-        Returns the list of existing saves on the server
+        Returns the list of existing saves on the server, or on the host
+        given by the optional field `host` (see server.cluster).
         The message will have the following structure:
         * 'saves': list of saves (see tools.saves.list() doc)
+        * 'host': host of the saves, None for the server
         * 'action': 'listsaves'
         """
-        self.writeMessage({
-            'saves': saves.list(),
-            'action': 'listsaves'
-        })
+        host = message.get('host')
+        if host in (None, factorio.LOCAL):
+            return self.writeMessage({
+                'saves': saves.list(),
+                'host': host,
+                'action': 'listsaves'
+            })
+
+        def done(future):
+            try:
+                hostSaves = future.result()
+            except Exception as e:
+                return self.error("Unable to list the saves of %s: %s"
+                                  % (host, str(e)))
+            self.writeMessage({
+                'saves': hostSaves,
+                'host': host,
+                'action': 'listsaves'
+            })
+        IOLoop.current().add_future(cluster.call(host, 'saves'), done)
 
     def execSave(self, message):
         """
@@ -74,23 +285,36 @@ class ManageHandler(object):
         * name: name of the instance
         * port: selected port for this instance
         * save: selected save for this instance
+        * cores: optional, cpus to pin the instance to (eg: '2,3' or '4-7',
+          see tools.placement), automatic placement if empty
+        * host: optional, host to run the instance on (see server.cluster),
+          the least loaded one when it first starts if empty
         If `_id` field is given as well, the instance will be updated instead.
         Note that updating a running instance will have no effect until it is
-        restarted.
+        restarted, except for its cores which are changed immediately.
         Returned message will hold the fields:
         * 'action': 'save'
         * 'instances': [saved data as a list of a single element for
                         consistency with the `load` action.]
         """
+        cores = message['data'].get('cores') or None
+        host = message['data'].get('host') or None
+        if host is not None and not cluster.exists(host):
+            raise Exception("Unknown host: %s" % host)
+        if cores is not None and host in (None, factorio.LOCAL):
+            # normalized, raises if invalid. The agents check their own.
+            cores = placement.formatCores(placement.parseCores(cores))
         if '_id' in message['data']:
             _id = message['data']['_id']
             getService('instance').update(
                 message['data']['_id'], name=message['data']['name'],
-                save=message['data']['save'], port=message['data']['port'])
+                save=message['data']['save'], port=message['data']['port'],
+                cores=cores, host=host)
+            supervisor.place(_id)
         else:
             _id = getService('instance').insert(
                 name=message['data']['name'], save=message['data']['save'],
-                port=message['data']['port'])
+                port=message['data']['port'], cores=cores, host=host)
         self.writeMessage({
             'action': 'save',
             'instances': [getService('instance').getById(_id)]
@@ -109,64 +333,179 @@ class ManageHandler(object):
             '_id': message['_id']
         })
 
-    def _logInstance(self):
-        if instanceProcess is None:
-            return
+    def execSearchLogs(self, message):
+        """
+        Search the output archive of an instance.
+        The message should hold the field `_id` of the instance and may hold
+        the following optional fields:
+        * query: full text query (sqlite FTS syntax, eg: 'error OR desync')
+        * start: only return lines written after this timestamp
+        * end: only return lines written before this timestamp
+        * limit: max number of lines returned (200 by default)
+        Runs in the background, then writes back a message with the fields:
+        * 'action': 'searchlogs'
+        * '_id': id of the instance
+        * 'lines': list of matching lines (see tools.logArchive.search doc)
+        """
+        def done(future):
+            try:
+                lines = future.result()
+            except Exception as e:
+                if not isinstance(e, logArchive.LogArchiveException):
+                    logging.exception(e)
+                return self.error("Unable to search the logs: %s" % str(e))
+            self.writeMessage({
+                'action': 'searchlogs',
+                '_id': message['_id'],
+                'lines': lines
+            })
+        IOLoop.current().add_future(_executor.submit(
+            logArchive.search, message['_id'], query=message.get('query'),
+            start=message.get('start'), end=message.get('end'),
+            limit=message.get('limit', 200)), done)
+
+    def execDiskUsage(self, _):
+        """
+        Compute the disk usage of each instance: its save file and backups,
+        and its output archive. Only the folders that changed since the
+        previous call are listed again (see `tools.diskUsage`), so the
+        dashboard can poll this action. The folders are listed in the
+        background, then the message is written back with the fields:
+        * 'action': 'diskusage'
+        * 'usage': dict {instance _id: {'saves': bytes, 'logs': bytes,
+                                        'total': human readable total}}
+        """
+        instances = getService('instance').getAll()
 
-        data = instanceProcess.read()
-        if data is not None:
-            logging.info('[Instance] %s' % data)
+        def compute():
+            usage = {}
+            for instance in instances:
+                prefix = '%s.zip' % instance['save']
+                savesSize = diskUsage.filesSize(
+                    saves.savesFolder, lambda name: name.startswith(prefix))
+                logsSize = diskUsage.folderSize(
+                    os.path.join(logArchive.archiveFolder, instance['_id']))
+                usage[instance['_id']] = {
+                    'saves': savesSize,
+                    'logs': logsSize,
+                    'total': utils.sizeFormat(savesSize + logsSize)
+                }
+            return usage
+
+        def done(future):
+            try:
+                usage = future.result()
+            except Exception as e:
+                logging.exception(e)
+                return self.error("Unable to compute the disk usage: %s"
+                                  % str(e))
             self.writeMessage({
-                'action': 'log',
-                'message': data
+                'action': 'diskusage',
+                'usage': usage
             })
+        IOLoop.current().add_future(_executor.submit(compute), done)
+
+    def execStorage(self, _):
+        """
+        Returns the size ledger of the saves folder. The folder is listed
+        in the background, then the message is written back with the fields:
+        * 'action': 'storage'
+        * 'total', 'free': size of the saves and free disk space in bytes
+        * 'families': {family: size in bytes} (see tools.storage.family)
+        * 'instances': {instance _id: size of its save family in bytes}
+        * 'evictions': most recent evictions (see tools.storage.evict)
+        """
+        instances = getService('instance').getAll()
 
-        if not instanceProcess.is_alive():
-            logging.warning(
-                "Cannot find instance log, process isn't alive anymore.")
-            getService('instance').set(instanceProcess._id, 'status', 'stopped')
+        def compute():
+            current = storage.ledger()
+            return {
+                'action': 'storage',
+                'total': current['total'],
+                'free': current['free'],
+                'families': {fam: data['size'] for fam, data
+                             in current['families'].iteritems()},
+                'instances': storage.instancesLedger(instances, current),
+                'evictions': storage.lastEvictions()
+            }
+
+        def done(future):
+            try:
+                message = future.result()
+            except Exception as e:
+                logging.exception(e)
+                return self.error("Unable to read the storage ledger: %s"
+                                  % str(e))
+            self.writeMessage(message)
+        IOLoop.current().add_future(_executor.submit(compute), done)
+
+    def execVerify(self, _):
+        """
+        Check the integrity of all the saves of the saves folder (see
+        tools.verify). Runs in the background, the message is written back
+        once all saves are checked, with the fields:
+        * 'action': 'verify'
+        * 'saves': {save filename: {'valid': bool, 'error': message or None}}
+        """
+        def done(future):
+            try:
+                results = future.result()
+            except Exception as e:
+                logging.exception(e)
+                return self.error("Unable to verify the saves: %s" % str(e))
             self.writeMessage({
-                'action': 'kill',
-                'instances': [
-                    getService('instance').getById(instanceProcess._id)]
+                'action': 'verify',
+                'saves': {name: {'valid': valid, 'error': error}
+                          for name, (valid, error) in results.iteritems()}
             })
-            self.error("Instance seems to have stopped unexpectedly and "
-                       "prematurely.")
-            return
+        IOLoop.current().add_future(_executor.submit(verify.sweep), done)
 
-        self.instLogtimeout = IOLoop.current().add_timeout(
-            time.time() + 2, self._logInstance)
+    def execUnpack(self, message):
+        """
+        Restore a backup packed by tools.recompress into a regular save.
+        The message should hold the field `filename`: name of the packed
+        backup in the saves folder. Runs in the background, then writes back
+        the message:
+        * 'action': 'unpack'
+        * 'filename': name of the restored save file
+        * 'saves': updated list of saves (see tools.saves.list() doc)
+        """
+        filename = os.path.basename(message['filename'])
+        if not filename.endswith(recompress.SUFFIX):
+            raise Exception("%s is not a packed backup" % filename)
+
+        def done(future):
+            try:
+                path = future.result()
+            except Exception as e:
+                logging.exception(e)
+                return self.error("Unable to unpack %s: %s"
+                                  % (filename, str(e)))
+            saves.list.invalidate()
+            self.writeMessage({
+                'action': 'unpack',
+                'filename': os.path.basename(path),
+                'saves': saves.list()
+            })
+        IOLoop.current().add_future(_executor.submit(
+            recompress.unpack,
+            os.path.join(saves.savesFolder, filename)), done)
 
     def execStart(self, message):
         """
-        Start a factorio instance.
-        If a running instance is already existing, attempt to kill it first via
-        ctrl+c to trigger data saving.
-        There might be data loss when starting an instance while another one
-        is running, use carefully.
+        Start a factorio instance, supervised by server.supervisor: it is
+        restarted automatically if it crashes.
+        Instances can run simultaneously as long as they use different ports.
+        A hibernating instance (see server.hibernation) is woken up.
         Requires the messsage to hold the field `_id` denoting which instance
         to start
-        Write back the data for all instances in database
-        """
-        global instanceProcess
-        if self.instLogtimeout:
-            IOLoop.current().remove_timeout(self.instLogtimeout)
-        if instanceProcess is not None and not \
-                instanceProcess.killed.value:
-            raise Exception(
-                "An instance is already running (pid: %d, _id=%s)" % (
-                    instanceProcess.subpid.value,
-                    instanceProcess._id))
-        data = getService('instance').getById(message['_id'])
-        instanceProcess = factorio.Instance(
-            data['port'], data['save'], data['_id'])
-        instanceProcess.start()
-        self.instLogtimeout = IOLoop.current().add_timeout(
-            time.time() + 2, self._logInstance)
-        getService('instance').set(message['_id'], 'status', 'running')
+        Write back the data of the instance
+        """
+        hibernation.cancel(message['_id'])
+        supervisor.start(message['_id'])
         self.writeMessage({
             'action': 'start',
-            'instances': getService('instance').getAll()
+            'instances': [getService('instance').getById(message['_id'])]
         })
 
     def execKill(self, message):
@@ -174,31 +513,284 @@ class ManageHandler(object):
         Kill a running factorio instance.
         Requires the messsage to hold the field `_id` denoting which instance
         to kill
-        Write back the data for all instances in database
+        Write back the data of the instance
         """
-        getService('instance').set(message['_id'], 'status', 'stopped')
+        found = hibernation.cancel(message['_id'])
+        found = supervisor.stop(message['_id']) or found
+        self.writeMessage({
+            'action': 'kill',
+            'instances': [getService('instance').getById(message['_id'])]
+        })
+        if not found:
+            raise Exception("No running instance found")
 
-        if instanceProcess is None:
+    def execReplace(self, message):
+        """
+        Restart a running instance without closing its port (see
+        server.supervisor.replace), eg: after editing its config or
+        restoring its save. Requires the forwarder to be enabled (see
+        `Conf['factorio']['forwarder']`).
+        Requires the message to hold the field `_id` of the instance. It
+        may hold the field `backup`: False to boot from the save as it is,
+        without the latest autosave (default: True).
+        Write back the message {'action': 'replace', '_id': id of the
+        instance}, then the data of the instance once replaced.
+        """
+        supervisor.replace(message['_id'], message.get('backup', True))
+        self.writeMessage({
+            'action': 'replace',
+            '_id': message['_id']
+        })
+
+    def execForwarder(self, _):
+        """
+        Returns the counters of the relayed ports (see server.forwarder).
+        Write back a message with the fields:
+        * 'action': 'forwarder'
+        * 'enabled': whether the ports are relayed
+        * 'ports': {public port: {'backendPort', 'sessions', 'in', 'out',
+          'dropped', 'switchedAt'}}, 'in' and 'out' being {'packets',
+          'bytes'}
+        """
+        self.writeMessage({
+            'action': 'forwarder',
+            'enabled': forwarder.enabled(),
+            'ports': forwarder.stats() if forwarder.enabled() else {}
+        })
+
+    def _bulk(self, action, instanceIds):
+        """
+        Run the action on the instances with bounded concurrency (see
+        server.bulk), streaming the progress of each instance with the
+        messages:
+        * 'action': 'bulkprogress'
+        * 'operation': id of the bulk operation
+        * '_id': id of the instance
+        * 'step': 'stopping', 'starting', 'replacing' or 'done'
+        * 'result': once done, 'ok', 'skipped', 'failed' or 'timeout'
+        * 'error': error message if it failed
+        * 'done', 'total': number of instances done, and in total
+        Once all are done, writes back the message:
+        * 'action': 'bulk'
+        * 'operation': id of the bulk operation
+        * 'results': {instance _id: result}
+        * 'instances': data of the instances of the operation
+        """
+        operation = {}
+
+        def write(message):
+            try:
+                self.writeMessage(message)
+            except Exception as e:  # the client is gone, keep going
+                logging.warning("Unable to report bulk progress: %s" % str(e))
+
+        def onProgress(instanceId, step, result=None, error=None):
+            write({
+                'action': 'bulkprogress',
+                'operation': operation.get('_id'),
+                '_id': instanceId,
+                'step': step,
+                'result': result,
+                'error': error,
+                'done': len(operation['bulk'].results)
+                if 'bulk' in operation else 0,
+                'total': len(instanceIds)
+            })
+
+        def onDone(results):
+            write({
+                'action': 'bulk',
+                'operation': operation.get('_id'),
+                'results': results,
+                'instances': [i for i in getService('instance').getAll()
+                              if i['_id'] in results]
+            })
+
+        operation['bulk'] = bulk.BulkOperation(
+            action, instanceIds, onProgress, onDone)
+        operation['_id'] = operation['bulk']._id
+        operation['bulk'].start()
+
+    def _bulkIds(self, message):
+        if message.get('_ids', '*') == '*':
+            return [i['_id'] for i in getService('instance').getAll()]
+        return message['_ids']
+
+    def execStartMany(self, message):
+        """
+        Start many instances, `Conf['manage']['bulk']['parallelism']` at a
+        time. The message may hold the field `_ids`: list of the ids of the
+        instances to start, or '*' for all (default). Instances sharing a
+        port can't run together: starting the others fails.
+        See `_bulk` for the messages written back.
+        """
+        self._bulk('start', self._bulkIds(message))
+
+    def execKillMany(self, message):
+        """
+        Kill many instances, `Conf['manage']['bulk']['parallelism']` at a
+        time. The message may hold the field `_ids`: list of the ids of the
+        instances to kill, or '*' for all (default).
+        See `_bulk` for the messages written back.
+        """
+        self._bulk('kill', self._bulkIds(message))
+
+    def execRestartAll(self, _):
+        """
+        Restart all the running instances, eg: after an update of factorio,
+        `Conf['manage']['bulk']['parallelism']` at a time. With the forwarder
+        enabled, the local instances are replaced without closing their
+        port (see server.supervisor.replace).
+        See `_bulk` for the messages written back.
+        """
+        self._bulk('restart', [p._id for p in supervisor.running()])
+
+    def execIncidents(self, message):
+        """
+        Returns the unexpected stops of an instance and their recovery (see
+        server.supervisor). The message should hold the field `_id` of the
+        instance.
+        Write back a message with the fields:
+        * 'action': 'incidents'
+        * '_id': id of the instance
+        * 'incidents': most recent incidents first (see
+          server.services.incidentService schema)
+        * 'summary': count of incidents and time to recover statistics
+        """
+        self.writeMessage({
+            'action': 'incidents',
+            '_id': message['_id'],
+            'incidents': getService('incident').getByInstance(message['_id']),
+            'summary': getService('incident').summary(message['_id'])
+        })
+
+    def execPlacement(self, _):
+        """
+        Returns the cpu placement of the running instances (see
+        tools.placement).
+        Write back a message with the fields:
+        * 'action': 'placement'
+        * 'instances': {instance _id: {'host': host it runs on, 'cores':
+          assigned cpus, 'current': {'cores': cpus, 'nice': nice value}
+          actual placement, on this host only}}
+        * 'topology': physical cores of the host, as lists of logical cpus
+        * 'reserved': cpus kept for the web server
+        * 'load': usage percentage of each logical cpu
+        """
+        reserved = placement.reserved()
+        self.writeMessage({
+            'action': 'placement',
+            'instances': supervisor.placements(),
+            'topology': placement.topology(),
+            'reserved': placement.formatCores(reserved),
+            'load': metrics.latest()['CPUs']
+        })
+
+    def execPrewarm(self, message):
+        """
+        Pre-warm the page cache with the files read when starting the
+        instance with the `_id` given in the message (see tools.prewarm), so
+        that it starts faster. Sent by the page as soon as the operator
+        points at an instance. Runs in the background, then writes back:
+        * 'action': 'prewarm'
+        * '_id': id of the instance
+        * 'stats': files, size, part already resident and duration (see
+          tools.prewarm.prewarm)
+        """
+        _id = message['_id']
+        paths = factorio.prewarmTargets(
+            getService('instance').getById(_id)['save'])
+
+        def done(future):
+            try:
+                stats = future.result()
+            except Exception as e:
+                logging.exception(e)
+                return self.error("Unable to pre-warm: %s" % str(e))
             self.writeMessage({
-                'action': 'kill',
-                'instances': getService('instance').getAll()
+                'action': 'prewarm',
+                '_id': _id,
+                'stats': stats
             })
-            raise Exception("No running instance found")
-        instanceProcess.kill()
+        IOLoop.current().add_future(
+            _executor.submit(prewarm.prewarm, paths), done)
 
-        if self.instLogtimeout:
-            IOLoop.current().remove_timeout(self.instLogtimeout)
+    def execHosts(self, _):
+        """
+        Returns the hosts the instances can run on (see server.cluster).
+        Write back a message with the fields:
+        * 'action': 'hosts'
+        * 'hosts': list of {'name', 'address', 'connected', 'cpus', 'CPU',
+          'MEM', 'instances': number of running instances}
+        """
+        self.writeMessage({
+            'action': 'hosts',
+            'hosts': cluster.hosts(supervisor.running())
+        })
+
+    def execHostMetrics(self, message):
+        """
+        Returns the metrics history of the host given by the field `host`
+        (see server.cluster). The message may hold the field `since`: only
+        the samples taken after this timestamp are returned, and the field
+        `columns`: if true, the history is sent by columns (see
+        server.metrics.columns), packed by the msgpack encoding.
+        Write back a message with the fields:
+        * 'action': 'hostmetrics'
+        * 'host': name of the host
+        * 'history': samples, oldest first (see server.metrics.history)
+        """
+        host = message['host']
 
+        def write(history):
+            if message.get('columns'):
+                history = metrics.columns(history)
+            self.writeMessage({
+                'action': 'hostmetrics',
+                'host': host,
+                'history': history
+            })
+        if host == factorio.LOCAL:
+            return write(metrics.history(message.get('since')))
+
+        def done(future):
+            try:
+                history = future.result()
+            except Exception as e:
+                return self.error("Unable to get the metrics of %s: %s"
+                                  % (host, str(e)))
+            write(history)
+        IOLoop.current().add_future(cluster.call(
+            host, 'metrics', since=message.get('since')), done)
+
+    def execHibernations(self, message):
+        """
+        Returns the results of the idle hibernation (see server.hibernation),
+        for the instance with the `_id` given in the message if any, for all
+        the instances otherwise.
+        Write back a message with the fields:
+        * 'action': 'hibernations'
+        * '_id': id of the instance, None for all the instances
+        * 'summary': count, time spent hibernating, memory saved and wake
+          latency (see server.services.hibernationService.summary)
+        * 'players': names of the connected players, if `_id` is given
+        """
+        _id = message.get('_id')
         self.writeMessage({
-            'action': 'kill',
-            'instances': getService('instance').getAll()
+            'action': 'hibernations',
+            '_id': _id,
+            'summary': getService('hibernation').summary(_id),
+            'players': hibernation.players(_id) if _id is not None else None
         })
 
     def onMessage(self, message):
         """
         The message should hold the following field:
         * action: action to perform, can be any of 'load', 'save', 'kill',
-          'start', 'listsaves'
+          'start', 'listsaves', 'searchlogs', 'diskusage', 'storage',
+          'verify', 'unpack', 'incidents', 'hibernations', 'placement',
+          'prewarm', 'startmany', 'killmany', 'restartall', 'sync', 'hosts',
+          'hostmetrics', 'replace', 'forwarder'
         More fields may be required depending on the action. See corresponding
         method documentation for details.
         """
@@ -209,7 +801,24 @@ class ManageHandler(object):
             'load': self.execLoad,
             'kill': self.execKill,
             'start': self.execStart,
-            'listsaves': self.execListSaves
+            'listsaves': self.execListSaves,
+            'searchlogs': self.execSearchLogs,
+            'diskusage': self.execDiskUsage,
+            'storage': self.execStorage,
+            'verify': self.execVerify,
+            'unpack': self.execUnpack,
+            'incidents': self.execIncidents,
+            'hibernations': self.execHibernations,
+            'placement': self.execPlacement,
+            'prewarm': self.execPrewarm,
+            'startmany': self.execStartMany,
+            'killmany': self.execKillMany,
+            'restartall': self.execRestartAll,
+            'sync': self.execSync,
+            'hosts': self.execHosts,
+            'hostmetrics': self.execHostMetrics,
+            'replace': self.execReplace,
+            'forwarder': self.execForwarder
         }
         if message['action'] in actions:
             return actions[message['action']](message)
@@ -4,9 +4,7 @@ from __future__ import unicode_literals
 
 import logging
 
-import psutil
-
-psutil.cpu_percent(interval=0.1)
+from server import memory, metrics, scheduler
 
 
 class SystemUsageHandler(object):
@@ -20,16 +18,28 @@ class SystemUsageHandler(object):
         self.writeMessage = writeMessage
 
     def systemUsage(self):
-        return {
-            'CPU': psutil.cpu_percent(),
-            'MEM': psutil.virtual_memory().percent
-        }
+        usage = metrics.latest()
+        del usage['ts']
+        del usage['CPUs']
+        return usage
+
+    def detailedSystemUsage(self):
+        usage = self.systemUsage()
+        usage['CPUs'] = metrics.latest()['CPUs']
+        usage['caches'] = memory.stats()
+        usage['jobs'] = scheduler.stats()
+        return usage
 
     def onMessage(self, message):
         """
         The message should hold the field 'detailed' as a boolean.
         If true, all the following information will be available:
-        <TODO>
+        * `CPU`, `MEM`: see below
+        * `CPUs`: list of float, usage percentage of each logical cpu
+        * `caches`: hit/miss/eviction statistics of the server caches by
+          namespace (see `server.memory.Memory.stats`)
+        * `jobs`: run statistics of the scheduled jobs by name (see
+          `server.scheduler.Job.stats`)
         If false, only the following information will be available:
         * `CPU`:float, cpu usage percentage
         * `MEM`:float memory usage percentage
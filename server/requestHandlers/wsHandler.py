@@ -9,6 +9,7 @@ import time
 
 from tornado.websocket import WebSocketHandler
 
+from server import rpc, codec
 from server.requestHandlers.websocketHandlers.echoHandler import EchoHandler
 from server.requestHandlers.websocketHandlers.systemUsageHandler import \
     SystemUsageHandler
@@ -17,20 +18,20 @@ from server.requestHandlers.websocketHandlers.manageHandler import \
 from tools import utils
 
 
-class WSHandler(WebSocketHandler):
+class Session(object):
     """
-    Entry point all websocket communications
-    The websocket handlers (in the submodule `websocketHandlers`) will be
-    instanciated and bound to a handlerKey.
-    The classes in this module should have this `handlerKey` property
-    available on the class level.
-    Each message transmitted between the client and the server will have
-    to send this value back and force to know which part of the application
-    should handle the message. The messages will be json-encoded dict/objects
-    that should hold this field.
+    The websocket handlers (in the submodule `websocketHandlers`) of a
+    connection, bound to their handlerKey.
+    * writeMessage(message, handlerKey): writes to the connection
+    * error(message): writes an error message to the connection
+    * publisher: in the multi-worker mode, writes a codec.Message (and an
+      error message, if any) to all the connections of the worker of this
+      one (see server.rpc)
     """
-    def open(self):
-        logging.info("WebSocket opened")
+    def __init__(self, writeMessage, error, publisher=None):
+        super(Session, self).__init__()
+        self.writeMessage = writeMessage
+        self.error = error
         self._handlers = {
             EchoHandler.handlerKey: EchoHandler(
                 partial(self.writeMessage, handlerKey=EchoHandler.handlerKey),
@@ -42,18 +43,10 @@ class WSHandler(WebSocketHandler):
             ManageHandler.handlerKey: ManageHandler(
                 partial(self.writeMessage,
                         handlerKey=ManageHandler.handlerKey),
-                self.error)
+                self.error, publisher)
         }
 
-    def writeMessage(self, message, handlerKey):
-        """ Write a message for the handler given by `handlerKey` """
-        message['handlerKey'] = handlerKey
-        self.write_message(json.dumps(message))
-
-    def error(self, message):
-        self.writeMessage({'message': message}, handlerKey='error')
-
-    def on_message(self, message):
+    def onMessage(self, message):
         t0 = time.time()
         message = json.loads(message)
         try:
@@ -68,5 +61,68 @@ class WSHandler(WebSocketHandler):
                          message['handlerKey'], utils.timeFormat(
                              time.time() - t0))
 
+    def close(self):
+        for handler in self._handlers.itervalues():
+            if hasattr(handler, 'onClose'):
+                handler.onClose()
+
+
+class WSHandler(WebSocketHandler):
+    """
+    Entry point all websocket communications
+    The websocket handlers (in the submodule `websocketHandlers`) will be
+    instanciated and bound to a handlerKey, see `Session`.
+    The classes in this module should have this `handlerKey` property
+    available on the class level.
+    Each message transmitted between the client and the server will have
+    to send this value back and force to know which part of the application
+    should handle the message. The messages will be json-encoded dict/objects
+    that should hold this field.
+    The messages written to the client may be MessagePack-encoded instead,
+    if it proposed the 'msgpack' subprotocol, see server.codec.
+    In the multi-worker mode, the session lives in the main process, see
+    server.rpc.
+    """
+    def initialize(self):
+        self.encoding = codec.JSON
+
+    def select_subprotocol(self, subprotocols):
+        encoding = codec.select(subprotocols)
+        if encoding is not None:
+            self.encoding = encoding
+        return encoding
+
+    def open(self):
+        logging.info("WebSocket opened (%s)" % self.encoding)
+        if rpc.client() is not None:
+            self._session = rpc.client().open(self)
+        else:
+            self._session = Session(self.writeMessage, self.error)
+
+    def writeMessage(self, message, handlerKey):
+        """
+        Write a message for the handler given by `handlerKey`. The message
+        may also be a codec.Message holding its handlerKey, shared with other
+        connections.
+        """
+        if not isinstance(message, codec.Message):
+            message['handlerKey'] = handlerKey
+            message = codec.Message(message)
+        self.writeEncoded(message)
+
+    def writeEncoded(self, message):
+        """ Write a codec.Message, in the encoding of the connection """
+        self.write_message(message.encode(self.encoding),
+                           binary=self.encoding != codec.JSON)
+
+    def error(self, message):
+        self.writeMessage({'message': message}, handlerKey='error')
+
+    def on_message(self, message):
+        if self._session is not None:
+            self._session.onMessage(message)
+
     def on_close(self):
         logging.info("WebSocket closed")
+        if self._session is not None:
+            self._session.close()
@@ -0,0 +1,328 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Local channel between the web workers and the main process, in the
+multi-worker mode (see `Conf['server']['workers']`).
+The workers accept the HTTP and websocket connections, and the main process
+owns the factorio instances, the database and the scheduler. The websocket
+sessions (see server.requestHandlers.wsHandler.Session) live in the main
+process: the workers forward the messages of their connections over a Unix
+socket, and write back what the sessions answer.
+Messages written to all the manage clients (see
+`manageHandler.broadcast`) are published once per worker, which writes
+them to each of its connections. The main process sends the messages
+marshalled, the workers encode them for their connections (at most once
+per encoding, see server.codec).
+
+Each frame is made of a JSON header and a payload, preceded by their sizes.
+The payload is an encoded websocket message if the header has an
+'encoding' (see server.codec), text otherwise. Headers:
+* worker to main process: {'type': 'open' | 'message' | 'close',
+  'session': id}, {'type': 'snapshot'} to get the snapshot embedded in the
+  pages (see server.snapshot)
+* main process to worker: {'type': 'message', 'session': id} to a single
+  connection, {'type': 'publish'} to all of them, with the 'encoding' of
+  the message. {'type': 'snapshot'} answering the snapshot requests in order
+"""
+
+import os
+import json
+import struct
+import socket
+import logging
+import itertools
+from functools import partial
+from collections import deque
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket, add_accept_handler
+from tornado.websocket import WebSocketClosedError
+
+from server import codec
+
+SIZES = struct.Struct(b'>II')
+RECONNECT_DELAY = 1  # in seconds
+
+
+def available():
+    """
+    Return False if the platform can't run the multi-worker mode.
+    """
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class Channel(object):
+    """
+    Framed connection over a stream: the Unix socket of the workers, or the
+    TCP connection to an agent (see server.cluster). `onFrame(channel,
+    header, payload)` is called for each frame received, `onClose(channel)`
+    once the connection is lost.
+    """
+    def __init__(self, stream, onFrame, onClose):
+        super(Channel, self).__init__()
+        self._stream = stream
+        self._onFrame = onFrame
+        self._onClose = onClose
+
+    def start(self):
+        IOLoop.current().add_future(self._read(), lambda f: f.result())
+
+    def send(self, header, payload=''):
+        header = json.dumps(header).encode('utf8')
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf8')
+        try:
+            self._stream.write(
+                SIZES.pack(len(header), len(payload)) + header + payload)
+        except StreamClosedError:
+            pass  # onClose is called by the reader
+
+    def close(self):
+        self._stream.close()
+
+    @gen.coroutine
+    def _read(self):
+        try:
+            while True:
+                sizes = yield self._stream.read_bytes(SIZES.size)
+                headerSize, payloadSize = SIZES.unpack(sizes)
+                header = yield self._stream.read_bytes(headerSize)
+                payload = b''
+                if payloadSize:
+                    payload = yield self._stream.read_bytes(payloadSize)
+                try:
+                    header = json.loads(header.decode('utf8'))
+                    if 'encoding' not in header:
+                        payload = payload.decode('utf8')
+                    self._onFrame(self, header, payload)
+                except Exception as e:
+                    logging.exception(e)
+        except StreamClosedError:
+            pass
+        self._onClose(self)
+
+
+class RpcServer(object):
+    """
+    Main process side: hosts the websocket sessions of the workers.
+    * sessionFactory(writeMessage, error, publisher): creates a session (see
+      wsHandler.Session)
+    * snapshot(): returns the snapshot sent to the workers
+    """
+    def __init__(self, path, sessionFactory, snapshot):
+        super(RpcServer, self).__init__()
+        self._path = path
+        self._sessionFactory = sessionFactory
+        self._snapshot = snapshot
+        self._sessions = {}  # {channel: {session id: session}}
+        # {channel: publisher}, shared by its sessions so that
+        # `manageHandler.broadcast` publishes once per worker
+        self._publishers = {}
+
+    def start(self):
+        sock = bind_unix_socket(self._path)
+        add_accept_handler(sock, self._accept)
+        logging.info("Waiting for the web workers on %s" % self._path)
+
+    def _accept(self, connection, address):
+        channel = Channel(IOStream(connection), self._onFrame, self._onClose)
+        self._sessions[channel] = {}
+        self._publishers[channel] = partial(self._publish, channel)
+        channel.start()
+
+    def _onFrame(self, channel, header, payload):
+        sessions = self._sessions.get(channel)
+        if sessions is None:
+            return
+        if header['type'] == 'snapshot':
+            try:
+                snapshot = self._snapshot()
+            except Exception as e:
+                logging.exception(e)
+                snapshot = None
+            return channel.send({'type': 'snapshot'}, json.dumps(snapshot))
+        sessionId = header['session']
+        if header['type'] == 'open':
+            sessions[sessionId] = self._sessionFactory(
+                partial(self._write, channel, sessionId),
+                partial(self._error, channel, sessionId),
+                self._publishers[channel])
+        elif header['type'] == 'message' and sessionId in sessions:
+            sessions[sessionId].onMessage(payload)
+        elif header['type'] == 'close' and sessionId in sessions:
+            sessions.pop(sessionId).close()
+
+    def _onClose(self, channel):
+        logging.warning("Lost the connection to a web worker.")
+        self._publishers.pop(channel, None)
+        for session in self._sessions.pop(channel, {}).itervalues():
+            session.close()
+
+    def _send(self, channel, header, message):
+        """
+        Send a codec.Message, marshalled unless it holds other types than
+        the builtin ones.
+        """
+        try:
+            encoding, payload = codec.MARSHAL, message.encode(codec.MARSHAL)
+        except ValueError:
+            encoding, payload = codec.JSON, message.encode(codec.JSON)
+        channel.send(dict(header, encoding=encoding), payload)
+
+    def _write(self, channel, sessionId, message, handlerKey):
+        message['handlerKey'] = handlerKey
+        self._send(channel, {'type': 'message', 'session': sessionId},
+                   codec.Message(message))
+
+    def _error(self, channel, sessionId, message):
+        self._write(channel, sessionId, {'message': message}, 'error')
+
+    def _publish(self, channel, message, error=None):
+        """
+        Publish a codec.Message, holding its handlerKey.
+        """
+        self._send(channel, {'type': 'publish'}, message)
+        if error is not None:
+            self._send(channel, {'type': 'publish'}, codec.Message(
+                {'message': error, 'handlerKey': 'error'}))
+
+
+class RemoteSession(object):
+    """
+    Worker side: forwards the messages of a websocket connection to its
+    session in the main process.
+    """
+    def __init__(self, client, sessionId):
+        super(RemoteSession, self).__init__()
+        self._client = client
+        self._id = sessionId
+
+    def onMessage(self, message):
+        self._client.send({'type': 'message', 'session': self._id}, message)
+
+    def close(self):
+        self._client.closeSession(self._id)
+
+
+class RpcClient(object):
+    """
+    Worker side: connection to the main process. Reconnects after losing
+    it, closing the websocket connections so that the clients reconnect as
+    well. Exits the worker if the main process is gone.
+    """
+    def __init__(self, path):
+        super(RpcClient, self).__init__()
+        self._path = path
+        self._channel = None
+        self._connections = {}  # {session id: WSHandler}
+        self._ids = itertools.count(1)
+        self._parent = os.getppid()
+        self._snapshots = deque()  # Futures of the snapshot requests
+
+    @gen.coroutine
+    def connect(self):
+        while self._channel is None:
+            if os.getppid() != self._parent:
+                logging.error("The main process is gone, exiting.")
+                IOLoop.current().stop()
+                return
+            stream = IOStream(socket.socket(socket.AF_UNIX,
+                                            socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self._path)
+            except (StreamClosedError, socket.error):
+                yield gen.sleep(RECONNECT_DELAY)
+                continue
+            self._channel = Channel(stream, self._onFrame, self._onClose)
+            self._channel.start()
+            logging.info("Connected to the main process.")
+
+    def _onClose(self, channel):
+        logging.warning("Lost the connection to the main process.")
+        self._channel = None
+        while self._snapshots:
+            self._snapshots.popleft().set_result(None)
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = {}
+        IOLoop.current().add_future(self.connect(), lambda f: f.result())
+
+    def _onFrame(self, channel, header, payload):
+        if header['type'] == 'snapshot':
+            if self._snapshots:
+                self._snapshots.popleft().set_result(json.loads(payload))
+            return
+        if header['type'] == 'publish':
+            connections = self._connections.values()
+        else:
+            connections = [self._connections.get(header['session'])]
+        message = codec.Message(encoding=header['encoding'],
+                                payload=payload)
+        for connection in connections:
+            try:
+                if connection is not None:
+                    connection.writeEncoded(message)
+            except WebSocketClosedError:
+                pass  # its session is closed by WSHandler.on_close
+
+    def send(self, header, payload=''):
+        if self._channel is not None:
+            self._channel.send(header, payload)
+
+    def snapshot(self):
+        """
+        Return a Future of the snapshot of the main process (see
+        server.snapshot), None if it isn't connected.
+        """
+        future = Future()
+        if self._channel is None:
+            future.set_result(None)
+        else:
+            self._snapshots.append(future)
+            self.send({'type': 'snapshot'})
+        return future
+
+    def open(self, connection):
+        """
+        Return the session of the websocket connection, see WSHandler.
+        """
+        if self._channel is None:
+            connection.close()
+            return None
+        sessionId = next(self._ids)
+        self._connections[sessionId] = connection
+        self.send({'type': 'open', 'session': sessionId})
+        return RemoteSession(self, sessionId)
+
+    def closeSession(self, sessionId):
+        if self._connections.pop(sessionId, None) is not None:
+            self.send({'type': 'close', 'session': sessionId})
+
+
+# in the workers, the connection to the main process
+_client = None
+
+
+def serve(path, sessionFactory, snapshot):
+    RpcServer(path, sessionFactory, snapshot).start()
+
+
+def connect(path):
+    """
+    Connect the worker to the main process.
+    """
+    global _client
+    _client = RpcClient(path)
+    IOLoop.current().add_future(_client.connect(), lambda f: f.result())
+
+
+def client():
+    """
+    Return the connection to the main process, None outside of the workers.
+    """
+    return _client
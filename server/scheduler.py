@@ -0,0 +1,354 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Central scheduler of the periodic and delayed work of the server.
+Jobs are kept in a heap ordered by next run time, and a single thread waits
+for the next due job and hands it to an executor, so that nothing runs on
+the scheduler thread itself:
+* 'thread': pool of worker threads (size `Conf['scheduler']['workers']`)
+* 'process': pool of worker processes, the function must be picklable
+* 'ioloop': the tornado IOLoop, for the jobs using the websockets or the
+  database connection. They should be fast.
+Each job has a trigger (interval, cron-like spec or one-shot date), an
+optional jitter, a max number of concurrent runs and a misfire grace time:
+a run that couldn't start within `misfireGrace` seconds of its scheduled
+time is skipped.
+"""
+
+import time
+import heapq
+import random
+import logging
+import itertools
+import multiprocessing
+from datetime import datetime, timedelta
+from threading import Thread, Condition, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+from conf import Conf
+
+
+class SchedulerException(Exception):
+    pass
+
+
+class IntervalTrigger(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next(self, previous, now):
+        if previous is None:
+            return now + self.seconds
+        # don't try to catch up with the runs missed while the job was late
+        return max(previous + self.seconds, now)
+
+
+class OneShotTrigger(object):
+    def __init__(self, at):
+        self.at = at
+
+    def next(self, previous, now):
+        return self.at if previous is None else None
+
+
+class CronTrigger(object):
+    """
+    Cron trigger. The spec holds the 5 usual fields: minute, hour, day of
+    month, month and day of week (0 or 7 = sunday). Each field can be `*`,
+    a value, a range `a-b`, a step `*/n` or `a-b/n`, or a list of those
+    separated with commas.
+    As in cron, if both the day of month and the day of week are restricted
+    (not starting with `*`), a day matches if either of them does.
+    """
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise SchedulerException("Invalid cron spec: %s" % spec)
+        self.spec = spec
+        self.allowed = [self._parse(field, lo, hi)
+                        for field, (lo, hi) in zip(fields, self.RANGES)]
+        if 7 in self.allowed[4]:
+            self.allowed[4].remove(7)
+            self.allowed[4].add(0)
+        self._eitherDay = not fields[2].startswith('*') and \
+            not fields[4].startswith('*')
+
+    def _parse(self, field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            rng, _, step = part.partition('/')
+            try:
+                if rng == '*':
+                    start, end = lo, hi
+                elif '-' in rng:
+                    start, end = map(int, rng.split('-'))
+                else:
+                    start = end = int(rng)
+                step = int(step or 1)
+            except ValueError:
+                raise SchedulerException("Invalid cron field: %s" % field)
+            if start < lo or end > hi or start > end or step < 1:
+                raise SchedulerException("Invalid cron field: %s" % field)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _dayMatches(self, dt):
+        day = dt.day in self.allowed[2]
+        # datetime counts the days of week from monday
+        weekday = (dt.weekday() + 1) % 7 in self.allowed[4]
+        if self._eitherDay:
+            return day or weekday
+        return day and weekday
+
+    def _matches(self, dt):
+        minute, hour, _, month, _ = self.allowed
+        return dt.month in month and self._dayMatches(dt) and \
+            dt.hour in hour and dt.minute in minute
+
+    def next(self, previous, now):
+        dt = datetime.fromtimestamp(now).replace(second=0, microsecond=0)
+        limit = dt + timedelta(days=366)
+        while dt < limit:
+            dt += timedelta(minutes=1)
+            if dt.month not in self.allowed[3]:
+                # jump to the first day of next month
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0) - timedelta(minutes=1)
+                continue
+            if not self._dayMatches(dt):
+                dt = dt.replace(hour=23, minute=59)
+                continue
+            if self._matches(dt):
+                return time.mktime(dt.timetuple())
+        raise SchedulerException("Cron spec %s never matches" % self.spec)
+
+
+class Job(object):
+    def __init__(self, name, fn, trigger, executor='thread', jitter=0,
+                 maxInstances=1, misfireGrace=None, args=None, kwargs=None):
+        super(Job, self).__init__()
+        self.name = name
+        self.fn = fn
+        self.trigger = trigger
+        self.executor = executor
+        self.jitter = jitter
+        self.maxInstances = maxInstances
+        self.misfireGrace = misfireGrace
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.nextRun = None
+        self.running = 0
+        self.removed = False
+        self._stats = {
+            'runs': 0, 'failures': 0, 'misfires': 0, 'skipped': 0,
+            'lastRun': None, 'lastDuration': None, 'maxDuration': 0,
+            'totalDuration': 0, 'lastError': None
+        }
+
+    def schedule(self, previous, now):
+        nextRun = self.trigger.next(previous, now)
+        if nextRun is not None and self.jitter:
+            nextRun += random.uniform(0, self.jitter)
+        self.nextRun = nextRun
+        return nextRun
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['running'] = self.running
+        stats['nextRun'] = self.nextRun
+        stats['avgDuration'] = stats['totalDuration'] / stats['runs'] \
+            if stats['runs'] else None
+        return stats
+
+
+class Scheduler(Thread):
+    def __init__(self):
+        super(Scheduler, self).__init__(name='scheduler')
+        self.daemon = True
+        self._heap = []
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._condition = Condition(Lock())
+        self._stopped = False
+        self._executors = {
+            'thread': ThreadPoolExecutor(Conf['scheduler']['workers']),
+        }
+        self._ioloop = IOLoop.instance()
+
+    def _executor(self, name):
+        if name == 'process' and name not in self._executors:
+            self._executors[name] = ProcessPoolExecutor(
+                Conf['scheduler']['processes'] or multiprocessing.cpu_count())
+        return self._executors[name]
+
+    def add(self, name, fn, interval=None, cron=None, at=None, delay=None,
+            **options):
+        """
+        Schedule `fn`, replacing any job with the same name.
+        Exactly one of the following triggers should be given:
+        * interval: run every `interval` seconds
+        * cron: cron-like spec (see CronTrigger)
+        * at: run once at the given timestamp
+        * delay: run once in `delay` seconds
+        See `Job` for the other options.
+        """
+        if interval is not None:
+            trigger = IntervalTrigger(interval)
+        elif cron is not None:
+            trigger = CronTrigger(cron)
+        elif at is not None:
+            trigger = OneShotTrigger(at)
+        elif delay is not None:
+            trigger = OneShotTrigger(time.time() + delay)
+        else:
+            raise SchedulerException("No trigger given for job %s" % name)
+        job = Job(name, fn, trigger, **options)
+        with self._condition:
+            if name in self._jobs:
+                self._jobs[name].removed = True
+            self._jobs[name] = job
+            self._push(job, None, time.time())
+            self._condition.notify()
+        return job
+
+    def remove(self, name):
+        with self._condition:
+            job = self._jobs.pop(name, None)
+            if job is not None:
+                job.removed = True
+
+    def has(self, name):
+        with self._condition:
+            return name in self._jobs
+
+    def _push(self, job, previous, now):
+        nextRun = job.schedule(previous, now)
+        if nextRun is None:
+            if self._jobs.get(job.name) is job:
+                del self._jobs[job.name]
+            return
+        heapq.heappush(self._heap, (nextRun, next(self._seq), job))
+
+    def stats(self):
+        """
+        Return the run statistics of each job, by name.
+        """
+        with self._condition:
+            return {name: job.stats() for name, job in self._jobs.iteritems()}
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (
+                        not self._heap or self._heap[0][0] > time.time()):
+                    self._condition.wait(
+                        self._heap[0][0] - time.time() if self._heap
+                        else None)
+                if self._stopped:
+                    return
+                scheduled, _, job = heapq.heappop(self._heap)
+                if job.removed:
+                    continue
+                now = time.time()
+                self._push(job, scheduled, now)
+                if job.misfireGrace is not None and \
+                        now - scheduled > job.misfireGrace:
+                    job._stats['misfires'] += 1
+                    logging.warning("Job %s misfired by %.1fs, skipped."
+                                    % (job.name, now - scheduled))
+                    continue
+                if job.running >= job.maxInstances:
+                    job._stats['skipped'] += 1
+                    logging.warning("Job %s is still running, skipped."
+                                    % job.name)
+                    continue
+                job.running += 1
+            self._submit(job)
+
+    def _submit(self, job):
+        t0 = time.time()
+
+        def done(future):
+            duration = time.time() - t0
+            with self._condition:
+                job.running -= 1
+                job._stats['runs'] += 1
+                job._stats['lastRun'] = t0
+                job._stats['lastDuration'] = duration
+                job._stats['totalDuration'] += duration
+                job._stats['maxDuration'] = max(
+                    job._stats['maxDuration'], duration)
+                error = future.exception()
+                if error is not None:
+                    job._stats['failures'] += 1
+                    job._stats['lastError'] = str(error)
+            if error is not None:
+                logging.error("Job %s failed: %s" % (job.name, str(error)))
+
+        if job.executor == 'ioloop':
+            future = Future()
+
+            def runOnIOLoop():
+                try:
+                    future.set_result(job.fn(*job.args, **job.kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            future.add_done_callback(done)
+            self._ioloop.add_callback(runOnIOLoop)
+        else:
+            try:
+                future = self._executor(job.executor).submit(
+                    job.fn, *job.args, **job.kwargs)
+            except Exception as e:
+                logging.exception(e)
+                with self._condition:
+                    job.running -= 1
+                return
+            future.add_done_callback(done)
+
+
+# this module is a singleton
+_instance = None
+_lock = Lock()
+
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = Scheduler()
+                _instance.start()
+    return _instance
+
+
+def add(name, fn, **options):
+    return getInstance().add(name, fn, **options)
+
+
+def remove(name):
+    return getInstance().remove(name)
+
+
+def has(name):
+    return getInstance().has(name)
+
+
+def stats():
+    return getInstance().stats()
@@ -1,6 +1,9 @@
 # -*- coding: utf8 -*-
 from __future__ import unicode_literals
 
+from conf import Conf
+from server import memory
+
 
 class ModelException(Exception):
     pass
@@ -9,11 +12,16 @@ class ModelException(Exception):
 class Service(object):
     """
     Base class of any service, provide some abstraction of common functions
+    Results of `getById` and `getAll` are cached in the `service.<tableName>`
+    cache of `server.memory`. Any method writing to the table must call
+    `invalidate`.
     """
     def __init__(self, connection, tableName):
         super(Service, self).__init__()
         self._connection = connection
         self._tableName = tableName
+        self._cache = memory.getCache(
+            'service.%s' % tableName, **Conf['cache']['services'])
         try:
             self.createTable()
         except NotImplementedError:
@@ -47,12 +55,23 @@ class Service(object):
             data[k] = itm[i]
         return data
 
+    def invalidate(self):
+        """
+        Drop the cached documents of this collection.
+        """
+        self._cache.invalidate()
+
     def getById(self, _id, fields=None):
         """
         Return a document specific to this id
         _id is the _id of the document
         fields is the list of fields to be returned (all by default)
         """
+        return dict(self._cache.getOrCompute(
+            ('getById', _id, tuple(fields) if fields is not None else None),
+            lambda: self._getById(_id, fields)))
+
+    def _getById(self, _id, fields=None):
         cur = self._connection.cursor()
         if fields is None:
             cur.execute("SELECT * FROM %s WHERE _id=?" % (self._tableName),
@@ -76,16 +95,21 @@ class Service(object):
         cur = self._connection.cursor()
         cur.execute("DELETE FROM %s" % self._tableName)
         self._connection.commit()
+        self.invalidate()
 
     def deleteById(self, _id):
         cur = self._connection.cursor()
         cur.execute("DELETE FROM %s WHERE _id=?" % (self._tableName), (_id,))
         self._connection.commit()
+        self.invalidate()
 
     def getAll(self):
         """
         Returns all documents available in this collection.
         """
+        return map(dict, self._cache.getOrCompute('getAll', self._getAll))
+
+    def _getAll(self):
         cur = self._connection.cursor()
         cur.execute("SELECT * FROM %s" % self._tableName)
         return map(self.itm2dict, cur.fetchall())
@@ -100,3 +124,4 @@ class Service(object):
         cur.execute("UPDATE %s SET %s=? WHERE _id=?"
                     % (self._tableName, field), (value, _id))
         self._connection.commit()
+        self.invalidate()
@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+from uuid import uuid4
+
+from baseService import Service
+
+"""
+Schema:
+    * _id:string id of the record
+    * filename:string name of the recompressed backup (before packing)
+    * family:string save family of the backup (see tools.storage.family)
+    * codec:string codec used to pack the backup ('zstd', 'lzma' or 'bz2')
+    * originalSize:integer size of the original zip archive in bytes
+    * packedSize:integer size of the packed archive in bytes
+    * ratio:real packedSize / originalSize
+    * duration:real time spent packing the archive, in seconds
+    * date:real timestamp of the recompression
+"""
+
+
+class CompressionService(Service):
+    """
+    Provides helper functions related to the compressions collection
+    of the database: results of the recompression of backups.
+    """
+    def __init__(self, connection):
+        super(CompressionService, self).__init__(connection, 'compressions')
+
+    def createTable(self):
+        self._connection.execute(
+            "CREATE TABLE %s (_id text, filename text, family text, "
+            "codec text, originalSize integer, packedSize integer, "
+            "ratio real, duration real, date real)" % self._tableName)
+
+    def schema(self):
+        return [
+            ('_id', 'whatever'),
+            ('filename', True),
+            ('family', True),
+            ('codec', True),
+            ('originalSize', True),
+            ('packedSize', True),
+            ('ratio', True),
+            ('duration', True),
+            ('date', True),
+        ]
+
+    def insert(self, filename, family, codec, originalSize, packedSize,
+               duration, date=None, _id=None):
+        logging.debug("Saving recompression of: %s" % (filename))
+        if _id is None:
+            _id = str(uuid4())
+        date = date or time.time()
+
+        cur = self._connection.cursor()
+        cur.execute(
+            "INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            % self._tableName,
+            (_id, filename, family, codec, originalSize, packedSize,
+             float(packedSize) / originalSize if originalSize else 1.0,
+             duration, date))
+        self._connection.commit()
+        self.invalidate()
+        return _id
+
+    def summary(self):
+        """
+        Return the overall results as a dict holding the fields:
+        * count: number of recompressed backups
+        * originalSize, packedSize: total sizes in bytes
+        * ratio: overall ratio
+        """
+        cur = self._connection.cursor()
+        cur.execute("SELECT COUNT(_id), SUM(originalSize), SUM(packedSize) "
+                    "FROM %s" % self._tableName)
+        count, original, packed = cur.fetchone()
+        return {
+            'count': count,
+            'originalSize': original or 0,
+            'packedSize': packed or 0,
+            'ratio': float(packed) / original if original else 1.0
+        }
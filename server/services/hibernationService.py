@@ -0,0 +1,87 @@
+# -*- coding: utf8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+from uuid import uuid4
+
+from baseService import Service
+
+"""
+Schema:
+    * _id:string id of the hibernation
+    * instanceId:string id of the hibernated instance
+    * sleptAt:real timestamp at which the instance was stopped for being idle
+    * rss:integer memory used by factorio when it was stopped, in bytes
+    * wokeAt:real timestamp of the packet that woke the instance up, null
+      while it is hibernating
+    * wakeLatency:real time between the packet and the server being ready
+      to accept players, in seconds
+"""
+
+
+class HibernationService(Service):
+    """
+    Provides helper functions related to the hibernations collection
+    of the database: instances stopped while idle (see server.hibernation).
+    """
+    def __init__(self, connection):
+        super(HibernationService, self).__init__(connection, 'hibernations')
+
+    def createTable(self):
+        self._connection.execute(
+            "CREATE TABLE %s (_id text, instanceId text, sleptAt real, "
+            "rss integer, wokeAt real, wakeLatency real)" % self._tableName)
+
+    def schema(self):
+        return [
+            ('_id', 'whatever'),
+            ('instanceId', True),
+            ('sleptAt', True),
+            ('rss', True),
+            ('wokeAt', False),
+            ('wakeLatency', False),
+        ]
+
+    def insert(self, instanceId, sleptAt, rss, _id=None):
+        logging.debug("Saving hibernation of instance: %s" % (instanceId))
+        if _id is None:
+            _id = str(uuid4())
+
+        cur = self._connection.cursor()
+        cur.execute(
+            "INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)" % self._tableName,
+            (_id, instanceId, sleptAt, rss, None, None))
+        self._connection.commit()
+        self.invalidate()
+        return _id
+
+    def summary(self, instanceId=None):
+        """
+        Return the overall results, for all instances or for the given one,
+        as a dict holding the fields:
+        * count: number of hibernations
+        * idleHours: time spent hibernating, in hours
+        * gbHours: memory freed multiplied by the time it was freed, in
+          gigabyte-hours
+        * wakeLatency: mean wake latency in seconds, None if never woken
+        * maxWakeLatency: longest wake latency in seconds
+        """
+        query = "SELECT COUNT(_id), SUM(COALESCE(wokeAt, ?) - sleptAt), " \
+                "SUM((COALESCE(wokeAt, ?) - sleptAt) * rss), " \
+                "AVG(wakeLatency), MAX(wakeLatency) FROM %s" % self._tableName
+        now = time.time()
+        args = (now, now)
+        if instanceId is not None:
+            query += " WHERE instanceId=?"
+            args += (instanceId, )
+        cur = self._connection.cursor()
+        cur.execute(query, args)
+        count, idle, byteSeconds, latency, maxLatency = cur.fetchone()
+        return {
+            'count': count,
+            'idleHours': (idle or 0) / 3600.0,
+            'gbHours': (byteSeconds or 0) / 3600.0 / 1024 ** 3,
+            'wakeLatency': latency,
+            'maxWakeLatency': maxLatency
+        }
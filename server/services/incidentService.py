@@ -0,0 +1,105 @@
+# -*- coding: utf8 -*-
+from __future__ import unicode_literals
+
+import logging
+from uuid import uuid4
+
+from baseService import Service
+
+"""
+Schema:
+    * _id:string id of the incident
+    * instanceId:string id of the instance that stopped unexpectedly
+    * crashedAt:real timestamp at which the process exit was detected
+    * exitCode:integer exit code of factorio, -1 if unknown
+    * attempt:integer number of crashes of the instance within the crash
+      window, this one included
+    * outcome:string 'restarted' or 'gaveup' (crash loop limit reached)
+    * restoredFrom:string backup the save was restored from, if it was
+      corrupted
+    * restartedAt:real timestamp of the restart, null if it gave up
+    * mttr:real time to recover in seconds (restartedAt - crashedAt)
+"""
+
+
+class IncidentService(Service):
+    """
+    Provides helper functions related to the incidents collection
+    of the database: unexpected stops of the instances, and their automatic
+    recovery (see server.supervisor).
+    """
+    def __init__(self, connection):
+        super(IncidentService, self).__init__(connection, 'incidents')
+
+    def createTable(self):
+        self._connection.execute(
+            "CREATE TABLE %s (_id text, instanceId text, crashedAt real, "
+            "exitCode integer, attempt integer, outcome text, "
+            "restoredFrom text, restartedAt real, mttr real)"
+            % self._tableName)
+
+    def schema(self):
+        return [
+            ('_id', 'whatever'),
+            ('instanceId', True),
+            ('crashedAt', True),
+            ('exitCode', True),
+            ('attempt', True),
+            ('outcome', True),
+            ('restoredFrom', False),
+            ('restartedAt', False),
+            ('mttr', False),
+        ]
+
+    def insert(self, instanceId, crashedAt, exitCode, attempt, outcome,
+               restoredFrom=None, restartedAt=None, _id=None):
+        logging.debug("Saving incident of instance: %s" % (instanceId))
+        if _id is None:
+            _id = str(uuid4())
+        mttr = restartedAt - crashedAt if restartedAt is not None else None
+
+        cur = self._connection.cursor()
+        cur.execute(
+            "INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            % self._tableName,
+            (_id, instanceId, crashedAt, exitCode, attempt, outcome,
+             restoredFrom, restartedAt, mttr))
+        self._connection.commit()
+        self.invalidate()
+        return _id
+
+    def getByInstance(self, instanceId, limit=20):
+        """
+        Return the most recent incidents of the given instance, most recent
+        first.
+        """
+        cur = self._connection.cursor()
+        cur.execute("SELECT * FROM %s WHERE instanceId=? "
+                    "ORDER BY crashedAt DESC LIMIT ?" % self._tableName,
+                    (instanceId, limit))
+        return [self.itm2dict(itm) for itm in cur.fetchall()]
+
+    def summary(self, instanceId=None):
+        """
+        Return the overall results, for all instances or for the given one,
+        as a dict holding the fields:
+        * count: number of incidents
+        * gaveup: number of incidents that weren't recovered
+        * mttr: mean time to recover in seconds, None if nothing recovered
+        * maxMttr: longest time to recover in seconds
+        """
+        query = "SELECT COUNT(_id), SUM(outcome = 'gaveup'), AVG(mttr), " \
+                "MAX(mttr) FROM %s" % self._tableName
+        args = ()
+        if instanceId is not None:
+            query += " WHERE instanceId=?"
+            args = (instanceId, )
+        cur = self._connection.cursor()
+        cur.execute(query, args)
+        count, gaveup, mttr, maxMttr = cur.fetchone()
+        return {
+            'count': count,
+            'gaveup': gaveup or 0,
+            'mttr': mttr,
+            'maxMttr': maxMttr
+        }
@@ -2,8 +2,10 @@
 from __future__ import unicode_literals
 
 import logging
+import sqlite3
 from uuid import uuid4
 
+from conf import Conf
 from baseService import Service
 
 """
@@ -12,7 +14,18 @@ Schema:
     * name:string name of the instance
     * save:string name of the save this instance is running
     * port:string, port this instance is listening on
-    * status:string, current status of the instance ('running' or 'stopped')
+    * status:string, current status of the instance ('running', 'stopped',
+      'restarting', 'crashed' or 'hibernating')
+    * cores:string, cpus the instance is pinned to (see tools.placement),
+      empty for an automatic placement
+    * version:integer, version of the store when the instance was last
+      changed
+    * host:string, host the instance runs on (see server.cluster), empty
+      until its first start for an automatic placement
+
+The deleted instances are kept in the `instanceDeletions` table (_id,
+version), so that the clients can be told about them (see `changesSince`).
+Only the `Conf['manage']['sync']['deletions']` most recent are kept.
 """
 
 
@@ -20,14 +33,35 @@ class InstanceService(Service):
     """
     Provides helper functions related to the tags collection
     of the database.
+    Each write increments the version of the store, which is given to the
+    changed instance. Listeners registered with `onChange` are called after
+    each write.
     """
     def __init__(self, connection):
         super(InstanceService, self).__init__(connection, 'instances')
+        # databases created before the cores, version and host columns
+        for column in ('cores text', 'version integer', 'host text'):
+            try:
+                self._connection.execute(
+                    "ALTER TABLE %s ADD COLUMN %s"
+                    % (self._tableName, column))
+            except sqlite3.OperationalError:
+                pass  # already there
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS instanceDeletions "
+            "(_id text, version integer)")
+        cur = self._connection.cursor()
+        cur.execute("SELECT MAX(version) FROM %s UNION ALL "
+                    "SELECT MAX(version) FROM instanceDeletions"
+                    % self._tableName)
+        self._version = max(v or 0 for v, in cur.fetchall())
+        self._listeners = []
 
     def createTable(self):
         self._connection.execute(
             "CREATE TABLE %s (_id text, name text, save text, port text, "
-            "status text)" % self._tableName)
+            "status text, cores text, version integer, host text)"
+            % self._tableName)
 
     def schema(self):
         return [
@@ -36,26 +70,114 @@ class InstanceService(Service):
             ('save', False),
             ('port', True),
             ('status', False),
+            ('cores', False),
+            ('version', False),
+            ('host', False),
         ]
 
-    def insert(self, name, save=None, port=None, status='stopped', _id=None):
+    def onChange(self, listener):
+        """
+        `listener()` is called after each write.
+        """
+        self._listeners.append(listener)
+
+    def _nextVersion(self):
+        self._version += 1
+        return self._version
+
+    def _changed(self):
+        self._connection.commit()
+        self.invalidate()
+        for listener in self._listeners:
+            try:
+                listener()
+            except Exception as e:
+                logging.exception(e)
+
+    def version(self):
+        """
+        Return the current version of the store.
+        """
+        return self._version
+
+    def changesSince(self, version):
+        """
+        Return the changes made after the given version of the store, as a
+        tuple (changed instance documents, deleted instance ids).
+        Return None if they aren't all known anymore (too many deletions
+        since then), or if the version is unknown: the client should start
+        over from a full snapshot.
+        """
+        if version is None or version > self._version:
+            return None
+        cur = self._connection.cursor()
+        cur.execute("SELECT COUNT(_id), MIN(version) FROM instanceDeletions")
+        count, oldest = cur.fetchone()
+        if count >= Conf['manage']['sync']['deletions'] and \
+                version < oldest - 1:
+            return None  # some deletions after that version were forgotten
+        cur.execute("SELECT * FROM %s WHERE version > ?" % self._tableName,
+                    (version, ))
+        changed = map(self.itm2dict, cur.fetchall())
+        cur.execute("SELECT _id FROM instanceDeletions WHERE version > ?",
+                    (version, ))
+        return changed, [_id for _id, in cur.fetchall()]
+
+    def insert(self, name, save=None, port=None, status='stopped', cores=None,
+               _id=None, host=None):
         logging.debug("Saving new instance: %s" % (name))
         if _id is None:
             _id = str(uuid4())
 
         cur = self._connection.cursor()
-        cur.execute("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % self._tableName,
-                    (_id, name, save, port, status))
-        self._connection.commit()
+        cur.execute(
+            "INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            % self._tableName,
+            (_id, name, save, port, status, cores, self._nextVersion(), host))
+        self._changed()
         return _id
 
-    def update(self, _id, name, save, port):
+    def update(self, _id, name, save, port, cores=None, host=None):
         """
         Update all the above in one request.
         Call `set` to set only a single field.
         """
         cur = self._connection.cursor()
         cur.execute(
-            "UPDATE %s SET name=?, save=?, port=? WHERE _id=?"
-            % (self._tableName), (name, save, port, _id))
-        self._connection.commit()
+            "UPDATE %s SET name=?, save=?, port=?, cores=?, host=?, "
+            "version=? WHERE _id=?" % (self._tableName),
+            (name, save, port, cores, host, self._nextVersion(), _id))
+        self._changed()
+
+    def set(self, _id, field, value):
+        cur = self._connection.cursor()
+        cur.execute("UPDATE %s SET %s=?, version=? WHERE _id=?"
+                    % (self._tableName, field),
+                    (value, self._nextVersion(), _id))
+        self._changed()
+
+    def _recordDeletions(self, ids):
+        cur = self._connection.cursor()
+        cur.executemany("INSERT INTO instanceDeletions VALUES (?, ?)",
+                        [(_id, self._nextVersion()) for _id in ids])
+        cur.execute(
+            "DELETE FROM instanceDeletions WHERE version NOT IN (SELECT "
+            "version FROM instanceDeletions ORDER BY version DESC LIMIT ?)",
+            (Conf['manage']['sync']['deletions'], ))
+
+    def deleteById(self, _id):
+        cur = self._connection.cursor()
+        cur.execute("DELETE FROM %s WHERE _id=?" % (self._tableName), (_id,))
+        self._recordDeletions([_id])
+        self._changed()
+
+    def deleteAll(self):
+        """
+        Warning: will delete ALL the documents in this collection
+        """
+        cur = self._connection.cursor()
+        cur.execute("SELECT _id FROM %s" % self._tableName)
+        ids = [_id for _id, in cur.fetchall()]
+        cur.execute("DELETE FROM %s" % self._tableName)
+        self._recordDeletions(ids)
+        self._changed()
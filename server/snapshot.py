@@ -0,0 +1,55 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Snapshot of the state shown by the pages: instances, saves and latest
+metrics. It is embedded in the rendered templates (see TemplatesHandler),
+so that the pages show it before their websocket is open. In the
+multi-worker mode, the workers get it from the main process (see
+server.rpc).
+The snapshot is versioned by the instances and the saves: it is rebuilt
+when one of them changes, or after `Conf['server']['templates']['ttl']`
+seconds. The metrics are the latest sample, whatever its age.
+"""
+
+import json
+import zlib
+
+from conf import Conf
+from server import memory, metrics
+from server.model import getService
+from tools import saves
+
+
+def _cache():
+    return memory.getCache('snapshot', maxSize=1,
+                           ttl=Conf['server']['templates']['ttl'])
+
+
+def get():
+    """
+    Return the snapshot as a dict:
+    * version: version of the instance store, see the manage 'sync' action
+    * dataVersion: changes with the instances and the saves
+    * instances: data of all the instances
+    * saves: see tools.saves.list
+    * metrics: latest sample, see server.metrics
+    Main process only, on the IOLoop thread which owns the database
+    connection.
+    """
+    savesList = saves.list()
+    version = getService('instance').version()
+    dataVersion = '%d-%08x' % (version, zlib.crc32(json.dumps(
+        savesList, sort_keys=True)) & 0xffffffff)
+
+    def build():
+        return {
+            'version': version,
+            'dataVersion': dataVersion,
+            'instances': getService('instance').getAll(),
+            'saves': savesList
+        }
+    data = dict(_cache().getOrCompute(dataVersion, build))
+    data['metrics'] = metrics.latest()
+    return data
@@ -0,0 +1,524 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Supervision of the running factorio instances.
+Each started instance gets a watcher thread blocked on the end of its
+process, so its exit is noticed immediately, whether or not a client is
+connected. An exit that wasn't requested is a crash: the save is checked
+and restored from its last valid backup generation if needed (see
+`tools.factorio.restoreSave`), and the instance is started again after an
+exponential backoff (`backoff * 2 ** (crashes - 1)` seconds, at most
+`maxBackoff`). After `maxRestarts` crashes within `crashWindow` seconds,
+the instance is left stopped with the status 'crashed'.
+Each instance is pinned to its own cores (see tools.placement), chosen when
+it starts and changed live when the operator edits its core set.
+Each crash is recorded with its time to recover by the 'incident' service.
+The instances may run on other hosts (see server.cluster): a new instance is
+placed on the least loaded host when it first starts.
+With the forwarder (see server.forwarder), the port of a local instance
+stays open across its restarts, and `replace` restarts it without
+interruption: a second process boots on another internal port, and the
+players are switched to it once it accepts them.
+
+All the state changes happen on the IOLoop thread, which owns the database
+connection; the listeners (see `addListener`) are called there as well.
+"""
+
+import time
+import logging
+from threading import Thread, Lock
+
+from tornado.ioloop import IOLoop
+
+from conf import Conf
+from server import scheduler, metrics, cluster, forwarder
+from server.model import getService
+from tools import factorio, placement
+
+
+class SupervisorException(Exception):
+    pass
+
+
+class Supervisor(object):
+    def __init__(self):
+        super(Supervisor, self).__init__()
+        self._instances = {}  # {instance _id: factorio.Instance}
+        self._crashes = {}  # {instance _id: [crash timestamps]}
+        # {instance _id: (replacement factorio.Instance, boot deadline)},
+        # the replacement is None until started
+        self._replacing = {}
+        self._listeners = []
+        self._ioloop = IOLoop.instance()
+
+    def addListener(self, listener):
+        """
+        `listener(event, instanceId, **info)` is called on the IOLoop thread
+        for each of the following events:
+        * 'crashed': the instance stopped unexpectedly. info: exitCode,
+          restartIn (seconds before the restart, None if it gave up)
+        * 'restarted': the instance was started again after a crash.
+          info: mttr, restoredFrom
+        * 'started': the instance was started on request
+        * 'stopped': the instance stopped as requested
+        * 'exited': emitted before any of the previous events with the
+          process, so that its remaining output can be read. info: process
+        * 'replaced': the instance was replaced (see `replace`). info: error
+          (None if the players were switched to the new process)
+        * 'ready': the server accepts players
+        * 'join', 'leave': a player joined or left the game. info: player
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, event, instanceId, **info):
+        for listener in self._listeners:
+            try:
+                listener(event, instanceId, **info)
+            except Exception as e:
+                logging.exception(e)
+
+    def onOutput(self, instanceId, data):
+        """
+        Notify the events found in the output of the instance (see
+        tools.factorio.parseOutput).
+        """
+        for line in data.splitlines():
+            event = factorio.parseOutput(line)
+            if event is None:
+                continue
+            kind, player = event
+            if kind == 'ready':
+                self._notify('ready', instanceId)
+            else:
+                self._notify(kind, instanceId, player=player)
+
+    def get(self, instanceId):
+        """
+        Return the running process of the instance, None if it isn't running.
+        """
+        return self._instances.get(instanceId)
+
+    def running(self):
+        """
+        Return the list of the running processes.
+        """
+        return self._instances.values()
+
+    def start(self, instanceId):
+        """
+        Start the instance with the given _id, cancelling any pending
+        automatic restart.
+        """
+        scheduler.remove('restart-%s' % instanceId)
+        self._crashes.pop(instanceId, None)
+        process = self._start(getService('instance').getById(instanceId))
+        self._notify('started', instanceId)
+        return process
+
+    def _start(self, data):
+        if data['_id'] in self._instances:
+            raise SupervisorException(
+                "The instance %s is already running" % data['name'])
+        host = data.get('host') or cluster.pickHost(self._instances.values())
+        for process in self._instances.itervalues():
+            if process.host == host and \
+                    process.publicPort == str(data['port']):
+                raise SupervisorException(
+                    "An instance is already running on port %s of %s (pid: "
+                    "%d, _id=%s)" % (process.publicPort, host,
+                                     process.subpid.value, process._id))
+            # they would share their autosaves, see factorio.WRITE_DATA
+            if process.host == host and process.save == data['save']:
+                raise SupervisorException(
+                    "The save %s is already run on %s (_id=%s)"
+                    % (data['save'], host, process._id))
+        if host == factorio.LOCAL and forwarder.enabled():
+            process = self._forwarded(data)
+        else:
+            process = cluster.create(host, data)
+        if host == factorio.LOCAL:
+            process.cores = self._plan(data, self._local())
+        process.start()
+        self._follow(process)
+        if host != data.get('host'):
+            getService('instance').set(data['_id'], 'host', host)
+        getService('instance').set(data['_id'], 'status', 'running')
+        return process
+
+    def _forwarded(self, data, switch=True):
+        """
+        Return the local process of the instance listening on an internal
+        port. Its port is relayed to that internal port (see
+        server.forwarder) if `switch`.
+        """
+        used = set(p.port for p in self._local())
+        used.update(r.port for r, _ in self._replacing.itervalues() if r)
+        for port in Conf['factorio']['forwarder']['internalPorts']:
+            if str(port) not in used:
+                break
+        else:
+            raise SupervisorException("No internal port left for instance %s"
+                                      % data['name'])
+        process = cluster.create(factorio.LOCAL, dict(data, port=port))
+        process.publicPort = str(data['port'])
+        if switch:
+            forwarder.forward(data['port'], port)
+        process.inherited = forwarder.sockets()
+        return process
+
+    def _unforward(self, host, publicPort):
+        """
+        Close the port of a local instance that won't run anymore, so that
+        it can be bound again (eg: by server.hibernation).
+        """
+        if host == factorio.LOCAL and forwarder.enabled():
+            forwarder.close(publicPort)
+
+    def _follow(self, process):
+        self._instances[process._id] = process
+        watcher = Thread(target=self._watch, args=(process, ),
+                         name='watch-%s' % process._id)
+        watcher.daemon = True
+        watcher.start()
+
+    def adopt(self, process):
+        """
+        Follow an instance found running on an agent (see server.cluster),
+        started before this process.
+        """
+        if process._id in self._instances:
+            return
+        logging.info("Instance %s found running on %s."
+                     % (process._id, process.host))
+        scheduler.remove('restart-%s' % process._id)
+        self._follow(process)
+        getService('instance').set(process._id, 'status', 'running')
+
+    def _local(self):
+        return [p for p in self._instances.itervalues()
+                if p.host == factorio.LOCAL]
+
+    def _plan(self, data, others):
+        """
+        Return the cpus to pin the instance to, given the other running
+        processes.
+        """
+        if not Conf['placement']['enabled']:
+            return None
+        try:
+            manual = placement.parseCores(data.get('cores'))
+        except placement.PlacementException as e:
+            logging.warning("Ignoring the cores of instance %s: %s"
+                            % (data['name'], str(e)))
+            manual = None
+        return placement.plan(manual, [p.cores for p in others],
+                              metrics.latest().get('CPUs'))
+
+    def place(self, instanceId):
+        """
+        Pin the running instance again, after its core set was edited.
+        """
+        process = self._instances.get(instanceId)
+        if process is None:
+            return
+        data = getService('instance').getById(instanceId)
+        if process.host != factorio.LOCAL:
+            return process.place(data['cores'])
+        process.cores = self._plan(
+            data, [p for p in self._local() if p is not process])
+        if process.subpid.value:
+            placement.apply(process.subpid.value, process.cores, 'game')
+
+    def placements(self):
+        """
+        Return the placement of the running instances as a dict
+        {instance _id: {'host': host it runs on, 'cores': cpus assigned,
+        'current': actual placement of factorio (see
+        tools.placement.current), None on the other hosts}}.
+        """
+        return {
+            instanceId: {
+                'host': process.host,
+                'cores': placement.formatCores(process.cores),
+                'current': placement.current(process.subpid.value)
+                if process.subpid.value and process.host == factorio.LOCAL
+                else None
+            } for instanceId, process in self._instances.iteritems()}
+
+    def stop(self, instanceId):
+        """
+        Request the instance to save and stop. Also cancels a pending
+        automatic restart.
+        Return False if the instance was neither running nor restarting.
+        """
+        pending = scheduler.has('restart-%s' % instanceId)
+        scheduler.remove('restart-%s' % instanceId)
+        self._endReplace(instanceId, "The instance was stopped")
+        getService('instance').set(instanceId, 'status', 'stopped')
+        process = self._instances.get(instanceId)
+        if process is None:
+            if pending:
+                data = getService('instance').getById(instanceId)
+                self._unforward(data.get('host') or factorio.LOCAL,
+                                data['port'])
+            return pending
+        process.kill()
+        return True
+
+    def replace(self, instanceId, backup=True):
+        """
+        Restart the running local instance without closing its port (see
+        server.forwarder), eg: to apply a new config or a restored save. A
+        new process boots from the save of the instance, updated first with
+        the latest autosave if `backup`, on another internal port. Once it
+        accepts players, they are switched to it and the previous process
+        stops without overriding the save. The progress made meanwhile on
+        the previous process is lost.
+        The outcome is notified with the 'replaced' event, the previous
+        process keeps running if the new one fails to boot within
+        `Conf['factorio']['forwarder']['bootTimeout']` seconds.
+        """
+        process = self._instances.get(instanceId)
+        if process is None:
+            raise SupervisorException("The instance %s isn't running"
+                                      % instanceId)
+        if process.host != factorio.LOCAL or not forwarder.enabled():
+            raise SupervisorException("Only the local instances can be "
+                                      "replaced, with the forwarder enabled")
+        if instanceId in self._replacing:
+            raise SupervisorException("The instance %s is already being "
+                                      "replaced" % instanceId)
+        self._replacing[instanceId] = (None, None)
+        scheduler.add('replace-%s' % instanceId, self._prepareReplace,
+                      delay=0, args=(process, backup))
+
+    def _prepareReplace(self, process, backup):
+        """
+        Scheduled on a worker thread: update the save before booting.
+        """
+        if backup:
+            try:
+                process.backupSave()
+            except Exception as e:
+                logging.exception(e)
+        self._ioloop.add_callback(self._bootReplacement, process)
+
+    def _bootReplacement(self, process):
+        instanceId = process._id
+        if self._replacing.get(instanceId) != (None, None) or \
+                self._instances.get(instanceId) is not process:
+            return  # stopped meanwhile
+        data = getService('instance').getById(instanceId)
+        try:
+            replacement = self._forwarded(data, switch=False)
+            replacement.cores = self._plan(data, self._local())
+            replacement.start()
+        except Exception as e:
+            logging.exception(e)
+            return self._endReplace(instanceId, str(e))
+        logging.info("Booting a replacement of instance %s on port %s."
+                     % (instanceId, replacement.port))
+        self._replacing[instanceId] = (
+            replacement,
+            time.time() + Conf['factorio']['forwarder']['bootTimeout'])
+        scheduler.add('replace-%s' % instanceId, self._checkReplacement,
+                      interval=1, executor='ioloop', args=(instanceId, ))
+
+    def _checkReplacement(self, instanceId):
+        """
+        Scheduled on the IOLoop every second while the replacement boots.
+        """
+        replacement, deadline = self._replacing.get(instanceId, (None, None))
+        if replacement is None:
+            return  # ended meanwhile
+        if not replacement.is_alive():
+            return self._endReplace(
+                instanceId, "The new process stopped while booting (exit "
+                "code: %d)" % replacement.exitCode.value)
+        if not replacement.ready.value:
+            if time.time() > deadline:
+                self._endReplace(instanceId, "The new process didn't boot "
+                                 "in time")
+            return
+        scheduler.remove('replace-%s' % instanceId)
+        del self._replacing[instanceId]
+        process = self._instances[instanceId]
+        forwarder.forward(replacement.publicPort, replacement.port)
+        process.replaced = True
+        process.kill(save=False)
+        self._follow(replacement)
+        logging.info("Instance %s replaced, now on port %s."
+                     % (instanceId, replacement.port))
+        self._notify('replaced', instanceId, error=None)
+
+    def _endReplace(self, instanceId, error):
+        """
+        Abort the replacement of the instance, if any: the new process is
+        stopped without overriding the save, and its output is forwarded
+        as the one of an exited process.
+        """
+        if instanceId not in self._replacing:
+            return
+        scheduler.remove('replace-%s' % instanceId)
+        replacement, _ = self._replacing.pop(instanceId)
+        if replacement is not None:
+            replacement.replaced = True
+            replacement.kill(save=False)
+            watcher = Thread(target=self._watch, args=(replacement, ),
+                             name='watch-%s' % instanceId)
+            watcher.daemon = True
+            watcher.start()
+        logging.error("Unable to replace instance %s: %s"
+                      % (instanceId, error))
+        self._notify('replaced', instanceId, error=error)
+
+    def _watch(self, process):
+        """
+        Watcher thread: wait for the end of the process.
+        """
+        process.join()
+        exitedAt = time.time()
+        self._ioloop.add_callback(self._onExit, process, exitedAt)
+
+    def _onExit(self, process, exitedAt):
+        instanceId = process._id
+        if self._instances.get(instanceId) is process:
+            del self._instances[instanceId]
+        self._notify('exited', instanceId, process=process)
+        if process.replaced:
+            logging.info("Replaced process of instance %s stopped."
+                         % instanceId)
+            return
+        self._endReplace(instanceId, "The instance stopped")
+        if process.stopRequested:
+            logging.info("Instance %s stopped." % instanceId)
+            self._unforward(process.host, process.publicPort)
+            return self._notify('stopped', instanceId)
+
+        options = Conf['factorio']['supervisor']
+        crashes = [t for t in self._crashes.get(instanceId, [])
+                   if t > exitedAt - options['crashWindow']]
+        crashes.append(exitedAt)
+        self._crashes[instanceId] = crashes
+        exitCode = process.exitCode.value
+        logging.error("Instance %s stopped unexpectedly (exit code: %d, "
+                      "crash %d)" % (instanceId, exitCode, len(crashes)))
+
+        if len(crashes) > options['maxRestarts']:
+            logging.error("Instance %s crashed %d times in %ds, giving up."
+                          % (instanceId, len(crashes), options['crashWindow']))
+            getService('instance').set(instanceId, 'status', 'crashed')
+            getService('incident').insert(
+                instanceId, exitedAt, exitCode, len(crashes), 'gaveup')
+            self._unforward(process.host, process.publicPort)
+            return self._notify('crashed', instanceId, exitCode=exitCode,
+                                restartIn=None)
+
+        delay = min(options['maxBackoff'],
+                    options['backoff'] * 2 ** (len(crashes) - 1))
+        getService('instance').set(instanceId, 'status', 'restarting')
+        scheduler.add('restart-%s' % instanceId, self._restore,
+                      delay=delay, args=(process, exitedAt, len(crashes)))
+        self._notify('crashed', instanceId, exitCode=exitCode,
+                     restartIn=delay)
+
+    def _restore(self, process, crashedAt, attempt):
+        """
+        Scheduled on a worker thread: check the save before restarting.
+        """
+        try:
+            restoredFrom = process.restoreSave()
+        except Exception as e:
+            logging.exception(e)
+            restoredFrom = None
+        if restoredFrom is not None:
+            logging.warning("Restored the save of instance %s from %s"
+                            % (process._id, restoredFrom))
+        self._ioloop.add_callback(
+            self._restart, process, crashedAt, attempt, restoredFrom)
+
+    def _restart(self, process, crashedAt, attempt, restoredFrom):
+        instanceId = process._id
+        data = getService('instance').getById(instanceId)
+        if data['status'] != 'restarting':
+            return  # stopped or started meanwhile
+        try:
+            self._start(data)
+        except Exception as e:
+            logging.exception(e)
+            getService('instance').set(instanceId, 'status', 'crashed')
+            getService('incident').insert(
+                instanceId, crashedAt, process.exitCode.value, attempt,
+                'gaveup', restoredFrom=restoredFrom)
+            self._unforward(process.host, process.publicPort)
+            return self._notify('crashed', instanceId,
+                                exitCode=process.exitCode.value,
+                                restartIn=None)
+        restartedAt = time.time()
+        getService('incident').insert(
+            instanceId, crashedAt, process.exitCode.value, attempt,
+            'restarted', restoredFrom=restoredFrom, restartedAt=restartedAt)
+        logging.warning("Instance %s restarted %.1fs after its crash."
+                        % (instanceId, restartedAt - crashedAt))
+        self._notify('restarted', instanceId, mttr=restartedAt - crashedAt,
+                     restoredFrom=restoredFrom)
+
+
+# this module is a singleton
+_instance = None
+_lock = Lock()
+
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = Supervisor()
+    return _instance
+
+
+def addListener(listener):
+    return getInstance().addListener(listener)
+
+
+def onOutput(instanceId, data):
+    return getInstance().onOutput(instanceId, data)
+
+
+def get(instanceId):
+    return getInstance().get(instanceId)
+
+
+def running():
+    return getInstance().running()
+
+
+def start(instanceId):
+    return getInstance().start(instanceId)
+
+
+def stop(instanceId):
+    return getInstance().stop(instanceId)
+
+
+def place(instanceId):
+    return getInstance().place(instanceId)
+
+
+def adopt(process):
+    return getInstance().adopt(process)
+
+
+def placements():
+    return getInstance().placements()
+
+
+def replace(instanceId, backup=True):
+    return getInstance().replace(instanceId, backup)
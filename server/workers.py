@@ -0,0 +1,91 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Web worker processes of the multi-worker mode (see
+`Conf['server']['workers']`). Each worker is started with the command line
+of the server and `--worker <index>`, serves HTTP and websockets on the
+port of the server, shared with SO_REUSEPORT, and forwards the websocket
+messages to the main process (see server.rpc). The main process restarts
+the workers that exit.
+"""
+
+import time
+import signal
+import socket
+import logging
+import subprocess
+
+from server import scheduler
+
+WATCH_INTERVAL = 2  # in seconds
+STOP_TIMEOUT = 5  # in seconds
+
+
+def bindSockets(port):
+    """
+    Return the listening sockets of a worker, on all the interfaces.
+    """
+    sockets = []
+    for family, kind, proto, _, address in set(socket.getaddrinfo(
+            None, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+            socket.AI_PASSIVE)):
+        sock = socket.socket(family, kind, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(address[:2])
+        sock.listen(128)
+        sockets.append(sock)
+    return sockets
+
+
+class WorkerPool(object):
+    """
+    Starts `count` workers with the given command line, and keeps them
+    running.
+    """
+    def __init__(self, command, count):
+        super(WorkerPool, self).__init__()
+        self._command = command
+        self._count = count
+        self._processes = {}  # {index: subprocess.Popen}
+
+    def _spawn(self, index):
+        self._processes[index] = subprocess.Popen(
+            self._command + ['--worker', str(index)], close_fds=True)
+
+    def start(self):
+        for index in range(self._count):
+            self._spawn(index)
+        logging.info("Started %d web workers." % self._count)
+        scheduler.add('web-workers', self.check, interval=WATCH_INTERVAL,
+                      executor='ioloop')
+
+    def check(self):
+        """
+        Restart the workers that exited. Scheduled on the IOLoop.
+        """
+        for index, process in self._processes.items():
+            if process.poll() is not None:
+                logging.error("Web worker %d exited with the code %d, "
+                              "restarting it." % (index, process.returncode))
+                self._spawn(index)
+
+    def stop(self):
+        # a second Ctrl-C would leave the workers behind
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        scheduler.remove('web-workers')
+        for process in self._processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        deadline = time.time() + STOP_TIMEOUT
+        for process in self._processes.values():
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
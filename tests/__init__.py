@@ -0,0 +1,29 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Unit tests. Run from the root of the repository:
+    python -m unittest discover -s tests -t .
+Importing this package points Conf to temporary folders, so it must be
+imported before the modules reading Conf at import time (eg: tools.saves).
+"""
+
+import os
+import atexit
+import shutil
+import tempfile
+
+from conf import Conf
+
+workdir = tempfile.mkdtemp(prefix='miniboard-tests-')
+atexit.register(shutil.rmtree, workdir, True)
+for _folder in ('saves', 'config', 'logs'):
+    os.makedirs(os.path.join(workdir, _folder))
+
+# the factorio folders of Conf are given relative to the current one
+_path = os.path.relpath(workdir).replace(os.sep, '/')
+Conf['factorio']['savesFolder'] = _path + '/saves'
+Conf['factorio']['configFolder'] = _path + '/config'
+Conf['factorio']['logArchive']['folder'] = _path + '/logs'
+Conf['factorio']['storage']['minFreeSpace'] = 0
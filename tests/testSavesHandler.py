@@ -0,0 +1,66 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import io
+import zipfile
+
+from tests import workdir
+from tornado.web import Application
+from tornado.testing import AsyncHTTPTestCase
+
+from server.requestHandlers.savesHandler import SavesHandler
+
+savesFolder = os.path.join(workdir, 'saves')
+
+
+def archive(content):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        z.writestr('level.dat', content)
+    return buf.getvalue()
+
+
+class SavesHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application([(r"/savefiles/([^/]+)", SavesHandler)])
+
+    def tearDown(self):
+        super(SavesHandlerTest, self).tearDown()
+        for filename in os.listdir(savesFolder):
+            os.remove(os.path.join(savesFolder, filename))
+
+    def assertNoUploadLeft(self):
+        self.assertEqual([f for f in os.listdir(savesFolder)
+                          if f.startswith('.upload-')], [])
+
+    def put(self, filename, body, overwrite=False):
+        return self.fetch('/savefiles/%s%s' % (
+            filename, '?overwrite=1' if overwrite else ''),
+            method='PUT', body=body)
+
+    def testPut(self):
+        body = archive(b'map')
+        response = self.put('new.zip', body)
+        self.assertEqual(response.code, 201)
+        with open(os.path.join(savesFolder, 'new.zip'), 'rb') as f:
+            self.assertEqual(f.read(), body)
+        self.assertNoUploadLeft()
+        # downloaded back as uploaded
+        self.assertEqual(self.fetch('/savefiles/new.zip').body, body)
+
+    def testPutExisting(self):
+        self.assertEqual(self.put('save.zip', archive(b'old')).code, 201)
+        self.assertEqual(self.put('save.zip', archive(b'new')).code, 409)
+        body = archive(b'new')
+        self.assertEqual(self.put('save.zip', body, overwrite=True).code, 201)
+        with open(os.path.join(savesFolder, 'save.zip'), 'rb') as f:
+            self.assertEqual(f.read(), body)
+        self.assertNoUploadLeft()
+
+    def testPutInvalid(self):
+        self.assertEqual(self.put('broken.zip', b'not a zip').code, 400)
+        self.assertFalse(os.path.exists(
+            os.path.join(savesFolder, 'broken.zip')))
+        self.assertNoUploadLeft()
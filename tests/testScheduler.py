@@ -0,0 +1,55 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import time
+import unittest
+from datetime import datetime
+
+from server.scheduler import CronTrigger, SchedulerException
+
+
+def ts(*args):
+    return time.mktime(datetime(*args).timetuple())
+
+
+def nextRuns(spec, start, count=3):
+    trigger = CronTrigger(spec)
+    runs, now = [], ts(*start)
+    for _ in range(count):
+        now = trigger.next(None, now)
+        runs.append(datetime.fromtimestamp(now))
+    return runs
+
+
+class CronTriggerTest(unittest.TestCase):
+    # 2026-10-21 is a wednesday
+
+    def testSunday(self):
+        expected = [datetime(2026, 10, 25, 3), datetime(2026, 11, 1, 3),
+                    datetime(2026, 11, 8, 3)]
+        self.assertEqual(nextRuns('0 3 * * 0', (2026, 10, 21)), expected)
+        self.assertEqual(nextRuns('0 3 * * 7', (2026, 10, 21)), expected)
+
+    def testWeekdays(self):
+        self.assertEqual(nextRuns('30 8 * * 1-5', (2026, 10, 23, 9)), [
+            datetime(2026, 10, 26, 8, 30), datetime(2026, 10, 27, 8, 30),
+            datetime(2026, 10, 28, 8, 30)])
+
+    def testDayOfMonthOrDayOfWeek(self):
+        # the 13th, and every friday
+        self.assertEqual(nextRuns('0 0 13 * 5', (2026, 11, 1), 4), [
+            datetime(2026, 11, 6), datetime(2026, 11, 13),
+            datetime(2026, 11, 20), datetime(2026, 11, 27)])
+        # the 1st and the 15th
+        self.assertEqual(nextRuns('0 0 1,15 * *', (2026, 10, 21)), [
+            datetime(2026, 11, 1), datetime(2026, 11, 15),
+            datetime(2026, 12, 1)])
+        # a restricted day of week alone
+        self.assertEqual(nextRuns('0 0 * * 5', (2026, 11, 1), 2), [
+            datetime(2026, 11, 6), datetime(2026, 11, 13)])
+
+    def testInvalid(self):
+        for spec in ('* * *', '60 * * * *', '* * * * 8', '* * 0 * *',
+                     '5-1 * * * *', '*/0 * * * *', 'x * * * *'):
+            self.assertRaises(SchedulerException, CronTrigger, spec)
@@ -0,0 +1,233 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Compiles the client templates (the `.hbs` files of
+`Conf['server']['assets']['templates']`) into JavaScript functions, so
+that the pages don't need the Handlebars compiler. All the templates are
+bundled in a single script defining `Templates.<file name>(context)`,
+which returns the rendered HTML.
+
+The supported subset of Handlebars:
+* {{path}}, {{{path}}}: escaped and raw values. A path is `this`, or names
+  separated by dots, optionally after `this.`; `@index`, `@key`, `@first`
+  and `@last` in an each block
+* {{#if path}}, {{#unless path}}, {{#each path}}, with an optional
+  {{else}}, closed by {{/if}}, {{/unless}} or {{/each}}
+* {{! comments }}
+Anything else is rejected. The line breaks of the templates and the
+indentation that follows them are removed, as the continued lines of the
+JavaScript strings they come from.
+"""
+
+import os
+import re
+import json
+import random
+
+TAG = re.compile(r'(\{\{\{.*?\}\}\}|\{\{.*?\}\})', re.S)
+PATH = re.compile(r'^(?:this(?:\.[A-Za-z_$][\w$]*)*|[A-Za-z_$][\w$]*'
+                  r'(?:\.[A-Za-z_$][\w$]*)*|@(?:index|key|first|last))$')
+BLOCKS = ('if', 'unless', 'each')
+
+RUNTIME = """\
+var Templates = (function () {
+    var escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+                   "'": '&#x27;', '`': '&#x60;', '=': '&#x3D;'};
+    function isArray(value) {
+        return Object.prototype.toString.call(value) === '[object Array]';
+    }
+    function raw(value) {
+        return value === null || value === undefined ? '' : String(value);
+    }
+    function escape(value) {
+        return raw(value).replace(/[&<>"'`=]/g, function (c) {
+            return escapes[c];
+        });
+    }
+    function lookup(ctx, path) {
+        for (var i = 0; i < path.length; i++) {
+            if (ctx === null || ctx === undefined)
+                break;
+            ctx = ctx[path[i]];
+        }
+        return ctx;
+    }
+    function truthy(value) {
+        return isArray(value) ? value.length > 0 : !!value;
+    }
+    function each(value, fn, inverse) {
+        var out = '';
+        var keys = [];
+        if (isArray(value))
+            for (var i = 0; i < value.length; i++)
+                keys.push(i);
+        else if (value && typeof value === 'object')
+            keys = Object.keys(value);
+        for (var i = 0; i < keys.length; i++)
+            out += fn(value[keys[i]], {index: i, key: keys[i], first: i === 0,
+                                       last: i === keys.length - 1});
+        return keys.length || !inverse ? out : inverse();
+    }
+    return {
+%s
+    };
+})();
+"""
+
+
+class TemplateException(Exception):
+    pass
+
+
+def _parse(source, name):
+    """
+    Return the tree of the template: a list of nodes ('text', text),
+    ('value', path, escaped) and (block, path, body, inverse).
+    """
+    source = re.sub(r'\r?\n[ \t]*', '', source.strip())
+    root = []
+    stack = [(None, None, root, None)]  # open blocks
+    current = root
+    for index, token in enumerate(TAG.split(source)):
+        if index % 2 == 0:
+            if token:
+                current.append(('text', token))
+            continue
+        raw = token.startswith('{{{')
+        tag = token[3:-3] if raw else token[2:-2]
+        tag = tag.strip()
+        if not tag:
+            raise TemplateException("Empty tag %s in %s" % (token, name))
+        if tag.startswith('!'):
+            continue
+        if raw or tag[0] not in '#/':
+            if tag == 'else':
+                if stack[-1][0] is None or stack[-1][3] is not None:
+                    raise TemplateException("Unexpected {{else}} in %s"
+                                            % name)
+                current = []
+                stack[-1] = stack[-1][:3] + (current, )
+                continue
+            if not PATH.match(tag):
+                raise TemplateException("Unsupported expression {{%s}} in %s"
+                                        % (tag, name))
+            current.append(('value', tag, not raw))
+        elif tag[0] == '#':
+            parts = tag[1:].split()
+            if len(parts) != 2 or parts[0] not in BLOCKS or \
+                    not PATH.match(parts[1]):
+                raise TemplateException("Unsupported block {{%s}} in %s"
+                                        % (tag, name))
+            current = []
+            stack.append((parts[0], parts[1], current, None))
+        else:
+            block = tag[1:].strip()
+            if block != stack[-1][0]:
+                raise TemplateException("Unexpected {{/%s}} in %s"
+                                        % (block, name))
+            block, path, body, inverse = stack.pop()
+            current = stack[-1][3] if stack[-1][3] is not None \
+                else stack[-1][2]
+            current.append((block, path, body, inverse))
+    if len(stack) > 1:
+        raise TemplateException("Unclosed {{#%s}} in %s"
+                                % (stack[-1][0], name))
+    return root
+
+
+def _path(path, inEach):
+    if path.startswith('@'):
+        if not inEach:
+            raise TemplateException("%s used out of an each block" % path)
+        return 'data.%s' % path[1:]
+    names = path.split('.')
+    if names[0] == 'this':
+        names = names[1:]
+    if not names:
+        return 'ctx'
+    return 'lookup(ctx, %s)' % json.dumps(names)
+
+
+def _function(nodes, inEach, params='ctx, data'):
+    return 'function (%s) {var out = \'\';%s return out;}' % (
+        params, _statements(nodes, inEach))
+
+
+def _statements(nodes, inEach):
+    code = []
+    for node in nodes:
+        if node[0] == 'text':
+            code.append('out += %s;' % json.dumps(node[1]))
+        elif node[0] == 'value':
+            code.append('out += %s(%s);' % (
+                'escape' if node[2] else 'raw', _path(node[1], inEach)))
+        elif node[0] == 'each':
+            _, path, body, inverse = node
+            code.append('out += each(%s, %s%s);' % (
+                _path(path, inEach), _function(body, True),
+                ', %s' % _function(inverse, inEach, '')
+                if inverse is not None else ''))
+        else:
+            block, path, body, inverse = node
+            code.append('if (%struthy(%s)) {%s}' % (
+                '!' if block == 'unless' else '', _path(path, inEach),
+                _statements(body, inEach)))
+            if inverse is not None:
+                code.append('else {%s}' % _statements(inverse, inEach))
+    return ' '.join(code)
+
+
+def compile(source, name='template'):
+    """
+    Return the JavaScript function rendering the template source.
+    Raise a TemplateException if it isn't in the supported subset.
+    """
+    return _function(_parse(source, name), False, 'ctx')
+
+
+def sources(folder):
+    """
+    Return the paths of the templates of the folder, sorted.
+    """
+    return sorted(os.path.join(folder, filename)
+                  for filename in os.listdir(folder)
+                  if filename.endswith('.hbs'))
+
+
+def _modified(folder):
+    return max([os.path.getmtime(folder)] + [
+        os.path.getmtime(path) for path in sources(folder)])
+
+
+def version(folder):
+    """
+    Return the most recent modification time of the templates, changing
+    with the bundle.
+    """
+    return int(_modified(folder))
+
+
+def bundle(folder, target):
+    """
+    Compile the templates of the folder into the script `target`, unless
+    it is already there and newer than all of them.
+    Returns the path of the script.
+    """
+    if os.path.isfile(target) and \
+            os.path.getmtime(target) >= _modified(folder):
+        return target
+    functions = []
+    for path in sources(folder):
+        name = os.path.basename(path)[:-len('.hbs')]
+        with open(path) as f:
+            source = f.read().decode('utf8')
+        functions.append('        %s: %s' % (
+            json.dumps(name), compile(source, os.path.basename(path))))
+    # written aside then renamed, the file may be requested meanwhile
+    tmp = "%s.%d.tmp" % (target, random.randint(0, 10 ** 9))
+    with open(tmp, 'w') as f:
+        f.write((RUNTIME % ',\n'.join(functions)).encode('utf8'))
+    os.rename(tmp, target)
+    return target
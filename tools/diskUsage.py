@@ -0,0 +1,121 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Disk usage accounting.
+Each directory is listed with `scandir`, reusing the stat results of the
+directory entries, and its listing (size of each file and list of
+sub-directories) is cached along with the directory mtime. A scan only lists
+again the directories whose mtime changed, the directories of a same level
+being listed in parallel on a thread pool. Since the size of a file growing
+in place does not change the mtime of its directory, call `scan` with
+`full=True` to recompute everything.
+"""
+
+import os
+import logging
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from conf import Conf
+
+
+_executor = ThreadPoolExecutor(Conf['diskUsage']['workers'])
+# path -> (mtime, {filename: (size, mtime)}, [subdirectory paths])
+_listings = {}
+_lock = Lock()
+
+
+def _list(path, full=False):
+    """
+    Return the listing of a single directory, from the cache if its mtime
+    did not change.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _lock:
+        cached = _listings.get(path)
+    if cached is not None and cached[0] == mtime and not full:
+        return cached
+    files, subdirs = {}, []
+    try:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    files[entry.name] = (st.st_size, st.st_mtime)
+            except OSError:
+                pass  # removed while scanning
+    except OSError as e:
+        logging.warning("Unable to list folder %s: %s" % (path, str(e)))
+        return None
+    res = (mtime, files, subdirs)
+    with _lock:
+        _listings[path] = res
+    return res
+
+
+def scan(path, full=False):
+    """
+    Return a dict {directory path: listing} for `path` and all of its
+    sub-directories. The directories of a same depth are listed in parallel.
+    """
+    tree = {}
+    frontier = [path]
+    while frontier:
+        listings = _executor.map(lambda p: _list(p, full), frontier)
+        nextFrontier = []
+        for p, res in zip(frontier, listings):
+            if res is None:
+                continue
+            tree[p] = res
+            nextFrontier += res[2]
+        frontier = nextFrontier
+
+    # forget the directories that were removed
+    prefix = os.path.join(path, '')
+    with _lock:
+        for p in [p for p in _listings
+                  if p.startswith(prefix) and p not in tree]:
+            del _listings[p]
+    return tree
+
+
+def folderSize(path, full=False):
+    """
+    Return the total size in bytes of the files found in `path` and its
+    sub-directories.
+    """
+    return sum(sum(size for size, _ in files.itervalues())
+               for _, files, _ in scan(path, full).itervalues())
+
+
+def listing(path):
+    """
+    Return a tuple (mtime, {filename: (size, mtime)}) describing the files
+    directly in the `path` folder. The same dict is returned as long as the
+    folder content doesn't change.
+    """
+    res = _list(path)
+    if res is None:
+        return None, {}
+    return res[0], res[1]
+
+
+def filesSize(path, predicate):
+    """
+    Return the total size of the files directly in the `path` folder whose
+    name matches the given predicate.
+    """
+    return sum(size for name, (size, _) in listing(path)[1].iteritems()
+               if predicate(name))
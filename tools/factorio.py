@@ -6,6 +6,8 @@ from __future__ import unicode_literals
 Implements helper functions related to factorio server instances
 """
 
+import re
+import logging
 import subprocess
 import time
 import os
@@ -18,6 +20,7 @@ from fcntl import fcntl, F_GETFL, F_SETFL
 from os import O_NONBLOCK, read
 
 from conf import Conf
+from tools import storage, verify, placement, prewarm, recompress
 
 
 class FactorioException(Exception):
@@ -27,8 +30,91 @@ class FactorioException(Exception):
 configFolder = os.path.join(*Conf['factorio']['configFolder'].split('/'))
 savesFolder = os.path.join(*Conf['factorio']['savesFolder'].split('/'))
 binary = os.path.join(*Conf['factorio']['binary'].split('/'))
-PIDFILE = os.path.join('db', 'pidfile.txt')
+# host name of the instances run by this process, see server.cluster
+LOCAL = 'local'
+# one pid file per port, formatted with the port
+PIDFILE = os.path.join('db', 'pidfile.%s.txt')
+# write-data folder of the instances, formatted with their save: they write
+# their autosaves in its 'saves' folder, apart from the other instances
+WRITE_DATA = os.path.join(configFolder, 'instances', '%s')
+# mods of the default write-data folder, shared by the instances
+modsFolder = os.path.join(os.path.dirname(configFolder), 'mods')
 SAVE_INTERVAL = Conf['factorio']['autosaveInterval']
+# factorio saves the map and exits when receiving it
+if platform.system() == 'Windows':
+    STOP_SIGNAL = signal.CTRL_C_EVENT
+else:
+    STOP_SIGNAL = signal.SIGINT
+
+JOIN_PATTERN = re.compile(r'\[JOIN\] (.+) joined the game')
+LEAVE_PATTERN = re.compile(r'\[LEAVE\] (.+) left the game')
+# written once the map is loaded and the server accepts players
+READY_MARK = 'to(InGame)'
+
+
+def parseOutput(line):
+    """
+    Return the event described by a line of the server output, as a tuple
+    ('join', player name), ('leave', player name) or ('ready', None).
+    Return None if the line doesn't describe any of these events.
+    """
+    match = JOIN_PATTERN.search(line)
+    if match:
+        return 'join', match.group(1)
+    match = LEAVE_PATTERN.search(line)
+    if match:
+        return 'leave', match.group(1)
+    if READY_MARK in line:
+        return 'ready', None
+    return None
+
+
+def prewarmTargets(save):
+    """
+    Return the paths of the files read when starting a server with the given
+    save: the save, the factorio binary (the whole bundle on MacOS) and the
+    data folder if configured.
+    """
+    paths = [os.path.join(savesFolder, '%s.zip' % save), binary]
+    if Conf['prewarm']['dataFolder']:
+        paths.append(os.path.join(*Conf['prewarm']['dataFolder'].split('/')))
+    return paths
+
+
+def restoreSave(saveFile):
+    """
+    Make sure that the save at `saveFile` passes the integrity verification
+    (see tools.verify), replacing it with its most recent valid backup
+    generation otherwise. The packed generations (see tools.recompress),
+    the oldest ones, are only unpacked if no zip generation is valid.
+    Return the file name of the restored backup, None if the save was valid.
+    Raise a FactorioException if no valid generation is left.
+    """
+    if os.path.exists(saveFile) and verify.verify(saveFile)[0]:
+        return None
+    fam = storage.family(os.path.basename(saveFile))
+    generations = storage.ledger()['families'].get(fam, {}).get(
+        'generations', [])
+    backups = [filename for filename, _, _, kind in generations
+               if kind == 'backup']
+    for filename in backups:
+        if not filename.endswith('.zip'):
+            continue
+        path = os.path.join(savesFolder, filename)
+        if verify.verify(path)[0]:
+            shutil.copyfile(path, saveFile)
+            return filename
+    for filename in backups:
+        if not filename.endswith(recompress.SUFFIX):
+            continue
+        try:
+            # checked before replacing the save
+            recompress.unpack(os.path.join(savesFolder, filename), saveFile)
+            return filename
+        except Exception as e:
+            logging.error("Unable to unpack %s: %s" % (filename, str(e)))
+    raise FactorioException(
+        "No valid backup of %s found" % os.path.basename(saveFile))
 
 
 class Instance(Process):
@@ -36,84 +122,177 @@ class Instance(Process):
     def __init__(self, listeningPort, save, _id):
         super(Instance, self).__init__()
         self.port = str(listeningPort)
+        self.save = save
         self.saveFile = os.path.join(savesFolder, '%s.zip' % save)
+        self.writeData = WRITE_DATA % save
         self.logQueue = Queue()
         self.killed = Value('b')
         self.killed.value = 0
-        self.lastSave = time.time()
+        # set once the server accepts players
+        self.ready = Value('b')
+        self.ready.value = 0
+        # cleared when the save must not be written on exit, see `kill`
+        self.backupOnExit = Value('b')
+        self.backupOnExit.value = 1
         self.waitForPID = None
         self.subpid = Value('I')
+        # exit code of factorio, -1 if unknown
+        self.exitCode = Value('i')
+        self.exitCode.value = -1
+        self.pidfile = PIDFILE % self.port
+        # cpus factorio is pinned to, set by the supervisor before starting
+        self.cores = None
         self._id = _id
+        self.host = LOCAL
+        # port of the players, differs from `port` when relayed by
+        # server.forwarder
+        self.publicPort = self.port
+        # sockets of the main process, closed by the forked process so that
+        # it doesn't keep their port bound
+        self.inherited = []
+        # main process only: set when the stop was requested from the UI
+        self.stopRequested = False
+        # main process only: set when another process took over, see
+        # server.supervisor.replace
+        self.replaced = False
 
-    def ensureConfigExists(self):
+    def writeConfig(self):
         """
-        Make sure that the config file for the instance port is existing.
-        Create itt otherwise.
+        Write the config file of the instance, from the default one: with
+        the port and the write-data folder of the instance. Rewritten on
+        each start, since the save of the port may have changed.
         """
-        try:
-            # check that config exist for this port
-            f = open(os.path.join(
+        autosavesFolder = os.path.join(self.writeData, 'saves')
+        if not os.path.isdir(autosavesFolder):
+            os.makedirs(autosavesFolder)
+        writeData = 'write-data=%s\n' % os.path.abspath(self.writeData)
+        with open(os.path.join(
                 configFolder,
-                'config.%s.ini' % self.port), 'r')
-            f.close()
-        except IOError:
-            # config does not exist - create it
+                'config.%s.ini' % self.port), 'w') as newConfig:
             with open(os.path.join(
                     configFolder,
-                    'config.%s.ini' % self.port), 'w') as newConfig:
-                with open(os.path.join(
-                        configFolder,
-                        'config.ini' % self.port), 'r') as defaultConfig:
-                    for line in defaultConfig:
-                        try:
-                            k, v = line.split('=')
-                            if k == 'port':
-                                v = self.port + '\n'
-                            newConfig.write('%s=%s\n' % (k, v))
-                        except ValueError:
-                            newConfig.write(line)
+                    'config.ini'), 'r') as defaultConfig:
+                for line in defaultConfig:
+                    try:
+                        k, v = line.rstrip('\r\n').split('=')
+                        if k == 'port':
+                            v = self.port
+                        elif k == 'write-data':
+                            continue  # written after the section header
+                        newConfig.write('%s=%s\n' % (k, v))
+                    except ValueError:
+                        newConfig.write(line)
+                        if line.strip() == '[path]':
+                            newConfig.write(writeData)
+                            writeData = None
+            if writeData is not None:  # no [path] section
+                newConfig.write('\n[path]\n' + writeData)
 
-    def findMostRecentAutosave(self):
+    def findAutosaves(self):
         """
-        Find and return the path to the most recent auto-save file.
+        Return the paths to the auto-save files of the instance, most recent
+        first.
         """
+        folder = os.path.join(self.writeData, 'saves')
         autosaves = []
-        for file in os.listdir(savesFolder):
+        try:
+            files = os.listdir(folder)
+        except OSError:
+            files = []  # never started
+        for file in files:
             if file.startswith('_autosave'):
-                stat = os.stat(os.path.join(savesFolder, file))
+                stat = os.stat(os.path.join(folder, file))
                 autosaves.append(
-                    (os.path.join(savesFolder, file), stat.st_mtime))
+                    (os.path.join(folder, file), stat.st_mtime))
+
+        return [path for path, _ in
+                sorted(autosaves, key=lambda itm: itm[1], reverse=True)]
 
-        return sorted(autosaves, key=lambda itm: itm[1], reverse=True)[0][0]
+    def findMostRecentAutosave(self):
+        """
+        Find and return the path to the most recent auto-save file.
+        """
+        return self.findAutosaves()[0]
+
+    def findVerifiedAutosave(self):
+        """
+        Find and return the path to the most recent auto-save file that passes
+        the integrity verification (see tools.verify), None if there is none.
+        An auto-save can be truncated if factorio was killed while writing it.
+        """
+        for path in self.findAutosaves():
+            valid, error = verify.verify(path)
+            if valid:
+                return path
+            self.logQueue.put('[ERROR] Skipping corrupted autosave %s: %s'
+                              % (os.path.basename(path), error))
+        return None
 
     def backupSave(self):
         """
-        Backup the autosave, overriding initial save file and creating a backup
-        of the data.
+        Backup the autosave of the instance, overriding initial save file and
+        creating a new backup generation of the data.
+        Called when the instance stops, and every `SAVE_INTERVAL` minutes by
+        the server scheduler while it runs.
+        Only an auto-save that passed the integrity verification is promoted:
+        if none does, the current save is left untouched.
+        Old generations are evicted beforehand if needed to respect the
+        storage quotas and leave enough free space for both copies.
         """
-        src = self.findMostRecentAutosave()
+        src = self.findVerifiedAutosave()
+        if src is None:
+            self.logQueue.put('[ERROR] No valid autosave found, backup '
+                              'skipped.')
+            return
         dst1 = self.saveFile
-        dst2 = self.saveFile + '_back.zip'
+        dst2 = '%s_back_%s.zip' % (
+            self.saveFile, time.strftime('%Y%m%d-%H%M%S'))
+        storage.enforce(reserve=2 * os.path.getsize(src))
         shutil.copyfile(src, dst1)
         shutil.copyfile(src, dst2)
 
-    def execFactorioWindows(self):
-        self.ensureConfigExists()
+    def restoreSave(self):
+        """
+        Restore the save of the instance if needed, see `restoreSave`.
+        """
+        return restoreSave(self.saveFile)
+
+    def command(self, executable):
+        """
+        Return the command line starting the server with the given factorio
+        executable.
+        """
+        self.writeConfig()
         command = [
-            binary, '--config',
+            executable, '--config',
             os.path.join(configFolder, 'config.%s.ini' % self.port),
             '--start-server', self.saveFile,
-            '--autosave-interval', SAVE_INTERVAL]
+            '--autosave-interval', str(SAVE_INTERVAL)]
+        if os.path.isdir(modsFolder):
+            command += ['--mod-directory', modsFolder]
         if self.waitForPID is not None:
-            command += ['--wait-to-close', self.waitForPID]
+            command += ['--wait-to-close', str(self.waitForPID)]
+        return command
+
+    def writePid(self, pid):
+        with open(self.pidfile, 'w') as f:
+            f.write('%d' % pid)
+        self.subpid.value = pid
+        if Conf['placement']['enabled']:
+            placement.apply(pid, self.cores, 'game')
+
+    def removePid(self):
+        try:
+            os.remove(self.pidfile)
+        except OSError:
+            pass
+
+    def execFactorioWindows(self):
         p = subprocess.Popen(
-            command,
+            self.command(binary),
             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT)
-
-        with open(PIDFILE, 'w') as f:
-            f.write(p.pid + ' ' * 10)
-        self.subpid.value = p.pid
+        self.writePid(p.pid)
 
         # set the O_NONBLOCK flag of p.stdout file descriptor:
         flags = fcntl(p.stdout, F_GETFL)  # get current p.stdout flags
@@ -121,59 +300,98 @@ class Instance(Process):
 
         while not self.killed.value:
             try:
-                self.logQueue.put(read(p.stdout.fileno(), 1024))
+                data = read(p.stdout.fileno(), 1024)
+                if READY_MARK in data.decode('utf8', 'replace'):
+                    self.ready.value = 1
+                self.logQueue.put(data)
             except OSError:
                 # the os throws an exception if there is no data
-                self.logQueue.get('[No more data]')
+                self.logQueue.put('[No more data]')
                 break
             time.sleep(1)
-            # SAVE_INTERVAL is in minutes
-            if time.time() - self.lastSave > SAVE_INTERVAL * 60:
-                self.lastSave = time.time()
-                self.backupSave()
 
-        os.kill(self.subpid.value, signal.CTRL_C_EVENT)
+        os.kill(self.subpid.value, STOP_SIGNAL)
         time.sleep(2)
-        self.backupSave()
+        self.exitCode.value = p.poll() if p.poll() is not None else -1
+        self.removePid()
+        if self.backupOnExit.value:
+            self.backupSave()
         # os.kill(pid, signal.SIGINT)
         # os.kill(pid, signal.SIGHUP)
         # os.kill(pid, signal.SIGKILL)
 
-    def execFactorioMacOS(self):
-        raise FactorioException(
-            "Factorio execution is not supported on MacOS.")
+    def execFactorioPosix(self):
+        """
+        Run factorio until it exits, forwarding its output line by line.
+        The stop is requested by the main process, which sends STOP_SIGNAL
+        to factorio (see `kill`).
+        """
+        executable = binary
+        if executable.endswith('.app'):  # MacOS bundle
+            executable = os.path.join(
+                executable, 'Contents', 'MacOS', 'factorio')
+        p = subprocess.Popen(
+            self.command(executable),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, close_fds=True)
+        self.writePid(p.pid)
+        if self.killed.value:  # stop requested while starting
+            os.kill(p.pid, STOP_SIGNAL if self.backupOnExit.value
+                    else signal.SIGKILL)
 
-    def execFactorioLinux(self):
-        raise FactorioException(
-            "Factorio execution is not supported on Linux.")
+        # factorio closes its output when it exits
+        for line in iter(p.stdout.readline, b''):
+            line = line.decode('utf8', 'replace').rstrip()
+            self.logQueue.put(line)
+            if not self.ready.value and READY_MARK in line:
+                self.ready.value = 1
+                self.logQueue.put('[Startup] Joinable %.1fs after the start.'
+                                  % (time.time() - self.startedAt))
+        self.exitCode.value = p.wait()
+        self.removePid()
+        if self.backupOnExit.value:
+            self.backupSave()
 
     if platform.system() == 'Windows':
         execFactorio = execFactorioWindows
-    if platform.system() == 'Linux':
-        execFactorio = execFactorioLinux
-    else:  # macos?
-        execFactorio = execFactorioMacOS
+    else:  # Linux and MacOS
+        execFactorio = execFactorioPosix
 
     def run(self):
+        for sock in self.inherited:
+            sock.close()
         try:
-            with open(PIDFILE, 'r') as f:
-                pid = f.read().strip()
+            with open(self.pidfile, 'r') as f:
+                pid = int(f.read().strip())
             self.logQueue.put("Found a running factorio instance, killing it.")
-            os.kill(pid, signal.CTRL_C_EVENT)
+            os.kill(pid, STOP_SIGNAL)
             self.waitForPID = pid
             time.sleep(2)
-            # os.kill(pid, signal.SIGINT)
-            # os.kill(pid, signal.SIGHUP)
-            # os.kill(pid, signal.SIGKILL)
-        except IOError:
+        except (IOError, OSError, ValueError):
             pass  # couldn't kill the running instance, maybe it is not running
-        # TODO: test this code in an environment that can run the process
+        self.startedAt = time.time()
+        if Conf['prewarm']['enabled']:
+            self.prewarmSave()
         try:
             self.execFactorio()
         except Exception as e:
             self.logQueue.put('[ERROR] ' + str(e))
         self.killed.value = 1
 
+    def prewarmSave(self):
+        """
+        Start reading the save into the page cache while factorio starts, and
+        report which part of it was already there.
+        """
+        try:
+            stats = prewarm.prewarm([self.saveFile])
+        except Exception as e:
+            return self.logQueue.put('[ERROR] Unable to pre-warm the save: %s'
+                                     % str(e))
+        if stats['ratio'] is not None:
+            self.logQueue.put('[Startup] %d%% of the save was in the page '
+                              'cache.' % (100 * stats['ratio']))
+
     def read(self):
         """
         From the main process, read from the log queue and return whatever was
@@ -181,10 +399,22 @@ class Instance(Process):
         Return None if nothing was read.
         """
         try:
-            return self.logQueue.get()
+            return self.logQueue.get_nowait()
         except Empty:
             return None
 
-    def kill(self):
-        """ Expected to be called from the main process """
+    def kill(self, save=True):
+        """
+        Expected to be called from the main process. If not `save`, neither
+        factorio nor the backup on exit write the save.
+        """
+        self.stopRequested = True
         self.killed.value = 1
+        if not save:
+            self.backupOnExit.value = 0
+        if platform.system() != 'Windows' and self.subpid.value:
+            try:
+                os.kill(self.subpid.value,
+                        STOP_SIGNAL if save else signal.SIGKILL)
+            except OSError:
+                pass  # already stopped
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals, print_function
+
+"""
+Stand-in for the factorio headless server, to run the supervisor and the
+idle hibernation without the game. Set `Conf['factorio']['binary']` to the
+path of this script.
+It accepts the command line used by `tools.factorio.Instance`, listens on
+the UDP port of its config file and writes factorio-like log lines:
+* a datagram `JOIN <name>` or `LEAVE <name>` makes a player join or leave
+* a datagram `CRASH` makes the server exit with the code 1
+* SIGINT saves the map (touches the save file) and exits with the code 0
+Any other datagram is ignored.
+For the load tests (see benchmarks.loadTest), it can also write filler log
+lines at a steady rate, each holding the time it was written at, and copy
+the save to `_autosave<n>.zip` files on a schedule. Their options default
+to the `FAKE_FACTORIO_*` environment variables, since the command line is
+set by `tools.factorio.Instance`.
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import argparse
+
+START = time.time()
+
+
+def log(message):
+    print('%8.3f %s' % (time.time() - START, message))
+    sys.stdout.flush()
+
+
+def readConfig(configFile, name, default=None):
+    with open(configFile) as f:
+        for line in f:
+            key, _, value = line.partition('=')
+            if key.strip() == name:
+                return value.strip()
+    return default
+
+
+def env(name, default):
+    return os.environ.get('FAKE_FACTORIO_%s' % name, default)
+
+
+def autosave(saveFile, folder, slot):
+    """
+    Copy the save to the autosave `slot` of the folder, as factorio does.
+    """
+    name = '_autosave%d' % slot
+    log('Info AppManager.cpp: Saving to %s (non-blocking).' % name)
+    target = os.path.join(folder, '%s.zip' % name)
+    if os.path.exists(saveFile):
+        shutil.copyfile(saveFile, target)
+    else:
+        with open(target, 'wb') as f:
+            f.write(b'PK\x05\x06' + b'\x00' * 18)  # empty zip
+    log('Info AppManagerStates.cpp: Saving finished')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="fakeFactorio.py")
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--start-server', required=True)
+    parser.add_argument('--autosave-interval', type=int, default=10)
+    parser.add_argument('--wait-to-close', type=int)
+    parser.add_argument('--mod-directory')
+    parser.add_argument('--startup-delay', type=float,
+                        default=float(env('STARTUP_DELAY', 0.5)),
+                        help="Time spent loading the map, in seconds.")
+    parser.add_argument('--log-rate', type=float,
+                        default=float(env('LOG_RATE', 0)),
+                        help="Filler log lines written per second.")
+    parser.add_argument('--log-size', type=int,
+                        default=int(env('LOG_SIZE', 100)),
+                        help="Length of the filler log lines.")
+    parser.add_argument('--autosave-period', type=float,
+                        default=float(env('AUTOSAVE_PERIOD', 0)),
+                        help="Time between two autosaves, in seconds. "
+                        "Default: --autosave-interval minutes.")
+    parser.add_argument('--autosave-slots', type=int,
+                        default=int(env('AUTOSAVE_SLOTS', 3)))
+    return parser.parse_args()
+
+
+def main():
+    ns = parse_args()
+    stopping = []
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+
+    port = int(readConfig(ns.config, 'port', 34197))
+    # the saves folder of the write-data folder, as factorio
+    writeData = readConfig(ns.config, 'write-data')
+    autosaves = os.path.join(writeData, 'saves') if writeData else \
+        os.path.dirname(ns.start_server)
+    log('Loading map %s' % ns.start_server)
+    time.sleep(ns.startup_delay)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', port))
+    log('Hosting game at IP ADDR:({0.0.0.0:%d})' % port)
+    log('Info ServerMultiplayerManager.cpp: changing state from(CreatingGame) '
+        'to(InGame)')
+
+    logPeriod = 1. / ns.log_rate if ns.log_rate > 0 else None
+    autosavePeriod = ns.autosave_period or ns.autosave_interval * 60
+    nextLog = time.time()
+    nextAutosave = time.time() + autosavePeriod
+    slot = 0
+    while not stopping:
+        now = time.time()
+        while logPeriod is not None and nextLog <= now:
+            line = 'Info Benchmark.cpp: tick %.6f ' % time.time()
+            log(line + 'x' * max(0, ns.log_size - len(line) - 9))
+            nextLog += logPeriod
+        if nextAutosave <= now:
+            autosave(ns.start_server, autosaves, slot + 1)
+            slot = (slot + 1) % ns.autosave_slots
+            nextAutosave = now + autosavePeriod
+        wait = min(0.2, nextAutosave - now)
+        if logPeriod is not None:
+            wait = min(wait, nextLog - now)
+        sock.settimeout(max(wait, 0.001))
+        try:
+            data = sock.recv(1024).decode('utf8', 'replace').strip()
+        except socket.timeout:
+            continue
+        except socket.error:
+            continue  # interrupted by the signal
+        command, _, name = data.partition(' ')
+        if command == 'JOIN':
+            log('[JOIN] %s joined the game' % name)
+        elif command == 'LEAVE':
+            log('[LEAVE] %s left the game' % name)
+        elif command == 'CRASH':
+            log('Error: simulated crash')
+            sys.exit(1)
+
+    log('Saving game as %s' % ns.start_server)
+    if os.path.exists(ns.start_server):
+        os.utime(ns.start_server, None)
+    log('Goodbye')
+
+
+if __name__ == '__main__':
+    main()
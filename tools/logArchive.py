@@ -0,0 +1,270 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Per-instance archive of the factorio server output.
+The output is stored in gzip segments, one per time bucket (see
+`Conf['factorio']['logArchive']['bucket']`). Each flush appends a new gzip
+member to the segment of the current bucket, so a segment is always a valid
+gzip file and any member can be decompressed on its own from its offset.
+Each archive folder also holds an sqlite database with:
+* chunks: timestamp -> (segment, offset) of each gzip member
+* lines: timestamp and position (chunk, line number) of each line
+* lines_fts: contentless FTS4 full text index of the lines, sharing its
+  rowid with `lines`
+Searching only decompresses the members holding matching lines.
+"""
+
+import os
+import time
+import zlib
+import gzip
+import logging
+import sqlite3
+from datetime import datetime
+from threading import Lock
+
+from conf import Conf
+from tools import utils
+
+
+class LogArchiveException(Exception):
+    pass
+
+
+archiveFolder = os.path.join(
+    *Conf['factorio']['logArchive']['folder'].split('/'))
+BUCKET = Conf['factorio']['logArchive']['bucket']
+FLUSH_INTERVAL = Conf['factorio']['logArchive']['flushInterval']
+
+
+class LogArchive(object):
+    """
+    Archive of the output of a single instance.
+    `append` can be called from any thread, the data is written to disk by
+    `flushAll`, run periodically by the scheduler. `search` opens its own
+    connection and can be called from any thread as well.
+    """
+    def __init__(self, instanceId):
+        super(LogArchive, self).__init__()
+        self._id = instanceId
+        self.folder = os.path.join(archiveFolder, instanceId)
+        self.dbPath = os.path.join(self.folder, 'index.db')
+        self._pending = []  # list of (timestamp, line)
+        self._partial = ''
+        self._lock = Lock()
+        self._lastFlush = time.time()
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        # only used by `flush`
+        self._connection = None
+
+    def _connect(self):
+        # flushAll never runs concurrently but may run on any worker thread
+        connection = sqlite3.connect(self.dbPath, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (_id INTEGER PRIMARY KEY, "
+            "ts real, segment text, offset integer)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS lines (_id INTEGER PRIMARY KEY, "
+            "chunk integer, ts real, lineno integer)")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS lines_ts ON lines (ts)")
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts "
+            "USING fts4(content=\"\", text)")
+        connection.commit()
+        return connection
+
+    def append(self, data, ts=None):
+        """
+        Append raw output to the archive. `data` does not need to be made of
+        complete lines, an unterminated line will be completed by the
+        following calls.
+        """
+        ts = ts or time.time()
+        if isinstance(data, bytes):
+            data = data.decode('utf8', 'replace')
+        with self._lock:
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+            self._pending += [(ts, line.rstrip('\r')) for line in lines
+                              if line.strip()]
+
+    def needsFlush(self):
+        return len(self._pending) > 0 and \
+            time.time() - self._lastFlush >= FLUSH_INTERVAL
+
+    def flush(self, final=False):
+        """
+        Write the pending lines as a new gzip member of the current segment
+        and index them. Not thread safe: only called from `flushAll`.
+        If `final` is True, the unterminated line is flushed as well.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if final and self._partial.strip():
+                pending.append((time.time(), self._partial))
+                self._partial = ''
+        self._lastFlush = time.time()
+        if not pending:
+            return
+        if self._connection is None:
+            self._connection = self._connect()
+
+        # a flush never spans two buckets
+        byBucket = []
+        for ts, line in pending:
+            bucket = int(ts // BUCKET) * BUCKET
+            if not byBucket or byBucket[-1][0] != bucket:
+                byBucket.append((bucket, []))
+            byBucket[-1][1].append((ts, line))
+
+        cur = self._connection.cursor()
+        for bucket, lines in byBucket:
+            segment = datetime.fromtimestamp(bucket).strftime(
+                '%Y%m%d-%H%M%S.log.gz')
+            path = os.path.join(self.folder, segment)
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(path, 'ab') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    gz.write('\n'.join(l for _, l in lines).encode('utf8'))
+            cur.execute("INSERT INTO chunks (ts, segment, offset) "
+                        "VALUES (?, ?, ?)", (lines[0][0], segment, offset))
+            chunk = cur.lastrowid
+            for lineno, (ts, line) in enumerate(lines):
+                cur.execute("INSERT INTO lines (chunk, ts, lineno) "
+                            "VALUES (?, ?, ?)", (chunk, ts, lineno))
+                cur.execute("INSERT INTO lines_fts (docid, text) "
+                            "VALUES (?, ?)", (cur.lastrowid, line))
+        self._connection.commit()
+
+    def close(self):
+        self.flush(final=True)
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _readChunk(self, segment, offset):
+        """
+        Decompress the gzip member found at `offset` in `segment` and return
+        its lines.
+        """
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = []
+        with open(os.path.join(self.folder, segment), 'rb') as f:
+            f.seek(offset)
+            while not decompressor.unused_data:
+                buf = f.read(16384)
+                if not buf:
+                    break
+                data.append(decompressor.decompress(buf))
+        return b''.join(data).decode('utf8').split('\n')
+
+    def search(self, query=None, start=None, end=None, limit=200):
+        """
+        Return up to `limit` archived lines matching the FTS `query`, if any,
+        and written between the `start` and `end` timestamps (both optional),
+        most recent last, as a list of dicts holding the fields:
+        * ts: timestamp of the line
+        * date: formatted date of the line
+        * line: content of the line
+        """
+        if not os.path.exists(self.dbPath):
+            return []
+        where, params = [], []
+        if query:
+            where.append(
+                "l._id IN (SELECT docid FROM lines_fts WHERE text MATCH ?)")
+            params.append(query)
+        if start is not None:
+            where.append("l.ts >= ?")
+            params.append(float(start))
+        if end is not None:
+            where.append("l.ts <= ?")
+            params.append(float(end))
+        sql = ("SELECT l.ts, l.lineno, c._id, c.segment, c.offset "
+               "FROM lines l JOIN chunks c ON c._id = l.chunk")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY l._id DESC LIMIT ?"
+        params.append(int(limit))
+
+        connection = sqlite3.connect(self.dbPath)
+        try:
+            rows = connection.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            raise LogArchiveException("Invalid search `%s': %s"
+                                      % (query, str(e)))
+        finally:
+            connection.close()
+
+        chunks = {}
+        res = []
+        for ts, lineno, chunk, segment, offset in reversed(rows):
+            if chunk not in chunks:
+                chunks[chunk] = self._readChunk(segment, offset)
+            res.append({
+                'ts': ts,
+                'date': utils.dateFormat(ts),
+                'line': chunks[chunk][lineno]
+            })
+        return res
+
+
+_archives = {}
+_lock = Lock()
+# flushAll and closeAll never run concurrently
+_flushLock = Lock()
+
+
+def getArchive(instanceId):
+    """
+    Return the archive of the given instance, creating it if necessary.
+    """
+    with _lock:
+        if instanceId not in _archives:
+            _archives[instanceId] = LogArchive(instanceId)
+    return _archives[instanceId]
+
+
+def flushAll():
+    """
+    Write the pending lines of all the archives. Scheduled on a worker
+    thread, so that neither the compression nor the sqlite commits happen on
+    the IOLoop thread.
+    """
+    with _flushLock:
+        with _lock:
+            archives = _archives.values()
+        for archive in archives:
+            try:
+                if archive.needsFlush():
+                    archive.flush()
+            except Exception as e:
+                logging.exception(e)
+
+
+def closeAll():
+    """
+    Write the pending lines of all the archives, unterminated lines
+    included, and close their connections. Called once the server stops.
+    """
+    with _flushLock:
+        with _lock:
+            archives = _archives.values()
+        for archive in archives:
+            try:
+                archive.close()
+            except Exception as e:
+                logging.exception(e)
+
+
+def append(instanceId, data):
+    getArchive(instanceId).append(data)
+
+
+def search(instanceId, query=None, start=None, end=None, limit=200):
+    return getArchive(instanceId).search(query, start, end, limit)
@@ -0,0 +1,198 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+CPU placement of the processes of the server.
+Each factorio server is pinned to its own set of physical cores (with their
+SMT siblings), and runs with a high CPU and I/O priority. The first
+`Conf['placement']['reservedCores']` physical cores are kept for the web
+server and its background jobs, which run with the idle priority classes
+(see `background`).
+Without a manual assignment, the least loaded free physical cores are
+chosen (see `plan`). When there are not enough of them, the instances share
+the least loaded ones.
+
+A core set is written as a list of logical cpu ids and ranges, eg: '2,3'
+or '4-7'.
+"""
+
+import os
+import sys
+import glob
+import logging
+
+import psutil
+
+from conf import Conf
+
+
+class PlacementException(Exception):
+    pass
+
+
+def topology():
+    """
+    Return the physical cores of the host, as a list of sorted lists of
+    logical cpu ids (SMT siblings), sorted by first cpu id.
+    Without topology information (outside of Linux), each logical cpu is
+    considered a physical core.
+    """
+    cores = {}
+    for path in glob.glob('/sys/devices/system/cpu/cpu[0-9]*/topology'):
+        cpu = int(path.split('/')[-2][3:])
+        try:
+            with open(os.path.join(path, 'physical_package_id')) as f:
+                package = int(f.read())
+            with open(os.path.join(path, 'core_id')) as f:
+                core = int(f.read())
+        except (IOError, ValueError):
+            continue
+        cores.setdefault((package, core), []).append(cpu)
+    if not cores:
+        return [[cpu] for cpu in range(psutil.cpu_count())]
+    return sorted(sorted(cpus) for cpus in cores.itervalues())
+
+
+def parseCores(spec):
+    """
+    Return the sorted list of logical cpu ids of the core set `spec`, None
+    if `spec` is empty (automatic placement).
+    """
+    if not spec or not spec.strip():
+        return None
+    count = psutil.cpu_count()
+    cpus = set()
+    try:
+        for part in spec.split(','):
+            start, _, end = part.strip().partition('-')
+            cpus.update(range(int(start), int(end or start) + 1))
+    except ValueError:
+        raise PlacementException("Invalid core set: %s" % spec)
+    if not cpus or min(cpus) < 0 or max(cpus) >= count:
+        raise PlacementException("Invalid core set %s: this host has %d cpus"
+                                 % (spec, count))
+    return sorted(cpus)
+
+
+def formatCores(cpus):
+    """
+    Return the compact notation of the list of cpu ids, eg: '0-3,6'.
+    """
+    if not cpus:
+        return ''
+    cpus = sorted(cpus)
+    ranges = [[cpus[0], cpus[0]]]
+    for cpu in cpus[1:]:
+        if cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join('%d' % a if a == b else '%d-%d' % (a, b)
+                    for a, b in ranges)
+
+
+def reserved():
+    """
+    Return the logical cpu ids kept for the web server, None if the host
+    is too small to reserve any.
+    """
+    cores = topology()
+    count = Conf['placement']['reservedCores']
+    if not count or len(cores) <= count:
+        return None
+    return sorted(cpu for core in cores[:count] for cpu in core)
+
+
+def plan(manual, assigned, load=None):
+    """
+    Return the logical cpu ids to pin a new instance to, None to leave it
+    unpinned.
+    * manual: core set given by the operator (see `parseCores`), used as is
+    * assigned: list of the core sets of the other running instances
+    * load: usage percentage of each logical cpu, by cpu id
+    """
+    if manual is not None:
+        return manual
+    cores = topology()
+    keep = reserved()
+    if keep is not None:
+        cores = [core for core in cores if core[0] not in keep]
+    if not cores:
+        return None
+    load = load or [0] * psutil.cpu_count()
+    used = set(cpu for cpus in assigned if cpus for cpu in cpus)
+
+    def coreLoad(core):
+        return sum(load[cpu] for cpu in core if cpu < len(load)) / len(core)
+    free = [core for core in cores if not used.intersection(core)]
+    # share the least loaded cores when there are not enough free ones
+    candidates = sorted(free if len(free) >= Conf['placement']['cores']
+                        else cores, key=coreLoad)
+    return sorted(cpu for core in candidates[:Conf['placement']['cores']]
+                  for cpu in core)
+
+
+def apply(pid, cpus=None, role=None):
+    """
+    Pin the process to the given logical cpus (if any), and set its CPU and
+    I/O priorities for its role:
+    * 'game': high priorities, the nice value is `Conf['placement']['nice']`
+      (negative values need the CAP_SYS_NICE capability)
+    * 'background': idle priority classes
+    Failures are logged, the process keeps running as is.
+    """
+    try:
+        proc = psutil.Process(pid)
+    except psutil.Error as e:
+        logging.warning("Unable to place process %d: %s" % (pid, str(e)))
+        return
+    try:
+        if cpus is not None:
+            proc.cpu_affinity(cpus)
+    except (psutil.Error, AttributeError, ValueError, OSError) as e:
+        logging.warning("Unable to pin process %d to cpus %s: %s"
+                        % (pid, formatCores(cpus), str(e)))
+    windows = sys.platform.startswith('win')
+    linux = sys.platform.startswith('linux')
+    try:
+        if role == 'game':
+            proc.nice(psutil.HIGH_PRIORITY_CLASS if windows
+                      else Conf['placement']['nice'])
+            if linux:
+                proc.ionice(psutil.IOPRIO_CLASS_BE, 0)
+            elif windows:
+                proc.ionice(2)  # normal, the highest allowed
+        elif role == 'background':
+            proc.nice(psutil.IDLE_PRIORITY_CLASS if windows else 19)
+            if linux:
+                proc.ionice(psutil.IOPRIO_CLASS_IDLE)
+            elif windows:
+                proc.ionice(0)  # very low
+    except (psutil.Error, AttributeError, ValueError, OSError) as e:
+        logging.warning("Unable to set the %s priorities of process %d: %s"
+                        % (role, pid, str(e)))
+
+
+def background():
+    """
+    Give the current process the lowest CPU and I/O priorities. Called by
+    the worker processes of the CPU or I/O heavy jobs.
+    """
+    apply(os.getpid(), role='background')
+
+
+def current(pid):
+    """
+    Return the placement of the process as a dict holding the fields cores
+    (compact notation, None if unknown) and nice, None if the process is
+    gone.
+    """
+    try:
+        proc = psutil.Process(pid)
+        res = {'nice': proc.nice(), 'cores': None}
+        if hasattr(proc, 'cpu_affinity'):  # not available on MacOS
+            res['cores'] = formatCores(proc.cpu_affinity())
+        return res
+    except psutil.Error:
+        return None
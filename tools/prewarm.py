@@ -0,0 +1,141 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Page cache pre-warming of the files read when a factorio server starts:
+its save, the factorio binary and data folder.
+`prewarm` asks the kernel to read the files ahead with
+`posix_fadvise(POSIX_FADV_WILLNEED)` (Linux), and falls back to reading
+them once where it isn't available. Before that, it measures which part of
+the files was already resident in the page cache with `mincore`, so that
+the benefit of the pre-warming can be followed.
+Both system calls are made through ctypes, and are skipped on the platforms
+that don't provide them.
+"""
+
+import os
+import sys
+import mmap
+import time
+import ctypes
+import ctypes.util
+import logging
+
+
+POSIX_FADV_WILLNEED = 3
+PROT_READ = 0x1
+MAP_SHARED = 0x1
+READ_CHUNK = 1024 * 1024
+
+
+def _loadLibc():
+    if not (sys.platform.startswith('linux') or sys.platform == 'darwin'):
+        return None, None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                              ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_void_p]
+    except (OSError, AttributeError, TypeError) as e:
+        logging.warning("Page cache residency unavailable: %s" % str(e))
+        return None, None
+    try:
+        fadvise = libc.posix_fadvise
+        fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long,
+                            ctypes.c_int]
+    except AttributeError:  # MacOS
+        fadvise = None
+    return libc, fadvise
+
+
+_libc, _fadvise = _loadLibc()
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def resident(path):
+    """
+    Return the number of bytes of the file that are in the page cache, None
+    if it can't be measured.
+    """
+    size = os.path.getsize(path)
+    if _libc is None:
+        return None
+    if size == 0:
+        return 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = _libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if addr is None or addr == MAP_FAILED:
+            return None
+        try:
+            pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+            vec = (ctypes.c_ubyte * pages)()
+            if _libc.mincore(addr, size, vec) != 0:
+                return None
+            count = sum(1 for page in vec if page & 1)
+        finally:
+            _libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    return min(size, count * mmap.PAGESIZE)
+
+
+def advise(path):
+    """
+    Start reading the file into the page cache. Asynchronous where
+    posix_fadvise is available, reads the whole file otherwise.
+    """
+    with open(path, 'rb') as f:
+        if _fadvise is not None and \
+                _fadvise(f.fileno(), 0, 0, POSIX_FADV_WILLNEED) == 0:
+            return
+        while f.read(READ_CHUNK):
+            pass
+
+
+def _files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    yield os.path.join(root, filename)
+        elif os.path.isfile(path):
+            yield path
+
+
+def prewarm(paths):
+    """
+    Pre-warm the given files, and the files of the given folders.
+    Returns a dict holding the fields:
+    * files: number of files
+    * size: their total size in bytes
+    * resident: bytes already in the page cache beforehand, None if unknown
+    * ratio: resident / size, None if unknown
+    * duration: time spent, in seconds
+    """
+    t0 = time.time()
+    files, size, cached = 0, 0, 0
+    for path in _files(paths):
+        try:
+            fileSize = os.path.getsize(path)
+            fileCached = resident(path)
+            advise(path)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to pre-warm %s: %s" % (path, str(e)))
+            continue
+        files += 1
+        size += fileSize
+        cached = None if cached is None or fileCached is None \
+            else cached + fileCached
+    return {
+        'files': files,
+        'size': size,
+        'resident': cached,
+        'ratio': float(cached) / size if cached is not None and size
+        else None,
+        'duration': time.time() - t0
+    }
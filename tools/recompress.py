@@ -0,0 +1,348 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Background recompression of the old backup generations.
+Factorio writes its saves with a fast deflate. Backups older than
+`Conf['factorio']['recompress']['olderThan']` are packed into a `.fpk`
+archive: the members of the zip are inflated and the whole stream is
+compressed again with the strongest available codec (zstd if the
+`zstandard` module is installed, lzma if the `lzma` or `backports.lzma`
+module is, bz2 otherwise).
+`unpack` re-inflates a packed archive into a regular zip that Factorio can
+load.
+A backup is only replaced by its packed archive if it is smaller: the zip
+of an incompressible save is kept, and not tried again until the server
+restarts.
+Packing runs in a separate process with the lowest CPU and I/O priorities,
+and reads no more than `bytesPerSecond` bytes per second, so it never
+competes with the running servers.
+
+Format of a `.fpk` file: the magic `FPK1`, the codec name terminated by a
+new line, then the compressed stream of the members. Each member is a
+4 bytes big endian length, a json header of that length (name, date_time,
+external_attr, file_size, CRC) and the member data.
+"""
+
+import os
+import json
+import time
+import zlib
+import struct
+import zipfile
+import logging
+import tempfile
+import multiprocessing
+from Queue import Empty
+
+from conf import Conf
+from tools import saves, storage, verify, placement
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+import bz2
+
+
+MAGIC = b'FPK1'
+SUFFIX = storage.PACKED_SUFFIX
+CHUNK_SIZE = 256 * 1024
+RESULTS_POLL = 5  # in seconds, checks of the worker process while waiting
+
+# names of the backups which packing doesn't shrink, see `recompressOld`
+_kept = set()
+
+
+class RecompressException(Exception):
+    pass
+
+
+def bestCodec():
+    if zstandard is not None:
+        return 'zstd'
+    if lzma is not None:
+        return 'lzma'
+    return 'bz2'
+
+
+def _compressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=19).compressobj()
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=9)
+    return bz2.BZ2Compressor(9)
+
+
+def _decompressor(codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RecompressException("zstandard is required to unpack")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'lzma':
+        if lzma is None:
+            raise RecompressException("lzma is required to unpack")
+        return lzma.LZMADecompressor()
+    return bz2.BZ2Decompressor()
+
+
+class Throttle(object):
+    """
+    Sleep as needed to keep the throughput under `bytesPerSecond`.
+    """
+    def __init__(self, bytesPerSecond):
+        self.bytesPerSecond = bytesPerSecond
+        self.start = time.time()
+        self.count = 0
+
+    def __call__(self, count):
+        self.count += count
+        if not self.bytesPerSecond:
+            return
+        late = self.count / float(self.bytesPerSecond) - \
+            (time.time() - self.start)
+        if late > 0:
+            time.sleep(late)
+
+
+def pack(path, bytesPerSecond=None, codec=None):
+    """
+    Pack the zip archive at `path` into `path + SUFFIX` and remove the zip,
+    unless the packed archive isn't smaller: it is removed, and the zip
+    kept.
+    Returns a dict holding the fields filename, codec, packed (False if the
+    zip was kept), originalSize, packedSize and duration.
+    """
+    t0 = time.time()
+    codec = codec or bestCodec()
+    throttle = Throttle(bytesPerSecond)
+    compressor = _compressor(codec)
+    dst = path + SUFFIX
+    fd, tmp = tempfile.mkstemp(prefix='.pack-', suffix='.tmp',
+                               dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as out, zipfile.ZipFile(path) as archive:
+            out.write(MAGIC + codec.encode('ascii') + b'\n')
+            for info in archive.infolist():
+                header = json.dumps({
+                    'name': info.filename,
+                    'date_time': info.date_time,
+                    'external_attr': info.external_attr,
+                    'file_size': info.file_size,
+                    'CRC': info.CRC
+                }).encode('utf8')
+                out.write(compressor.compress(
+                    struct.pack(b'>I', len(header)) + header))
+                crc = 0
+                member = archive.open(info)
+                while True:
+                    chunk = member.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    out.write(compressor.compress(chunk))
+                    throttle(len(chunk))
+                if crc & 0xffffffff != info.CRC:
+                    raise RecompressException(
+                        "CRC mismatch for %s in %s" % (info.filename, path))
+            out.write(compressor.flush())
+        # keep the date of the backup, used to sort the generations
+        stat = os.stat(path)
+        packedSize = os.path.getsize(tmp)
+        packed = packedSize < stat.st_size
+        if packed:
+            os.utime(tmp, (stat.st_atime, stat.st_mtime))
+            os.rename(tmp, dst)
+    except:
+        os.remove(tmp)
+        raise
+    os.remove(path if packed else tmp)
+    return {
+        'filename': os.path.basename(path),
+        'codec': codec,
+        'packed': packed,
+        'originalSize': stat.st_size,
+        'packedSize': packedSize,
+        'duration': time.time() - t0
+    }
+
+
+class _Reader(object):
+    """
+    File-like reader of the decompressed stream of a packed archive.
+    """
+    def __init__(self, f, decompressor):
+        self._f = f
+        self._decompressor = decompressor
+        self._buf = b''
+        self._pos = 0
+
+    def read(self, size):
+        while len(self._buf) - self._pos < size:
+            data = self._f.read(CHUNK_SIZE)
+            if not data:
+                break
+            self._buf = self._buf[self._pos:] + \
+                self._decompressor.decompress(data)
+            self._pos = 0
+        res = self._buf[self._pos:self._pos + size]
+        self._pos += len(res)
+        return res
+
+
+def unpack(path, dst=None):
+    """
+    Re-inflate the packed archive at `path` into a regular zip archive at
+    `dst` (by default, `path` without its suffix). The packed archive is
+    left in place.
+    Each member is first extracted to a temporary file, so that memory usage
+    does not depend on the size of the members.
+    """
+    dst = dst or path[:-len(SUFFIX)]
+    folder = os.path.dirname(dst)
+    fd, tmpZip = tempfile.mkstemp(prefix='.unpack-', suffix='.tmp',
+                                  dir=folder)
+    os.close(fd)
+    fd, tmpMember = tempfile.mkstemp(prefix='.member-', suffix='.tmp',
+                                     dir=folder)
+    os.close(fd)
+    try:
+        with open(path, 'rb') as f, \
+                zipfile.ZipFile(tmpZip, 'w', zipfile.ZIP_DEFLATED) as out:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise RecompressException("%s is not a packed save" % path)
+            codec = f.readline().strip().decode('ascii')
+            reader = _Reader(f, _decompressor(codec))
+            while True:
+                length = reader.read(4)
+                if not length:
+                    break
+                header = json.loads(reader.read(
+                    struct.unpack(b'>I', length)[0]).decode('utf8'))
+                remaining = header['file_size']
+                with open(tmpMember, 'wb') as member:
+                    while remaining > 0:
+                        chunk = reader.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise RecompressException(
+                                "%s is truncated" % path)
+                        remaining -= len(chunk)
+                        member.write(chunk)
+                # zipfile takes the member date from the file mtime
+                mtime = time.mktime(tuple(header['date_time']) + (0, 0, -1))
+                os.utime(tmpMember, (mtime, mtime))
+                out.write(tmpMember, header['name'])
+                out.getinfo(header['name']).external_attr = \
+                    header['external_attr']
+        verify.checkArchive(tmpZip)
+        stat = os.stat(path)
+        os.utime(tmpZip, (stat.st_atime, stat.st_mtime))
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(tmpZip, dst)
+    except:
+        if os.path.exists(tmpZip):
+            os.remove(tmpZip)
+        raise
+    finally:
+        os.remove(tmpMember)
+    return dst
+
+
+def candidates(olderThan):
+    """
+    Return the paths of the backup generations older than `olderThan`
+    seconds that are not packed yet, nor known not to shrink.
+    """
+    limit = time.time() - olderThan
+    res = []
+    for filename in os.listdir(saves.savesFolder):
+        path = os.path.join(saves.savesFolder, filename)
+        if storage.kind(filename) == 'backup' and \
+                filename.endswith('.zip') and filename not in _kept and \
+                os.path.getmtime(path) < limit:
+            res.append(path)
+    return res
+
+
+def _packAll(paths, bytesPerSecond, results):
+    """
+    Worker process: pack the given archives one after another, putting the
+    result of each in the `results` queue (None once done).
+    """
+    placement.background()
+    for path in paths:
+        try:
+            valid, error = verify.verify(path)
+            if not valid:
+                raise RecompressException("%s is corrupted: %s"
+                                          % (path, error))
+            results.put(pack(path, bytesPerSecond))
+        except Exception as e:
+            results.put({'error': '%s: %s' % (os.path.basename(path), str(e))})
+    results.put(None)
+
+
+def recompressOld(onPacked=None):
+    """
+    Pack the backups older than `Conf['factorio']['recompress']['olderThan']`
+    in a low priority worker process, and wait for it to be done. Scheduled
+    by the server.
+    `onPacked` is called with the result of each packed backup (see `pack`,
+    the `family` field is added), not for the kept ones.
+    Raises a RecompressException if the worker process dies before it is
+    done.
+    """
+    options = Conf['factorio']['recompress']
+    paths = candidates(options['olderThan'])
+    if not paths:
+        return
+    logging.info("Recompressing %d old backups" % len(paths))
+    results = multiprocessing.Queue()
+    worker = multiprocessing.Process(
+        target=_packAll, args=(paths, options['bytesPerSecond'], results))
+    worker.daemon = True
+    worker.start()
+    alive = True
+    while True:
+        try:
+            res = results.get(timeout=RESULTS_POLL)
+        except Empty:
+            if alive:
+                # poll once more, its last results may still be in transit
+                alive = worker.is_alive()
+                continue
+            worker.join()
+            saves.list.invalidate()
+            raise RecompressException(
+                "The recompression process died (exit code: %s)"
+                % worker.exitcode)
+        if res is None:
+            break
+        if 'error' in res:
+            logging.error("Unable to recompress %s" % res['error'])
+            continue
+        if not res.pop('packed'):
+            _kept.add(res['filename'])
+            logging.info(
+                "Kept %s, packed with %s it would be %.1f%% of its size"
+                % (res['filename'], res['codec'],
+                   100.0 * res['packedSize'] / max(1, res['originalSize'])))
+            continue
+        res['family'] = storage.family(res['filename'])
+        logging.info(
+            "Recompressed %s with %s: %.1f%% of the original size"
+            % (res['filename'], res['codec'],
+               100.0 * res['packedSize'] / max(1, res['originalSize'])))
+        if onPacked is not None:
+            onPacked(res)
+    worker.join()
+    saves.list.invalidate()
@@ -10,6 +10,7 @@ import os
 import logging
 
 from conf import Conf
+from server import memory
 from tools import utils
 
 
@@ -17,6 +18,11 @@ class SavesException(Exception):
     pass
 
 
+savesFolder = '/' if Conf['factorio']['savesFolder'][0] == '/' else ''
+savesFolder += os.path.join(*Conf['factorio']['savesFolder'].split('/'))
+
+
+@memory.memoize('saves', **Conf['cache']['saves'])
 def list():
     """
     Returns the list of saves found in Factorio's saves folder as a dict
@@ -24,12 +30,11 @@ def list():
     * name: name of the save (filename stripped off of its .zip extension)
     * date: date of the save
     * size: size of the archive
+    The result is cached for a few seconds, call `list.invalidate()` after
+    changing the content of the saves folder.
     """
-    # import ipdb; ipdb.set_trace()
-    dirpath = '/' if Conf['factorio']['savesFolder'][0] == '/' else ''
-    dirpath += os.path.join(*Conf['factorio']['savesFolder'].split('/'))
     try:
-        files = os.listdir(dirpath)
+        files = os.listdir(savesFolder)
     except Exception as e:
         logging.error(e)
         raise SavesException(
@@ -0,0 +1,200 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Keep the disk usage of the saves folder within the configured quotas
+(see `Conf['factorio']['storage']`).
+Files of the saves folder are grouped by save family: a save `name.zip`,
+its backup generations `name.zip_back*.zip`, and the family of Factorio's
+own `_autosave*.zip` files (the instances write theirs apart, see
+factorio.WRITE_DATA). Packed backups (`*.zip.fpk`, see tools.recompress)
+belong to the family of the backup.
+When a quota is exceeded or the free disk space falls below
+`minFreeSpace`, generations are evicted, least valuable first:
+* autosaves, oldest first, but never the most recent one
+* backup generations, oldest first, but never the `keepBackups` most
+  recent ones of a family
+The main save of a family is never evicted.
+"""
+
+import os
+import time
+import logging
+from threading import Lock
+
+import psutil
+
+from conf import Conf
+from tools import diskUsage, saves, utils
+
+
+AUTOSAVE_FAMILY = '_autosave'
+# suffix of the backups packed by tools.recompress
+PACKED_SUFFIX = '.fpk'
+QUOTA = Conf['factorio']['storage']['quota']
+FAMILY_QUOTA = Conf['factorio']['storage']['familyQuota']
+MIN_FREE_SPACE = Conf['factorio']['storage']['minFreeSpace']
+KEEP_BACKUPS = max(1, Conf['factorio']['storage']['keepBackups'])
+
+_lock = Lock()
+# most recent evictions, as a list of dicts (see `evict`)
+_evictions = []
+# (saves folder mtime, families) of the last computed ledger
+_ledger = (None, {})
+
+
+def family(filename):
+    """
+    Return the name of the family of the given file of the saves folder,
+    None if it isn't a save.
+    """
+    if filename.endswith(PACKED_SUFFIX):
+        filename = filename[:-len(PACKED_SUFFIX)]
+    if not filename.endswith('.zip'):
+        return None
+    if filename.startswith(AUTOSAVE_FAMILY):
+        return AUTOSAVE_FAMILY
+    if '.zip_back' in filename:
+        return filename.split('.zip_back')[0]
+    return filename[:-4]
+
+
+def kind(filename):
+    """
+    Return 'autosave', 'backup' or 'main'.
+    """
+    if filename.startswith(AUTOSAVE_FAMILY):
+        return 'autosave'
+    if '.zip_back' in filename:
+        return 'backup'
+    return 'main'
+
+
+def ledger():
+    """
+    Return the size ledger of the saves folder as a dict:
+    * total: total size of the saves in bytes
+    * free: free space left on the disk in bytes
+    * families: {family: {'size': bytes, 'generations': [(filename, size,
+      mtime, kind), ...] most recent first}}
+    Sizes come from the cached folder listing of `tools.diskUsage`, and the
+    ledger is only computed again when the content of the saves folder
+    changes.
+    """
+    global _ledger
+    mtime, files = diskUsage.listing(saves.savesFolder)
+    if mtime is None or mtime != _ledger[0]:
+        families = {}
+        for filename, (size, fmtime) in files.iteritems():
+            fam = family(filename)
+            if fam is None:
+                continue
+            data = families.setdefault(fam, {'size': 0, 'generations': []})
+            data['size'] += size
+            data['generations'].append(
+                (filename, size, fmtime, kind(filename)))
+        for data in families.itervalues():
+            data['generations'].sort(key=lambda g: g[2], reverse=True)
+        _ledger = (mtime, families)
+    families = _ledger[1]
+    return {
+        'total': sum(f['size'] for f in families.itervalues()),
+        'free': psutil.disk_usage(saves.savesFolder).free,
+        'families': families
+    }
+
+
+def instancesLedger(instances, current=None):
+    """
+    Return a dict {instance _id: size in bytes of its save family}, given the
+    list of instance documents.
+    """
+    current = current or ledger()
+    return {
+        inst['_id']: current['families'].get(
+            inst['save'], {'size': 0})['size']
+        for inst in instances
+    }
+
+
+def candidates(families, onlyFamily=None):
+    """
+    Return the evictable generations, least valuable first, as a list of
+    (family, filename, size).
+    """
+    autosaves, backups = [], []
+    for fam, data in families.iteritems():
+        if onlyFamily is not None and fam != onlyFamily:
+            continue
+        gens = data['generations']
+        if fam == AUTOSAVE_FAMILY:
+            autosaves += [(g[2], fam, g[0], g[1]) for g in gens[1:]]
+        else:
+            backupGens = [g for g in gens if g[3] == 'backup']
+            backups += [(g[2], fam, g[0], g[1])
+                        for g in backupGens[KEEP_BACKUPS:]]
+    return [c[1:] for c in sorted(autosaves)] + \
+        [c[1:] for c in sorted(backups)]
+
+
+def evict(fam, filename, size, reason):
+    path = os.path.join(saves.savesFolder, filename)
+    try:
+        os.remove(path)
+    except OSError as e:
+        logging.error("Unable to evict %s: %s" % (path, str(e)))
+        return False
+    logging.warning("Evicted %s (%s) from family %s: %s"
+                    % (filename, utils.sizeFormat(size), fam, reason))
+    _evictions.append({'family': fam, 'filename': filename, 'size': size,
+                       'reason': reason, 'ts': time.time()})
+    del _evictions[:-100]
+    return True
+
+
+def enforce(reserve=0):
+    """
+    Evict generations until every quota is respected and at least
+    `reserve` more bytes can be written while keeping `minFreeSpace` bytes
+    free on the disk. Scheduled every `Conf['factorio']['storage']
+    ['interval']` seconds by the server.
+    Returns the number of evicted bytes.
+    """
+    with _lock:
+        current = ledger()
+        families = current['families']
+        evicted = 0
+        total, free = current['total'], current['free']
+
+        for fam, data in families.iteritems():
+            size = data['size']
+            for _, filename, fsize in candidates(families, fam):
+                if size <= FAMILY_QUOTA:
+                    break
+                if evict(fam, filename, fsize, 'family quota exceeded'):
+                    size -= fsize
+                    total -= fsize
+                    free += fsize
+                    evicted += fsize
+        for fam, filename, fsize in candidates(families):
+            if total + reserve <= QUOTA and free - reserve >= MIN_FREE_SPACE:
+                break
+            if not os.path.exists(os.path.join(saves.savesFolder, filename)):
+                continue  # already evicted by the family quota
+            if evict(fam, filename, fsize, 'quota exceeded'
+                     if total + reserve > QUOTA else 'disk almost full'):
+                total -= fsize
+                free += fsize
+                evicted += fsize
+        if free - reserve < MIN_FREE_SPACE:
+            logging.error(
+                "Disk almost full: %s left on the saves disk and nothing "
+                "left to evict." % utils.sizeFormat(free))
+    if evicted:
+        saves.list.invalidate()
+    return evicted
+
+
+def lastEvictions():
+    return list(_evictions)
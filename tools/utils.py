@@ -8,6 +8,8 @@ import time
 from datetime import datetime
 import os
 
+from tools import diskUsage
+
 """
 This module contains miscelaneous functions that can be useful anywhere in
 the project.
@@ -28,11 +30,12 @@ def sizeFormat(sizeInBytes):
         return "%.3fGb" % (size / (1024 ** 3))
 
 def getFolderSize(path, formatted=False):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
+    """
+    Return the total size of the files in the given folder, formatted using
+    `sizeFormat` if `formatted` is True.
+    See `tools.diskUsage` for details.
+    """
+    total_size = diskUsage.folderSize(path)
     if formatted:
         return sizeFormat(total_size)
     return total_size
@@ -0,0 +1,123 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+"""
+Integrity verification of the save archives.
+A save is valid if it is a readable zip archive whose members all match
+their CRC. Results are cached by (path, mtime, size), so unchanged files
+are never checked twice, and many files are checked in parallel in a pool
+of processes (decompression is CPU bound).
+"""
+
+import os
+import zipfile
+import logging
+import multiprocessing
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+
+from conf import Conf
+from server import memory
+from tools import saves, placement
+
+
+_cache = memory.getCache('verify', **Conf['cache']['verify'])
+_executor = None
+_lock = Lock()
+# set in the worker processes once their priority is lowered
+_background = False
+
+
+def checkArchive(path):
+    """
+    Raise an exception if the file at `path` isn't a valid zip archive, or if
+    any of its members is corrupted.
+    """
+    with zipfile.ZipFile(path) as archive:
+        bad = archive.testzip()
+    if bad is not None:
+        raise zipfile.BadZipfile("Corrupted member: %s" % bad)
+
+
+def _check(path):
+    """
+    Return None if the archive is valid, the error message otherwise.
+    Runs in the worker processes.
+    """
+    try:
+        checkArchive(path)
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    return None
+
+
+def _checkInWorker(path):
+    global _background
+    if not _background:
+        placement.background()
+        _background = True
+    return _check(path)
+
+
+def _key(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+
+def _getExecutor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(multiprocessing.cpu_count())
+    return _executor
+
+
+def verify(path):
+    """
+    Check the archive at `path` in the current process.
+    Returns a tuple (valid, error message or None).
+    """
+    key = _key(path)
+    error = _cache.getOrCompute(key, lambda: _check(path) or '')
+    return not error, error or None
+
+
+def verifyMany(paths):
+    """
+    Check the given archives, in parallel for the ones whose result isn't
+    cached yet. Returns a dict {path: (valid, error message or None)}.
+    Paths that can't be accessed anymore are reported as invalid.
+    """
+    results, todo = {}, []
+    for path in paths:
+        try:
+            key = _key(path)
+        except OSError as e:
+            results[path] = (False, str(e))
+            continue
+        error = _cache.get(key)
+        if error is None:
+            todo.append((path, key))
+        else:
+            results[path] = (not error, error or None)
+    if todo:
+        errors = _getExecutor().map(
+            _checkInWorker, [path for path, _ in todo])
+        for (path, key), error in zip(todo, errors):
+            _cache.set(key, error or '')
+            results[path] = (error is None, error)
+            if error is not None:
+                logging.warning("Corrupted save %s: %s" % (path, error))
+    return results
+
+
+def sweep():
+    """
+    Check all the archives of the saves folder.
+    Returns a dict {filename: (valid, error message or None)}.
+    """
+    paths = [os.path.join(saves.savesFolder, f)
+             for f in os.listdir(saves.savesFolder) if f.endswith('.zip')]
+    return {os.path.basename(path): res
+            for path, res in verifyMany(paths).iteritems()}